@@ -1,6 +1,11 @@
+import atexit
+import json
 import logging
 import os
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 
 from PySide2.QtUiTools import QUiLoader
 from PySide2.QtCore import QFile
@@ -11,7 +16,7 @@ server_endpoint = 'http://localhost:8000'
 
 # Carrega arquivo .ui gerado pelo Qt Designer e retorna widget
 def load_ui(ui_file: str, parent_widget=None) -> QWidget:
-    log.info(f'Loading UI file {ui_file}')
+    log.info('Loading UI file %s', ui_file)
     ui_path = os.path.join(os.getcwd(), 'ui', ui_file)
     file = QFile(ui_path)
     file.open(QFile.ReadOnly)
@@ -19,7 +24,59 @@ def load_ui(ui_file: str, parent_widget=None) -> QWidget:
     return loader.load(file, parent_widget)
 
 
-# Log é mais facilmente extensível e informativo que print
+# Registro persistente das sessões de upload retomáveis ainda não finalizadas. A chave inclui tamanho e data de
+# modificação do arquivo, pra que um arquivo alterado desde a última tentativa não seja retomado.
+class PendingUploads:
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as fd:
+                return json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, sessions: dict) -> None:
+        with open(self.path, 'w') as fd:
+            json.dump(sessions, fd)
+
+    @staticmethod
+    def _key(file_path: str) -> str:
+        stat = os.stat(file_path)
+        return f'{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}'
+
+    def get(self, file_path: str) -> Optional[str]:
+        return self._load().get(self._key(file_path))
+
+    def add(self, file_path: str, session_id: str) -> None:
+        sessions = self._load()
+        sessions[self._key(file_path)] = session_id
+        self._save(sessions)
+
+    def remove(self, file_path: str) -> None:
+        sessions = self._load()
+        sessions.pop(self._key(file_path), None)
+        self._save(sessions)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Põe os registros numa fila limitada sem nunca esperar; se ela estiver cheia, o registro é descartado."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # A mensagem só é formatada na thread de escrita
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+# Log é mais facilmente extensível e informativo que print. Os registros são escritos por uma thread própria, pra
+# que um terminal lento não trave a interface nem as threads de upload.
 log = logging.getLogger('desafio_upload_client')
 log.setLevel(logging.INFO)
 
@@ -27,4 +84,9 @@ handler = logging.StreamHandler(sys.stdout)
 handler.setLevel(logging.DEBUG)
 formatter = logging.Formatter('[%(levelname)s] %(asctime)s - %(message)s')
 handler.setFormatter(formatter)
-log.addHandler(handler)
+
+log_queue = queue.Queue(10000)
+log.addHandler(DroppingQueueHandler(log_queue))
+log_writer = QueueListener(log_queue, handler, respect_handler_level=True)
+log_writer.start()
+atexit.register(log_writer.stop)
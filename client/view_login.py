@@ -88,10 +88,10 @@ class LoginWidget(QWidget):
             super().__init__(parent)
             self.operation = operation
             assert self.operation in ('login', 'register')
-            log.info(f'Creating {self.operation} thread...')
+            log.info('Creating %s thread...', self.operation)
 
         def run(self):
-            log.info(f'Starting {self.operation} thread...')
+            log.info('Starting %s thread...', self.operation)
             parent = self.parent()
 
             # Iniciamos a requisição de login ou cadastro.
@@ -102,17 +102,17 @@ class LoginWidget(QWidget):
                 })
             # ConnectionError não é um erro gerado pelo servidor, mas sim de falha de conexão.
             except requests.exceptions.ConnectionError:
-                log.info(f'{self.operation} failed: connection to server failed.')
+                log.info('%s failed: connection to server failed.', self.operation)
                 self.signal_login_register_failed.emit('Erro ao conectar ao servidor.')
                 return
 
             # Verificamos se a operação de login/cadastro teve sucesso...
             if self.operation == 'login' and r.status_code == 200:
                 parent.did_login.emit(r.json()['username'])
-                log.info(f'Login successful ({r.json()["username"]})')
+                log.info('Login successful (%s)', r.json()['username'])
             elif self.operation == 'register' and r.status_code == 200:
                 parent.did_register.emit(r.json()['username'])
-                log.info(f'Registration successful ({r.json()["username"]})')
+                log.info('Registration successful (%s)', r.json()['username'])
 
             # Se não houve sucesso, indicamos ao usuário o erro ocorrido, se possível
             else:
@@ -122,6 +122,6 @@ class LoginWidget(QWidget):
                     409: 'Usuário já existente',
                     422: 'Dados inválidos.'
                 }
-                log.info(f'{self.operation} failed: {r.status_code}\n{r.json()}')
+                log.info('%s failed: %d\n%s', self.operation, r.status_code, r.json())
                 error_message = error_codes.get(r.status_code, 'Houve um erro.')
                 self.signal_login_register_failed.emit(error_message)
@@ -1,15 +1,48 @@
+import hashlib
+import json
 import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List
 
 import requests
-from requests_toolbelt import MultipartEncoderMonitor
 
 from PySide2.QtWidgets import *
 from PySide2.QtGui import QDragEnterEvent, QDropEvent
-from PySide2.QtCore import Signal, QStringListModel, QThread, QTimer
+from PySide2.QtCore import Signal, QStringListModel, QThread
 
-from utils import load_ui, server_endpoint, log
+from utils import load_ui, server_endpoint, log, PendingUploads
+
+# Tamanho dos blocos lidos do arquivo durante o upload; também define a granularidade da barra de progresso
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+# Tamanho dos blocos lidos ao calcular o hash do arquivo antes do upload
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Arquivos a partir desse tamanho são enviados em partes de UPLOAD_PART_SIZE bytes, PARALLEL_UPLOADS por vez
+PARALLEL_UPLOAD_THRESHOLD = 64 * 1024 * 1024
+UPLOAD_PART_SIZE = 16 * 1024 * 1024
+PARALLEL_UPLOADS = 4
+
+# Os dados são enviados comprimidos com gzip se uma amostra de COMPRESSION_SAMPLE_SIZE bytes do início do arquivo
+# ficar com no máximo COMPRESSION_MAX_RATIO do tamanho original; arquivos que já são comprimidos (ex.: vídeos,
+# arquivos .zip) vão como estão. O nível de compressão baixo evita que ela fique mais lenta que a rede.
+COMPRESSION_SAMPLE_SIZE = 1024 * 1024
+COMPRESSION_MAX_RATIO = 0.9
+COMPRESSION_LEVEL = 1
+
+# Quantidade de arquivos pedida por página ao atualizar a lista de arquivos já enviados
+FILES_PAGE_SIZE = 1000
+
+# Tempo máximo sem receber nada do feed de mudanças antes de considerar a conexão perdida (o servidor manda um
+# keepalive a cada 15 segundos), e espera antes de reconectar
+EVENTS_READ_TIMEOUT = 60
+EVENTS_RETRY_INTERVAL = 2
+
+# Sessões de upload ainda não finalizadas, salvas em disco pra que possam ser retomadas mesmo após reiniciar
+pending_uploads = PendingUploads(os.path.join(os.getcwd(), 'pending_uploads.json'))
 
 
 class UploadViewWidget(QWidget):
@@ -43,12 +76,10 @@ class UploadViewWidget(QWidget):
         self.button_select_file.clicked.connect(self.pick_file)
         self.button_upload.clicked.connect(self.button_upload_clicked)
 
-        # Agendar atualização contínua de lista de arquivos já enviados
+        # Iniciar atualização contínua de lista de arquivos já enviados
         self.uploaded_files_data = []
-        self.update_uploaded_files_timer = QTimer()
-        self.update_uploaded_files_timer.timeout.connect(self.launch_update_uploads_thread)
-        self.update_uploaded_files_timer.setInterval(1000)
-        self.update_uploaded_files_timer.start()
+        self.update_uploads_thread_task = None
+        self.launch_update_uploads_thread()
 
         self.is_uploading = False
         self.upload_thread_task = None
@@ -57,9 +88,9 @@ class UploadViewWidget(QWidget):
     # Funções de lançamento de threads
 
     def launch_update_uploads_thread(self):
-        thread_task = self.UpdatePastUploads(self)
-        thread_task.signal_update_past_uploads.connect(self.update_past_downloads_list)
-        thread_task.start()
+        self.update_uploads_thread_task = self.UpdatePastUploads(self)
+        self.update_uploads_thread_task.signal_update_past_uploads.connect(self.update_past_downloads_list)
+        self.update_uploads_thread_task.start()
 
     def button_upload_clicked(self):
         if not self.is_uploading:
@@ -128,83 +159,232 @@ class UploadViewWidget(QWidget):
         def __init__(self, parent):
             super().__init__(parent)
             self.upload_cancelled = False
-
-        # Callback de atualização da barra de progresso e verificação de cancelamento
-        def upload_progress_callback(self, monitor: MultipartEncoderMonitor) -> None:
-            # Mandamos um sinal pra barra de progresso para que atualize o valor mostrado
-            # baseado na quantidade de bytes lidos e faltantes
-            val = int(100 * monitor.bytes_read / monitor.len)
+            self.file_size = 0
+            self.bytes_sent = 0
+            self.progress_lock = threading.Lock()
+            self.compress = False
+
+        def add_progress(self, sent: int) -> None:
+            with self.progress_lock:
+                self.bytes_sent += sent
+                val = int(100 * self.bytes_sent / self.file_size) if self.file_size else 100
             self.signal_update_progress_bar.emit(val)
 
-            # Se a flag de upload cancelado for ativada, então cancelamos a requisição trocando
-            # o método read do MultipartEncoder por uma função que simplesmente levanta a exceção
-            # UploadCancelledError. Em seguida, basta tratar da exceção como se fosse um erro de
-            # conexão.
-            if self.upload_cancelled:
-                def cancel_upload(*args, **kwargs):
+        # Gera `length` bytes do arquivo a partir de `offset`, atualizando a barra de progresso e verificando
+        # cancelamento a cada bloco. Se a flag de upload cancelado for ativada, levantamos a exceção
+        # UploadCancelledError, o que interrompe a requisição em andamento.
+        def iter_file(self, fd, offset: int, length: int):
+            fd.seek(offset)
+            while length > 0:
+                if self.upload_cancelled:
                     raise UploadCancelledError
-
-                monitor.read = cancel_upload
+                chunk = fd.read(min(UPLOAD_CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                yield chunk
+                length -= len(chunk)
+                self.add_progress(len(chunk))
+
+        # Comprime com gzip os blocos gerados por `chunks`. O progresso continua contado pelos bytes lidos do arquivo.
+        def compress_chunks(self, chunks):
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            for chunk in chunks:
+                output = compressor.compress(chunk)
+                # Um bloco vazio encerraria o corpo da requisição (Transfer-Encoding: chunked)
+                if output:
+                    yield output
+            yield compressor.flush()
+
+        # Corpo e cabeçalhos da requisição que envia `length` bytes do arquivo a partir de `offset`
+        def request_body(self, fd, offset: int, length: int):
+            chunks = self.iter_file(fd, offset, length)
+            if self.compress:
+                return self.compress_chunks(chunks), {'Content-Encoding': 'gzip'}
+            return chunks, {}
+
+        # Verifica se vale a pena comprimir o arquivo, comprimindo uma amostra do início
+        def should_compress(self, file_path: str) -> bool:
+            with open(file_path, 'rb') as fd:
+                sample = fd.read(COMPRESSION_SAMPLE_SIZE)
+            return bool(sample) and len(zlib.compress(sample, COMPRESSION_LEVEL)) <= len(sample) * COMPRESSION_MAX_RATIO
+
+        # Calcula o hash SHA-256 do arquivo, verificando cancelamento a cada bloco
+        def hash_file(self, file_path: str) -> str:
+            hasher = hashlib.sha256()
+            with open(file_path, 'rb') as fd:
+                while True:
+                    if self.upload_cancelled:
+                        raise UploadCancelledError
+                    chunk = fd.read(HASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+            return hasher.hexdigest()
+
+        # Retoma a sessão de upload salva pra esse arquivo, se ainda existir no servidor, ou cria uma nova, com o
+        # hash do arquivo, que o servidor confere antes de criá-lo. Retorna a resposta da criação em caso de erro
+        # (ex.: 409 se o arquivo já existe).
+        def open_session(self, session: requests.Session, file_path: str, filename: str, file_size: int,
+                         digest: str):
+            session_id = pending_uploads.get(file_path)
+            if session_id is not None:
+                r = session.get(f'{server_endpoint}/uploads/{session_id}')
+                if r.status_code == 200:
+                    log.info('Resuming upload of %s at offset %s', filename, r.json()['offset'])
+                    return r
+                pending_uploads.remove(file_path)
+
+            # Arquivos grandes são enviados em partes, por várias conexões em paralelo
+            session_in = {'filename': filename, 'size': file_size, 'sha256': digest}
+            if file_size >= PARALLEL_UPLOAD_THRESHOLD:
+                session_in['part_size'] = UPLOAD_PART_SIZE
+            r = session.post(f'{server_endpoint}/uploads', json=session_in)
+            if r.status_code == 201:
+                pending_uploads.add(file_path, r.json()['id'])
+            return r
+
+        # Envia sequencialmente o restante do arquivo, a partir do offset já confirmado pelo servidor
+        def upload_sequential(self, session: requests.Session, file_path: str, session_info: dict):
+            offset = session_info['offset']
+            self.add_progress(offset)
+            with open(file_path, 'rb') as fd:
+                data, headers = self.request_body(fd, offset, self.file_size - offset)
+                return session.put(f'{server_endpoint}/uploads/{session_info["id"]}', params={'offset': offset},
+                                   data=data, headers=headers)
+
+        # Envia em paralelo as partes ainda não confirmadas pelo servidor; retorna a primeira resposta de erro,
+        # se houver, ou a resposta de uma das partes
+        def upload_parts(self, session: requests.Session, file_path: str, session_info: dict):
+            part_size = session_info['part_size']
+            committed = set(session_info.get('parts', []))
+            self.add_progress(session_info['offset'])
+
+            def upload_part(number: int):
+                with open(file_path, 'rb') as fd:
+                    start = number * part_size
+                    data, headers = self.request_body(fd, start, min(part_size, self.file_size - start))
+                    return session.put(f'{server_endpoint}/uploads/{session_info["id"]}/parts/{number}',
+                                       data=data, headers=headers)
+
+            part_count = max(1, -(-self.file_size // part_size))
+            missing = [number for number in range(part_count) if number not in committed]
+            with ThreadPoolExecutor(max_workers=PARALLEL_UPLOADS) as executor:
+                responses = list(executor.map(upload_part, missing))
+
+            failed = [r for r in responses if r.status_code != 200]
+            return failed[0] if failed else responses[-1] if responses else None
+
+        # Envia o arquivo por uma sessão de upload e a finaliza; retorna a resposta da finalização ou a primeira
+        # resposta de erro
+        def upload_with_session(self, session: requests.Session, file_path: str, filename: str, file_size: int,
+                                digest: str):
+            r = self.open_session(session, file_path, filename, file_size, digest)
+            if r.status_code not in (200, 201):
+                return r
+
+            session_info = r.json()
+            self.compress = self.should_compress(file_path)
+            if session_info['part_size'] is None:
+                r = self.upload_sequential(session, file_path, session_info)
+            else:
+                r = self.upload_parts(session, file_path, session_info) or r
+            if r.status_code not in (200, 201):
+                return r
+
+            r = session.post(f'{server_endpoint}/uploads/{session_info["id"]}/complete')
+            if r.status_code in (200, 409):
+                pending_uploads.remove(file_path)
+            return r
+
+        # Envia um arquivo cujo nome já foi reservado, criando-o a partir do hash se o servidor já tiver o conteúdo
+        def upload_reserved(self, session: requests.Session, file_path: str, filename: str, file_size: int):
+            digest = self.hash_file(file_path)
+            r = session.get(f'{server_endpoint}/blobs/{digest}')
+            if r.status_code == 200:
+                log.info('Content of %s already stored in server, skipping transfer', filename)
+                return session.post(f'{server_endpoint}/upload/by-hash', json={'filename': filename, 'sha256': digest})
+            return self.upload_with_session(session, file_path, filename, file_size, digest)
 
         def run(self) -> None:
-            log.info(f'Starting upload thread...')
+            log.info('Starting upload thread...')
 
             parent = self.parent()
-            selected_filename = os.path.basename(parent.selected_file)
-
-            # O requests por padrão não disponibiliza um jeito de rastrear o progresso de upload.
-            # Por isso, utilizamos o MultipartEncoderMonitor do requests-toolbelt, que nos permite
-            # setar um callback que é chamado quando há uma atualização, e por sua vez emite um sinal
-            # que atualiza a ProgressBar de modo não-blocante.
-            with open(parent.selected_file, 'rb') as fd:
-                # Criamos o MultipartEncoderMonitor
-                monitor = MultipartEncoderMonitor.from_fields(
-                    fields={'file': (selected_filename, fd, 'text/plain')},
-                    callback=self.upload_progress_callback)
-
-                # Fazemos a requisição
-                try:
-                    r = parent.session.post(f'{server_endpoint}/upload', data=monitor,
-                                            headers={'Content-Type': monitor.content_type})
-                except requests.exceptions.ConnectionError:
-                    log.info(f'Upload failed for {selected_filename}: connection to server failed.')
-                    result_message = 'Conexão com o servidor perdida.'
-                    self.signal_upload_finished.emit(result_message)
-                    return
-                except UploadCancelledError:
-                    log.info(f'Upload for {selected_filename} cancelled.')
-                    result_message = f'Upload cancelado:\n{selected_filename}'
-                    self.signal_upload_finished.emit(result_message)
-                    return
+            file_path = parent.selected_file
+            selected_filename = os.path.basename(file_path)
+            file_size = self.file_size = os.path.getsize(file_path)
+
+            # O upload é feito por uma sessão retomável: se a conexão cair ou o upload for interrompido, os bytes
+            # já confirmados pelo servidor não precisam ser reenviados na próxima tentativa com o mesmo arquivo.
+            # Se o servidor já tiver o conteúdo do arquivo (com qualquer nome), ele é criado a partir do hash, sem
+            # enviar os bytes.
+            try:
+                # Antes de tudo reservamos o nome do arquivo: se ele já existir ou faltar espaço no servidor,
+                # ficamos sabendo sem calcular o hash nem enviar nenhum byte
+                r = parent.session.post(f'{server_endpoint}/upload/reserve',
+                                        json={'filename': selected_filename, 'size': file_size})
+                if r.status_code == 200:
+                    r = self.upload_reserved(parent.session, file_path, selected_filename, file_size)
+            except requests.exceptions.ConnectionError:
+                log.info('Upload failed for %s: connection to server failed.', selected_filename)
+                result_message = f'Conexão com o servidor perdida.\nO upload de {selected_filename} será retomado.'
+                self.signal_upload_finished.emit(result_message)
+                return
+            except UploadCancelledError:
+                log.info('Upload for %s cancelled.', selected_filename)
+                result_message = f'Upload interrompido:\n{selected_filename}'
+                self.signal_upload_finished.emit(result_message)
+                return
 
             # Determinamos a mensagem a ser mostrada e emitimos o sinal de upload concluído.
             if r.status_code == 200:
-                log.info(f'Successfully uploaded {selected_filename}')
+                log.info('Successfully uploaded %s', selected_filename)
                 result_message = f'Upload concluído:\n{selected_filename}'
             elif r.status_code == 409:
-                log.info(f'Failed to upload {selected_filename}: file already exists in remote server (409).')
+                log.info('Failed to upload %s: file already exists in remote server (409).', selected_filename)
                 result_message = f'Conflito:\nArquivo {selected_filename} já existe.'
+            elif r.status_code == 507:
+                log.info('Failed to upload %s: not enough storage space in remote server (507).', selected_filename)
+                result_message = f'Sem espaço no servidor para\n{selected_filename}'
             else:
-                log.info(f'Failed to upload {selected_filename}: ({r.status_code})\n{r.json()}')
+                log.info('Failed to upload %s: (%d)\n%s', selected_filename, r.status_code, r.json())
                 result_message = f'({r.status_code}) Houve um erro no upload de\n{selected_filename}'
             self.signal_upload_finished.emit(result_message)
 
-    # Thread de update dos arquivos já existentes mostrados à direita
+    # Thread de update dos arquivos já existentes mostrados à direita. A lista é carregada uma vez e depois
+    # atualizada pelos eventos do feed de mudanças do servidor (GET /events), que só envia dados quando algum arquivo
+    # é criado ou removido; se a conexão cair, o feed é retomado a partir do último evento recebido.
     class UpdatePastUploads(QThread):
         signal_update_past_uploads = Signal(list)
 
-        def run(self) -> None:
-            parent = self.parent()
-
-            # Não continuar se não estivermos logados
-            if 'Authorization' not in parent.session.cookies:
-                return
-
-            # Fazer requisição à rota que disponibiliza informação de arquivos existentes
-            r = parent.session.get(f'{server_endpoint}/files')
-            existing_files = r.json()
+        def __init__(self, parent):
+            super().__init__(parent)
+            self.files = {}
+            self.last_event_id = None
+            # Última resposta de cada página, por cursor, como (ETag, página)
+            self.pages = {}
+
+        # Carregar a lista completa, seguindo o cursor de cada página até a última. Cada página é pedida com o
+        # ETag da última resposta dela; se nada mudou, o servidor responde 304 e reaproveitamos a que já temos.
+        def load_files(self, session: requests.Session) -> None:
+            files = {}
+            params = {'limit': FILES_PAGE_SIZE}
+            while True:
+                etag, page = self.pages.get(params.get('cursor'), (None, None))
+                headers = {} if etag is None else {'If-None-Match': etag}
+                r = session.get(f'{server_endpoint}/files', params=params, headers=headers)
+                if r.status_code != 304:
+                    r.raise_for_status()
+                    page = r.json()
+                    self.pages[params.get('cursor')] = (r.headers.get('ETag'), page)
+                files.update((file['filename'], file) for file in page['files'])
+                if page['next_cursor'] is None:
+                    break
+                params['cursor'] = page['next_cursor']
+            self.files = files
+
+        def emit_files(self) -> None:
             lines = []
-            for file in existing_files:
+            for file in sorted(self.files.values(), key=lambda file: (file['uploaded_at'], file['filename'])):
                 dt = datetime.fromisoformat(file["uploaded_at"])
                 dt_str = dt.strftime('%c')
                 line = f'{file["filename"]} - enviado por {file["uploaded_by"]} ({dt_str})'
@@ -213,6 +393,48 @@ class UploadViewWidget(QWidget):
             # Emitir sinal de atualização
             self.signal_update_past_uploads.emit(lines)
 
+        def handle_event(self, session: requests.Session, event: dict) -> None:
+            kind = event.get('event')
+            if kind in ('ready', 'reset'):
+                # Início do feed: a lista carregada agora já inclui tudo até esse evento
+                self.load_files(session)
+            elif kind == 'added':
+                file = json.loads(event['data'])
+                self.files[file['filename']] = file
+            elif kind == 'deleted':
+                self.files.pop(json.loads(event['data'])['filename'], None)
+            else:
+                return
+            self.last_event_id = event.get('id')
+            self.emit_files()
+
+        # Acompanhar o feed até a conexão cair. Com chunk_size=None, cada bloco é entregue assim que chega, em
+        # vez de esperar acumular um tamanho fixo.
+        def follow_events(self, session: requests.Session) -> None:
+            headers = {} if self.last_event_id is None else {'Last-Event-ID': self.last_event_id}
+            with session.get(f'{server_endpoint}/events', headers=headers, stream=True,
+                             timeout=(EVENTS_READ_TIMEOUT, EVENTS_READ_TIMEOUT)) as r:
+                r.raise_for_status()
+                event = {}
+                for line in r.iter_lines(chunk_size=None, decode_unicode=True):
+                    if not line:
+                        self.handle_event(session, event)
+                        event = {}
+                    elif not line.startswith(':'):
+                        field, _, value = line.partition(':')
+                        event[field] = value[1:] if value.startswith(' ') else value
+
+        def run(self) -> None:
+            parent = self.parent()
+            while True:
+                # Não continuar se não estivermos logados
+                if 'Authorization' in parent.session.cookies:
+                    try:
+                        self.follow_events(parent.session)
+                    except (requests.exceptions.RequestException, ValueError) as e:
+                        log.info('Lost connection to the change feed (%s), reconnecting', e)
+                self.sleep(EVENTS_RETRY_INTERVAL)
+
     # # # # # # # # # # # # # # # # # # # #
     # Seleção de arquivos de upload (botão e arrastar)
 
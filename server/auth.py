@@ -0,0 +1,125 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+
+import jwt
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from config import TOKEN_LIFETIME, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL
+from database import RevokedToken
+from threadpool import run_db
+
+JWT_SECRET = 'this-is-very-secret-dont-leak'
+
+
+class TokenCache:
+    """Cache limitado dos tokens já verificados, mapeados pros seus claims.
+
+    Cada entrada vale por no máximo `ttl` segundos e nunca além do `exp` do token; passando de `max_size`
+    entradas, as usadas há mais tempo são descartadas. Os tokens revogados neste processo também são lembrados por
+    `ttl` segundos, pra que uma verificação que consultou o banco de dados antes da revogação não os coloque de
+    volta no cache. Pode ser usado de várias threads.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._revoked = {}  # jti -> até quando é lembrado
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            claims, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return claims
+
+    def put(self, token: str, claims: dict) -> None:
+        expires_at = min(time.time() + self.ttl, claims['exp'])
+        with self._lock:
+            if claims['jti'] in self._revoked:
+                return
+            self._entries[token] = (claims, expires_at)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def revoke(self, token: str, claims: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._entries.pop(token, None)
+            self._revoked[claims['jti']] = min(now + self.ttl, claims['exp'])
+            self._revoked = {jti: until for jti, until in self._revoked.items() if until > now}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._revoked.clear()
+
+
+token_cache = TokenCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+def issue_token(username: str) -> str:
+    claims = {'username': username, 'exp': int(time.time()) + TOKEN_LIFETIME, 'jti': uuid.uuid4().hex}
+    return jwt.encode(claims, key=JWT_SECRET, algorithm='HS256').decode()
+
+
+def decode_token(token: str, verify_exp: bool = True) -> dict:
+    try:
+        claims = jwt.decode(token, key=JWT_SECRET, algorithms=['HS256'],
+                            options={'require_exp': True, 'verify_exp': verify_exp})
+    except jwt.InvalidTokenError:
+        raise HTTPException(403, 'Invalid or expired token; login again.')
+    if 'jti' not in claims or 'username' not in claims:
+        raise HTTPException(403, 'Invalid or expired token; login again.')
+    return claims
+
+
+# Verificação completa de um token que não está no cache: assinatura, validade e revogação. Faz I/O bloqueante.
+def verify_token(token: str) -> dict:
+    claims = decode_token(token)
+    if RevokedToken.select().where(RevokedToken.jti == claims['jti']).count() > 0:
+        raise HTTPException(403, 'Token was revoked; login again.')
+    token_cache.put(token, claims)
+    return claims
+
+
+def revoke_token(token: str) -> None:
+    """Revoga o token (ex.: logout). Faz I/O bloqueante."""
+    claims = decode_token(token, verify_exp=False)
+    token_cache.revoke(token, claims)
+    RevokedToken.insert(jti=claims['jti'],
+                        expires_at=datetime.fromtimestamp(claims['exp'])).on_conflict_ignore().execute()
+
+    # Tokens que já expiraram não precisam mais constar como revogados
+    RevokedToken.delete().where(RevokedToken.expires_at < datetime.now()).execute()
+
+
+def get_token(request: Request) -> str:
+    jwt_token = request.cookies.get('Authorization')
+
+    if jwt_token is None:
+        raise HTTPException(403, 'You need to login to use this feature.')
+
+    return jwt_token.split(' ')[-1]
+
+
+# Toda requisição autenticada passa por aqui. Tokens já verificados vêm do cache, sem verificar a assinatura de
+# novo nem sair do event loop; só os outros passam pela verificação completa, no pool de I/O.
+async def get_current_user(request: Request) -> str:
+    jwt_token = get_token(request)
+    claims = token_cache.get(jwt_token)
+    if claims is None:
+        claims = await run_db(verify_token, jwt_token)
+    return claims['username']
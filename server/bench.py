@@ -0,0 +1,294 @@
+"""Micro-benchmarks do servidor, executados diretamente sobre a aplicação ASGI (sem rede).
+
+Uso: python bench.py upload [--size-mb 256] [--runs 3]
+     python bench.py latency [--size-mb 256]
+     python bench.py files [--count 20000]
+     python bench.py auth [--requests 20000]
+
+Os benchmarks rodam num diretório temporário com o banco de dados de testes, então não tocam em
+`uploads/` nem em `uploads.db`.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVER_DIR)
+
+# Tamanho dos pedaços entregues à aplicação, igual ao tamanho de leitura do uvicorn/h11
+RECEIVE_CHUNK_SIZE = 64 * 1024
+BOUNDARY = b'benchboundary'
+
+
+def setup_environment():
+    workdir = tempfile.mkdtemp(prefix='upload_bench_')
+    os.chdir(workdir)
+    os.mkdir('uploads')
+    os.environ['UPLOAD_DIR'] = os.path.join(workdir, 'uploads')
+    os.environ['TEST_DB'] = 'TRUE'
+
+    import main
+    from auth import issue_token
+    from database import User
+
+    User.create(username='bench', password_hash='-')
+    token = issue_token('bench')
+    return main, workdir, token
+
+
+def multipart_body(filename: str, size: int):
+    random_block = os.urandom(1024 * 1024)
+    yield (b'--' + BOUNDARY + b'\r\n'
+           b'Content-Disposition: form-data; name="file"; filename="' + filename.encode() + b'"\r\n'
+           b'Content-Type: application/octet-stream\r\n\r\n')
+    remaining = size
+    while remaining > 0:
+        block = random_block[:min(remaining, len(random_block))]
+        for start in range(0, len(block), RECEIVE_CHUNK_SIZE):
+            yield block[start:start + RECEIVE_CHUNK_SIZE]
+        remaining -= len(block)
+    yield b'\r\n--' + BOUNDARY + b'--\r\n'
+
+
+async def asgi_request(app, method: str, path: str, headers: dict, body=(), messages: list = None) -> int:
+    # Retorna o status da resposta; com `messages`, acrescenta a ela as mensagens ASGI enviadas pela aplicação
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+        'path': path, 'root_path': '', 'query_string': b'',
+        'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        'client': ('127.0.0.1', 50000), 'server': ('127.0.0.1', 8000),
+    }
+    body = iter(body)
+    status = None
+
+    async def receive():
+        # Devolvemos o controle ao event loop a cada pedaço, como aconteceria lendo de um socket
+        await asyncio.sleep(0)
+        chunk = next(body, None)
+        if chunk is None:
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        return {'type': 'http.request', 'body': chunk, 'more_body': True}
+
+    async def send(message):
+        nonlocal status
+        if messages is not None:
+            messages.append(message)
+        if message['type'] == 'http.response.start':
+            status = message['status']
+
+    await app(scope, receive, send)
+    return status
+
+
+def legacy_upload_app(main):
+    # Reprodução da rota original, que recebia um UploadFile já gravado num arquivo temporário
+    # e o copiava pra pasta de uploads de 1000 em 1000 bytes
+    from datetime import datetime
+    from fastapi import FastAPI, File, UploadFile, Depends
+    from database import FileUpload
+
+    app = FastAPI()
+
+    @app.post('/upload')
+    async def upload_file(current_user: str = Depends(main.get_current_user), file: UploadFile = File(...)):
+        with open(os.path.join(os.getcwd(), 'uploads', file.filename), 'wb') as fd:
+            while True:
+                chunk = file.file.read(1000)
+                fd.write(chunk)
+                if chunk == b'':
+                    break
+        FileUpload.create(uploaded_by=current_user, uploaded_at=datetime.now(), filename=file.filename)
+        return {'filename': file.filename}
+
+    return app
+
+
+def bench_upload(args):
+    main, workdir, token = setup_environment()
+    import blobs
+    size = args.size_mb * 1024 * 1024
+    headers = {
+        'Cookie': f'Authorization="Bearer {token}"',
+        'Content-Type': f'multipart/form-data; boundary={BOUNDARY.decode()}',
+    }
+    apps = [('legacy (UploadFile + 1000 B copy)', legacy_upload_app(main)),
+            ('streaming (request.stream())', main.app)]
+
+    print(f'Upload of {args.size_mb} MiB, best of {args.runs} runs (workdir {workdir})')
+    for name, app in apps:
+        timings = []
+        for run in range(args.runs):
+            filename = f'{abs(hash(name))}-{run}.bin'
+            started = time.perf_counter()
+            status = asyncio.run(asgi_request(app, 'POST', '/upload', headers, multipart_body(filename, size)))
+            timings.append(time.perf_counter() - started)
+            assert status == 200, status
+            blobs.delete_file(filename, 'bench')
+        best = min(timings)
+        print(f'  {name:40s} {best:8.3f} s  {args.size_mb / best:9.1f} MiB/s')
+
+
+def percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def bench_latency(args):
+    main, workdir, token = setup_environment()
+    import blobs
+    size = args.size_mb * 1024 * 1024
+    cookie = f'Authorization="Bearer {token}"'
+    upload_headers = {'Cookie': cookie, 'Content-Type': f'multipart/form-data; boundary={BOUNDARY.decode()}'}
+
+    # Mede a latência de GET /files disparados a cada `interval` segundos enquanto um upload grande é processado
+    # no mesmo loop. A latência é contada a partir do instante em que a requisição deveria ter saído, pra que
+    # um loop travado apareça nos números em vez de simplesmente atrasar as medições.
+    async def measure(upload_app, filename):
+        interval = 0.005
+        latencies = []
+        upload = None
+        if upload_app is not None:
+            upload = asyncio.ensure_future(
+                asgi_request(upload_app, 'POST', '/upload', upload_headers, multipart_body(filename, size)))
+        first = time.perf_counter()
+        count = 0
+        while (count < args.requests) if upload is None else not upload.done():
+            scheduled = first + count * interval
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            status = await asgi_request(main.app, 'GET', '/files', {'Cookie': cookie})
+            latencies.append(time.perf_counter() - scheduled)
+            assert status == 200, status
+            count += 1
+        if upload is not None:
+            assert await upload == 200
+            blobs.delete_file(filename, 'bench')
+        return latencies
+
+    scenarios = [('idle', None), ('during legacy upload', legacy_upload_app(main)),
+                 ('during streaming upload', main.app)]
+
+    print(f'GET /files latency while uploading {args.size_mb} MiB (workdir {workdir})')
+    for index, (name, upload_app) in enumerate(scenarios):
+        latencies = asyncio.run(measure(upload_app, f'latency-{index}.bin'))
+        print(f'  {name:28s} n={len(latencies):5d}  p50 {1000 * percentile(latencies, 0.5):8.2f} ms'
+              f'  p99 {1000 * percentile(latencies, 0.99):8.2f} ms  max {1000 * max(latencies):8.2f} ms')
+
+
+def bench_files(args):
+    main, workdir, token = setup_environment()
+    from datetime import datetime, timedelta
+    from database import db, FileUpload
+    import catalog
+
+    # Catálogo com `count` arquivos de vários usuários
+    users = [f'user{index}' for index in range(20)]
+    for username in users:
+        main.User.create(username=username, password_hash='-')
+    start = datetime(2020, 1, 1)
+    rows = [{'filename': f'file-{index}.bin', 'uploaded_by': users[index % len(users)],
+             'uploaded_at': start + timedelta(seconds=index)} for index in range(args.count)]
+    with db.atomic():
+        for batch in range(0, len(rows), 500):
+            FileUpload.insert_many(rows[batch:batch + 500]).execute()
+
+    def legacy_list():
+        # Rota original: a tabela inteira, com uma consulta de User por linha
+        return [{'filename': file.filename, 'uploaded_by': file.uploaded_by.username,
+                 'uploaded_at': file.uploaded_at} for file in FileUpload.select()]
+
+    last_page_cursor = catalog.encode_cursor(rows[-101]['uploaded_at'], rows[-101]['filename'])
+    scenarios = [('legacy full list', legacy_list),
+                 ('first page (100)', lambda: catalog.query_files(100)),
+                 ('last page (100)', lambda: catalog.query_files(100, last_page_cursor)),
+                 ('user, first page', lambda: catalog.query_files(100, filters=catalog.FileFilter(users[3]))),
+                 ('prefix, first page', lambda: catalog.query_files(100, filters=catalog.FileFilter(
+                     prefix='file-1999'))),
+                 ('cached first page', lambda: catalog.list_files(100)),
+                 ('cached last page', lambda: catalog.list_files(100, last_page_cursor))]
+
+    print(f'Listing a catalog of {args.count} files, best of {args.runs} runs (workdir {workdir})')
+    for name, func in scenarios:
+        timings = []
+        for run in range(args.runs):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+        print(f'  {name:20s} {1000 * min(timings):10.2f} ms')
+
+
+def bench_auth(args):
+    main, workdir, token = setup_environment()
+    import jwt
+    from fastapi import FastAPI, Depends
+    from starlette.requests import Request
+    import auth
+
+    def legacy_get_current_user(request: Request) -> str:
+        # Dependência original: síncrona (executada no threadpool do Starlette), com jwt.decode a cada requisição
+        jwt_token = request.cookies.get('Authorization').split(' ')[-1]
+        return jwt.decode(jwt_token, key=auth.JWT_SECRET, algorithms=['HS256']).get('username')
+
+    # Rotas vazias, pra que o custo medido seja só o da autenticação (mais o mínimo do framework)
+    def auth_app(dependency):
+        app = FastAPI()
+
+        @app.get('/ping')
+        async def ping(current_user: str = Depends(dependency)):
+            return None
+
+        return app
+
+    async def noop():
+        return 'bench'
+
+    scenarios = [('no auth', auth_app(noop)), ('legacy (sync jwt.decode)', auth_app(legacy_get_current_user)),
+                 ('token cache', auth_app(auth.get_current_user))]
+    headers = {'Cookie': f'Authorization="Bearer {token}"'}
+
+    async def measure(app):
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            assert await asgi_request(app, 'GET', '/ping', headers) == 200
+        return time.perf_counter() - started
+
+    print(f'Authenticated request overhead, {args.requests} sequential requests (workdir {workdir})')
+    baseline = None
+    for name, app in scenarios:
+        per_request = asyncio.run(measure(app)) / args.requests
+        baseline = per_request if baseline is None else baseline
+        print(f'  {name:28s} {1e6 * per_request:8.1f} us/request  (auth {1e6 * (per_request - baseline):7.1f} us)')
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    upload_parser = subparsers.add_parser('upload', help='upload throughput, legacy vs streaming path')
+    upload_parser.add_argument('--size-mb', type=int, default=256)
+    upload_parser.add_argument('--runs', type=int, default=3)
+    upload_parser.set_defaults(func=bench_upload)
+
+    latency_parser = subparsers.add_parser('latency', help='GET /files latency during a large upload')
+    latency_parser.add_argument('--size-mb', type=int, default=256)
+    latency_parser.add_argument('--requests', type=int, default=200, help='requests in the idle scenario')
+    latency_parser.set_defaults(func=bench_latency)
+
+    files_parser = subparsers.add_parser('files', help='GET /files query cost, full list vs keyset pages')
+    files_parser.add_argument('--count', type=int, default=20000)
+    files_parser.add_argument('--runs', type=int, default=5)
+    files_parser.set_defaults(func=bench_files)
+
+    auth_parser = subparsers.add_parser('auth', help='per-request authentication overhead, legacy vs token cache')
+    auth_parser.add_argument('--requests', type=int, default=20000)
+    auth_parser.set_defaults(func=bench_auth)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    cli()
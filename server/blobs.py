@@ -0,0 +1,454 @@
+import hashlib
+import os
+import re
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+from peewee import IntegrityError
+
+import catalog
+import compression
+import storage
+from config import UPLOAD_DIR, RESERVATION_TTL, STORAGE_CODEC
+from database import db, write_transaction, Blob, FileUpload, Reservation
+from events import lock_event_log, record_event
+from models import MAX_FILENAME_LENGTH
+from utils import log, remove_if_exists
+
+# Armazenamento por conteúdo: cada conteúdo distinto é guardado uma única vez, com o nome igual ao seu hash, e
+# as entradas de FileUpload apontam pro blob. Enviar de novo um conteúdo já existente, com qualquer nome, não
+# ocupa espaço extra em disco. Os blobs ficam no backend de armazenamento configurado (ver storage.py), comprimidos
+# se STORAGE_CODEC estiver definido (ver compression.py).
+#
+# As funções daqui fazem I/O bloqueante e devem ser chamadas pelo pool de I/O nas rotas assíncronas.
+
+TMP_DIR = os.path.join(UPLOAD_DIR, '.tmp')
+
+HASH_READ_SIZE = 1024 * 1024
+
+DIGEST_PATTERN = re.compile('^[0-9a-f]{64}$')
+
+if STORAGE_CODEC is not None and STORAGE_CODEC not in compression.available_codecs():
+    raise ValueError(f'Unsupported STORAGE_CODEC: {STORAGE_CODEC}')
+
+
+def new_hasher():
+    return hashlib.sha256()
+
+
+# Caminho de um novo arquivo temporário, onde um upload é recebido enquanto seu hash ainda não é conhecido
+def temp_path() -> str:
+    os.makedirs(TMP_DIR, exist_ok=True)
+    return os.path.join(TMP_DIR, uuid.uuid4().hex)
+
+
+def staged_copy(path: str) -> str:
+    """Cria uma cópia de `path` num novo arquivo temporário (um hard link, sem custo, se possível) e retorna seu
+    caminho; assim o conteúdo pode ser passado ao backend, que move o arquivo, e o original continua onde está."""
+    staged = temp_path()
+    try:
+        os.link(path, staged)
+    except OSError:
+        shutil.copyfile(path, staged)
+    return staged
+
+
+def write_temp_file(data: bytes) -> Tuple[str, str]:
+    """Grava `data` num novo arquivo temporário e retorna seu caminho e o hash do conteúdo, numa única chamada; pra
+    arquivos pequenos, recebidos inteiros de uma vez."""
+    path = temp_path()
+    with open(path, 'wb') as fd:
+        fd.write(data)
+    return path, hashlib.sha256(data).hexdigest()
+
+
+# Arquivos enviados antes do armazenamento por conteúdo ficam em UPLOAD_DIR com o próprio nome, até a migração
+# (ver migrate_storage.py)
+def legacy_path(filename: str) -> str:
+    return os.path.join(UPLOAD_DIR, filename)
+
+
+def open_content(file_upload: catalog.FileRecord) -> storage.StoredFile:
+    """Abre o conteúdo original de um arquivo obtido com `get_file`. Se o blob estiver comprimido, o resultado é um
+    `compression.DecodedFile`, que dá acesso também aos bytes armazenados."""
+    try:
+        if file_upload.blob_id is None:
+            return storage.LocalFile(legacy_path(file_upload.filename))
+        content = storage.backend.open(file_upload.blob_id)
+        if file_upload.codec is not None:
+            return compression.DecodedFile(content, file_upload.codec, file_upload.size)
+        return content
+    except FileNotFoundError:
+        log.error('Content of %s is missing from storage', file_upload.filename)
+        raise HTTPException(404, 'File not found.')
+
+
+def hash_file(path: str) -> str:
+    hasher = new_hasher()
+    with open(path, 'rb') as fd:
+        while True:
+            chunk = fd.read(HASH_READ_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def parse_digest(value: str) -> str:
+    """Valida um hash SHA-256 informado pelo cliente, em hexadecimal; levanta 400 se for inválido."""
+    digest = value.strip().lower()
+    if not DIGEST_PATTERN.match(digest):
+        raise HTTPException(400, 'Invalid SHA-256 digest.')
+    return digest
+
+
+def check_digest(expected: Optional[str], digest: str, filename: str) -> None:
+    """Levanta 400 se o hash informado pelo cliente, se houver, não for o do conteúdo recebido."""
+    if expected is not None and expected != digest:
+        log.warning('Content of %s does not match the digest sent by the client (returned 400)', filename)
+        raise HTTPException(400, 'Content digest mismatch.')
+
+
+def get_file(filename: str) -> catalog.FileRecord:
+    file_upload = catalog.get_file(filename)
+    if file_upload is None:
+        raise HTTPException(404, 'File not found.')
+    return file_upload
+
+
+def is_reserved_by_other(filename: str, user: str) -> bool:
+    return Reservation.select().where((Reservation.filename == filename) & (Reservation.owner != user) &
+                                      (Reservation.expires_at > datetime.now())).count() > 0
+
+
+def validate_filename(filename: str) -> None:
+    """Levanta 400 se o nome não tiver de 1 a MAX_FILENAME_LENGTH caracteres, como nas rotas com corpo em JSON."""
+    if not 1 <= len(filename) <= MAX_FILENAME_LENGTH:
+        raise HTTPException(400, f'File name must have 1 to {MAX_FILENAME_LENGTH} characters.')
+
+
+def check_filename(filename: str, user: str) -> None:
+    """Levanta 409 se já houver um arquivo com esse nome, ou se ele estiver reservado por outro usuário."""
+    if catalog.file_exists(filename):
+        log.info('Tried to upload existing filename %s (returned 409)', filename)
+        raise HTTPException(409, 'Filename already exists.')
+    if is_reserved_by_other(filename, user):
+        log.info('Tried to upload filename %s reserved by another user (returned 409)', filename)
+        raise HTTPException(409, 'Filename is reserved by another upload.')
+
+
+def check_free_space(size: int) -> None:
+    """Levanta 507 se não houver espaço em disco pra receber `size` bytes."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    if size > shutil.disk_usage(UPLOAD_DIR).free:
+        log.info('Rejected upload of %d bytes: not enough disk space (returned 507)', size)
+        raise HTTPException(507, 'Not enough storage space for this upload.')
+
+
+def reserve_filename(filename: str, user: str, size: int = None) -> Reservation:
+    """Reserva `filename` pro usuário por RESERVATION_TTL segundos, ou renova a reserva que ele já tem.
+
+    Serve de pré-verificação: os conflitos são detectados antes do envio de qualquer byte, e nenhum outro
+    usuário consegue criar um arquivo com o mesmo nome enquanto o upload acontece.
+    """
+    if size is not None:
+        check_free_space(size)
+    with write_transaction():
+        check_filename(filename, user)
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=RESERVATION_TTL)
+        # No PostgreSQL, outro usuário pode passar pela verificação acima ao mesmo tempo; a condição do upsert faz
+        # com que só uma reserva do próprio usuário, ou uma já expirada, seja substituída
+        Reservation.insert(filename=filename, owner=user, size=size, expires_at=expires_at).on_conflict(
+            conflict_target=[Reservation.filename],
+            update={Reservation.owner: user, Reservation.size: size, Reservation.expires_at: expires_at},
+            where=(Reservation.owner == user) | (Reservation.expires_at <= now)).execute()
+        reservation = Reservation.get(Reservation.filename == filename)
+    if reservation.owner_id != user:
+        log.info('Tried to upload filename %s reserved by another user (returned 409)', filename)
+        raise HTTPException(409, 'Filename is reserved by another upload.')
+    return reservation
+
+
+@contextmanager
+def catalog_transaction():
+    """Transação de escrita que muda o catálogo. Depois de confirmada, o cache do catálogo deste processo já é
+    atualizado, em vez de esperar pela próxima leitura."""
+    with write_transaction():
+        yield
+    catalog.cache.sync()
+
+
+def _create_file_entry(filename: str, uploaded_by: str, digest: str) -> FileUpload:
+    check_filename(filename, uploaded_by)
+    # A verificação acima dá a resposta certa no caso comum, mas no PostgreSQL duas transações concorrentes podem
+    # passar por ela com o mesmo nome; quem decide é a chave primária, e a segunda recebe o mesmo 409
+    try:
+        with db.atomic():
+            file_upload = FileUpload.create(filename=filename, uploaded_by=uploaded_by, uploaded_at=datetime.now(),
+                                            blob=digest)
+    except IntegrityError:
+        log.info('Concurrent upload of filename %s (returned 409)', filename)
+        raise HTTPException(409, 'Filename already exists.')
+    record_event('added', file_upload)
+    # A reserva, se houver, já cumpriu seu papel
+    Reservation.delete().where(Reservation.filename == filename).execute()
+    return file_upload
+
+
+def _claim_blob(digest: str, size: int, codec: Optional[str] = None) -> bool:
+    """Acrescenta uma referência ao blob `digest`, criando sua entrada se preciso; retorna se ela foi criada.
+
+    Quem consegue inserir a entrada fica responsável por armazenar o conteúdo. A inserção é feita antes do
+    incremento porque, com duas transações concorrentes no PostgreSQL, as duas veriam 0 linhas no UPDATE e
+    tentariam criar o mesmo blob; assim, a segunda espera a primeira na chave primária e passa ao incremento.
+    """
+    while True:
+        try:
+            with db.atomic():
+                Blob.create(digest=digest, size=size, refcount=1, created_at=datetime.now(), codec=codec)
+            return True
+        except IntegrityError:
+            pass
+        if Blob.update(refcount=Blob.refcount + 1).where(Blob.digest == digest).execute() > 0:
+            return False
+        # O blob foi removido entre a inserção e o incremento; tentamos de novo
+
+
+def is_stored(digest: str) -> bool:
+    return Blob.select().where(Blob.digest == digest).exists()
+
+
+def compress_content(data_path: str, digest: str, stored: bool = None) -> Tuple[str, Optional[str]]:
+    """Comprime o conteúdo em `data_path` com STORAGE_CODEC, se estiver definido e compensar, num novo arquivo
+    temporário; retorna o caminho do conteúdo a armazenar e o codec usado, ou `data_path` e None.
+
+    Não comprime conteúdos já armazenados, que não vão ser usados; `stored` diz se é o caso, e, se não for
+    informado, é consultado no banco de dados (quem chama pelo pool de I/O, sem conexão, consulta antes com
+    `is_stored`). É feito antes da transação que cria o arquivo, pra não segurar o lock de escrita do banco
+    durante a compressão.
+    """
+    if STORAGE_CODEC is None:
+        return data_path, None
+    if stored is None:
+        stored = is_stored(digest)
+    if stored:
+        return data_path, None
+    compressed_path = temp_path()
+    if not compression.compress_file(data_path, compressed_path, STORAGE_CODEC):
+        log.info('Content %s does not compress well, storing it uncompressed', digest)
+        return data_path, None
+    return compressed_path, STORAGE_CODEC
+
+
+@contextmanager
+def prepared_content(data_path: str, digest: str) -> Iterator[Tuple[str, Optional[str]]]:
+    """Dá o caminho e o codec do conteúdo a armazenar (ver `compress_content`), pra serem passados a `create_file`.
+
+    Se o bloco terminar com erro, a versão comprimida é descartada e `data_path` continua onde está; se terminar
+    bem, `data_path` é removido.
+    """
+    stored_path, codec = compress_content(data_path, digest)
+    try:
+        yield stored_path, codec
+    except BaseException:
+        if stored_path != data_path:
+            remove_if_exists(stored_path)
+        raise
+    if stored_path != data_path:
+        remove_if_exists(data_path)
+
+
+def store_file(filename: str, uploaded_by: str, data_path: str, digest: str, size: int) -> FileUpload:
+    """`create_file` com o conteúdo comprimido antes, se for o caso (ver `prepared_content`)."""
+    with prepared_content(data_path, digest) as (stored_path, codec):
+        return create_file(filename, uploaded_by, stored_path, digest, size, codec)
+
+
+class _ContentRemoved(Exception):
+    """O conteúdo colocado no backend antes da transação foi removido por uma remoção concorrente do mesmo blob."""
+
+
+def _stage_content(digest: str, data_path: str) -> bool:
+    """Coloca no backend, com a chave `digest`, uma cópia do conteúdo em `data_path`, se ainda não houver um blob com
+    esse hash; retorna se colocou. É feito antes da transação que cria o arquivo, pra não segurar o lock de escrita
+    do banco durante o envio pro backend."""
+    if is_stored(digest):
+        return False
+    staged = staged_copy(data_path)
+    try:
+        storage.backend.put(digest, staged)
+    finally:
+        remove_if_exists(staged)
+    return True
+
+
+def _check_stored(digest: str) -> None:
+    """Levanta `_ContentRemoved` se o conteúdo de um blob criado na transação atual não estiver no backend.
+
+    Deve ser chamada depois de `record_event`: com o lock dos eventos, uma remoção concorrente (ver
+    `_discard_content`) ou já terminou, e é detectada aqui, ou só vai acontecer depois desta transação, e então vê o
+    blob e não remove nada.
+    """
+    if not storage.backend.exists(digest):
+        log.info('Content %s was removed concurrently, storing it again', digest)
+        raise _ContentRemoved(digest)
+
+
+def _discard_content(digest: str) -> None:
+    """Remove do backend o conteúdo `digest`, se não houver um blob com esse hash; chamada depois de confirmada a
+    transação que removeu o blob, ou depois de desfeita a que o criaria."""
+    with write_transaction():
+        lock_event_log()
+        if not Blob.select().where(Blob.digest == digest).exists():
+            storage.backend.delete(digest)
+
+
+def create_file(filename: str, uploaded_by: str, data_path: str, digest: str, size: int,
+                codec: Optional[str] = None, in_transaction: Callable[[], None] = None) -> FileUpload:
+    """Cria a entrada de um arquivo cujo conteúdo, com hash `digest` e `size` bytes, está em `data_path`,
+    comprimido com `codec`, se houver. `in_transaction`, se informada, é chamada na mesma transação (ex.: pra
+    remover a sessão de upload de onde o arquivo veio).
+
+    Se o conteúdo ainda não estiver armazenado, ele é colocado no backend antes da transação, que só cria ou
+    incrementa a entrada do blob; se a transação for desfeita, o conteúdo colocado é removido, a menos que outro
+    arquivo tenha passado a usá-lo. Se tudo der certo, `data_path` é removido; se algo falhar, nada é confirmado e
+    `data_path` continua onde está.
+    """
+    while True:
+        staged = _stage_content(digest, data_path)
+        try:
+            with catalog_transaction():
+                created = _claim_blob(digest, size, codec)
+                file_upload = _create_file_entry(filename, uploaded_by, digest)
+                if in_transaction is not None:
+                    in_transaction()
+                if created:
+                    _check_stored(digest)
+        except _ContentRemoved:
+            continue
+        except BaseException:
+            if staged:
+                _discard_content(digest)
+            raise
+        break
+
+    if not created:
+        log.info('Content of %s already stored as %s', filename, digest)
+    os.remove(data_path)
+    return file_upload
+
+
+def create_files(uploaded_by: str, uploads: List[Tuple[str, str, str, int]]) -> List[dict]:
+    """Cria numa única transação as entradas de vários arquivos recebidos juntos; cada item de `uploads` é
+    `(nome, caminho, hash, tamanho)`, como os argumentos de `create_file`.
+
+    Um arquivo rejeitado (ex.: nome já existente) não impede a criação dos outros: retorna o resultado de cada
+    um, com o status que ele teria num upload individual. Como em `create_file`, os conteúdos novos são colocados
+    no backend antes da transação, e os que não passaram a ser usados, removidos depois dela. Os arquivos
+    temporários são sempre removidos; se algo inesperado falhar, nenhum arquivo é criado.
+    """
+    prepared = []
+    try:
+        for filename, data_path, digest, size in uploads:
+            prepared.append((filename, data_path, digest, size) + compress_content(data_path, digest))
+
+        while True:
+            staged = set()
+            created_blobs = set()
+            try:
+                for _, _, digest, _, stored_path, _ in prepared:
+                    if digest not in staged and _stage_content(digest, stored_path):
+                        staged.add(digest)
+                results = []
+                with catalog_transaction():
+                    for filename, data_path, digest, size, stored_path, codec in prepared:
+                        try:
+                            # Cada arquivo num savepoint, pra que um conflito desfaça só o que foi feito por ele
+                            with db.atomic():
+                                created = _claim_blob(digest, size, codec)
+                                _create_file_entry(filename, uploaded_by, digest)
+                        except HTTPException as error:
+                            results.append({'filename': filename, 'status': error.status_code,
+                                            'detail': error.detail})
+                            continue
+                        results.append({'filename': filename, 'status': 200})
+                        if created:
+                            created_blobs.add(digest)
+                    for digest in created_blobs:
+                        _check_stored(digest)
+            except BaseException as error:
+                # Nada foi confirmado; os conteúdos colocados são removidos, e colocados de novo se for repetir
+                created_blobs.clear()
+                if isinstance(error, _ContentRemoved):
+                    continue
+                raise
+            finally:
+                for digest in staged - created_blobs:
+                    _discard_content(digest)
+            break
+    finally:
+        for _, data_path, _, _ in uploads:
+            remove_if_exists(data_path)
+        for _, data_path, _, _, stored_path, _ in prepared:
+            if stored_path != data_path:
+                remove_if_exists(stored_path)
+    return results
+
+
+def link_file(filename: str, uploaded_by: str, digest: str) -> FileUpload:
+    """Cria a entrada de um arquivo a partir de um conteúdo já armazenado, sem receber seus bytes."""
+    with catalog_transaction():
+        if Blob.update(refcount=Blob.refcount + 1).where(Blob.digest == digest).execute() == 0:
+            raise HTTPException(404, 'Content not found.')
+        return _create_file_entry(filename, uploaded_by, digest)
+
+
+def delete_file(filename: str, current_user: str) -> None:
+    """Remove a entrada de um arquivo; o blob só é apagado quando nenhum outro arquivo o referencia.
+
+    O conteúdo só sai do armazenamento depois de confirmada a transação: se ela for desfeita, o arquivo continua
+    com seu conteúdo.
+    """
+    with catalog_transaction():
+        file_upload = FileUpload.get_or_none(FileUpload.filename == filename)
+        if file_upload is None:
+            raise HTTPException(404, 'File not found.')
+        if file_upload.uploaded_by_id != current_user:
+            raise HTTPException(403, 'Only the user who uploaded a file can delete it.')
+        file_upload.delete_instance()
+        record_event('deleted', file_upload)
+
+        unreferenced = False
+        if file_upload.blob_id is not None:
+            Blob.update(refcount=Blob.refcount - 1).where(Blob.digest == file_upload.blob_id).execute()
+            unreferenced = Blob.delete().where((Blob.digest == file_upload.blob_id) &
+                                               (Blob.refcount <= 0)).execute() > 0
+
+    if file_upload.blob_id is None:
+        remove_if_exists(legacy_path(file_upload.filename))
+    elif unreferenced:
+        log.info('Deleted unreferenced content %s', file_upload.blob_id)
+        _discard_content(file_upload.blob_id)
+
+
+def sweep_temp_files(max_age: float) -> int:
+    """Remove os arquivos temporários sem modificação há mais de `max_age` segundos, deixados por uploads
+    interrompidos sem chance de limpeza (ex.: processo morto); retorna quantos foram removidos."""
+    if not os.path.isdir(TMP_DIR):
+        return 0
+    removed = 0
+    limit = time.time() - max_age
+    for entry in os.scandir(TMP_DIR):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < limit:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
@@ -0,0 +1,277 @@
+import base64
+import bisect
+import json
+import threading
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from fastapi import HTTPException
+from peewee import JOIN, Tuple
+
+from config import CATALOG_CACHE_MAX_FILES
+from database import db, Blob, CatalogEvent, FileUpload
+from events import notifier, last_seq
+from utils import log
+
+# Listagem dos arquivos enviados, paginada por cursor (keyset): cada página continua a partir do último arquivo
+# da anterior, na ordem (uploaded_at, filename), usando o índice dessas colunas. Assim o custo de uma página não
+# depende de quantas páginas vieram antes nem do tamanho do catálogo, ao contrário de OFFSET.
+#
+# As funções daqui fazem I/O bloqueante e devem ser chamadas pelo pool de I/O nas rotas assíncronas.
+
+# A versão do catálogo é o número do último evento do feed de mudanças (ver events.py), gravado na mesma transação
+# de cada mudança. Enquanto ela não muda, as respostas de GET /files também não, então o ETag derivado dela
+# permite responder 304 com uma única consulta pela chave primária, sem listar os arquivos. Por vir do banco de
+# dados, ela vale igualmente em todos os processos do servidor.
+def version_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def catalog_changed() -> None:
+    """Registra uma mudança no catálogo; chamada pelas rotas depois que a transação da mudança é confirmada."""
+    notifier.notify()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    # If-None-Match usa comparação fraca, então ignoramos o prefixo W/
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    return '*' in candidates or etag in [candidate[2:] if candidate.startswith('W/') else candidate
+                                         for candidate in candidates]
+
+
+def encode_cursor(uploaded_at: datetime, filename: str) -> str:
+    data = json.dumps([uploaded_at.isoformat(), filename]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        uploaded_at, filename = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(uploaded_at), filename
+    except (ValueError, TypeError):
+        raise HTTPException(400, 'Invalid cursor.')
+
+
+class FileRecord(NamedTuple):
+    """Dados de um arquivo do catálogo, com os do seu blob (nulos nos arquivos anteriores ao armazenamento por
+    conteúdo). Uma tupla ocupa bem menos memória que uma instância de modelo do peewee."""
+    filename: str
+    uploaded_by: str
+    uploaded_at: datetime
+    blob_id: Optional[str]
+    size: Optional[int]
+    codec: Optional[str]
+
+
+def file_info(record: FileRecord) -> dict:
+    return {
+        'filename': record.filename,
+        'uploaded_by': record.uploaded_by,
+        'uploaded_at': record.uploaded_at
+    }
+
+
+def _select_records():
+    # O nome do usuário é a chave primária de User, então a coluna uploaded_by já o contém e não é preciso
+    # consultar nem juntar a tabela de usuários
+    return (FileUpload
+            .select(FileUpload.filename, FileUpload.uploaded_by, FileUpload.uploaded_at, FileUpload.blob, Blob.size,
+                    Blob.codec)
+            .join(Blob, JOIN.LEFT_OUTER))
+
+
+def _page(records: list, limit: int) -> dict:
+    next_cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_cursor = encode_cursor(records[-1].uploaded_at, records[-1].filename)
+    return {'files': [file_info(record) for record in records], 'next_cursor': next_cursor}
+
+
+class CatalogCache:
+    """Cópia em memória do catálogo de arquivos, da qual saem as páginas de /files, as verificações de existência
+    de nomes e as buscas dos downloads, sem consultar o banco de dados.
+
+    O cache reflete uma versão do catálogo (ver `version_etag`). Cada leitura começa por `sync`, que compara essa versão
+    com a do banco de dados, uma consulta pela chave primária, e aplica os eventos de mudança que faltarem. Assim as
+    mudanças feitas por qualquer processo do servidor aparecem em todos, e um processo só recarrega o catálogo inteiro
+    ao iniciar, se ficar muito para trás ou se o banco de dados for recriado; uma versão mais antiga que a do cache,
+    lida antes de outra requisição atualizá-lo, não o faz voltar. Os arquivos ficam como `FileRecord`, mais uma lista
+    ordenada por (uploaded_at, filename) pra paginação; se o catálogo passar de `max_files` arquivos, o cache é
+    esvaziado e as leituras voltam a ser feitas no banco de dados. Pode ser usado de várias threads.
+    """
+
+    # Com mais eventos que isso pra aplicar, é mais rápido recarregar o catálogo inteiro
+    MAX_EVENTS = 1000
+
+    def __init__(self, max_files: int):
+        self.max_files = max_files
+        self.version: Optional[int] = None
+        self._files = {}  # filename -> FileRecord
+        self._order = []  # (uploaded_at, filename), em ordem
+        self._usable = False
+        self._lock = threading.Lock()
+
+    def sync(self, version: Optional[int] = None) -> bool:
+        """Atualiza o cache até `version` (por padrão, a versão atual do banco de dados) e retorna se ele pode ser
+        usado. Dentro de uma transação, ele não é usado, já que ela vê mudanças que ainda podem ser desfeitas.
+        Faz I/O bloqueante."""
+        if db.in_transaction():
+            return False
+        if version is None:
+            version = last_seq()
+        with self._lock:
+            if self.version is not None and version < self.version and last_seq() >= self.version:
+                # A versão foi lida antes de outra requisição atualizar o cache (ex.: pelo `catalog_transaction`
+                # de um upload); o cache já inclui tudo até ela, então é usado como está, sem voltar a versão.
+                # Só se o banco de dados também estiver atrás do cache (ex.: foi recriado) ele é recarregado
+                return self._usable
+            if version != self.version:
+                # Os eventos são aplicados depois de lida a versão, então o cache pode já incluir mudanças
+                # posteriores a ela; como aplicar um evento de novo não muda o resultado, a próxima atualização
+                # corrige qualquer diferença
+                if not (self._usable and self.version is not None and self.version < version and
+                        self._apply_events(version)):
+                    self._load()
+                self.version = version
+            return self._usable
+
+    def _load(self) -> None:
+        self._files = {}
+        self._order = []
+        self._usable = FileUpload.select().count() <= self.max_files
+        if not self._usable:
+            log.info('Catalog has more than %d files, not caching it', self.max_files)
+            return
+        for record in map(FileRecord._make, _select_records().tuples().iterator()):
+            self._files[record.filename] = record
+            self._order.append((record.uploaded_at, record.filename))
+        self._order.sort()
+
+    def _apply_events(self, version: int) -> bool:
+        events = list(CatalogEvent
+                      .select(CatalogEvent.kind, CatalogEvent.filename)
+                      .where((CatalogEvent.seq > self.version) & (CatalogEvent.seq <= version))
+                      .order_by(CatalogEvent.seq)
+                      .limit(self.MAX_EVENTS + 1)
+                      .tuples())
+        if len(events) > self.MAX_EVENTS:
+            return False
+        added = {filename for kind, filename in events if kind == 'added'}
+        current = {}
+        if added:
+            current = {record.filename: record for record in map(
+                FileRecord._make, _select_records().where(FileUpload.filename.in_(list(added))).tuples())}
+
+        for kind, filename in events:
+            self._remove(filename)
+            # Um arquivo criado e removido depois da versão lida já não existe; o evento da remoção vem depois
+            if kind == 'added' and filename in current:
+                self._add(current[filename])
+        if len(self._files) > self.max_files:
+            return False
+        return True
+
+    def _add(self, record: FileRecord) -> None:
+        self._files[record.filename] = record
+        bisect.insort(self._order, (record.uploaded_at, record.filename))
+
+    def _remove(self, filename: str) -> None:
+        record = self._files.pop(filename, None)
+        if record is not None:
+            index = bisect.bisect_left(self._order, (record.uploaded_at, filename))
+            del self._order[index]
+
+    def get(self, filename: str) -> Optional[FileRecord]:
+        with self._lock:
+            return self._files.get(filename)
+
+    def page(self, limit: int, cursor: Optional[str] = None) -> dict:
+        key = None if cursor is None else decode_cursor(cursor)
+        with self._lock:
+            start = 0 if key is None else bisect.bisect_right(self._order, key)
+            records = [self._files[filename] for _, filename in self._order[start:start + limit + 1]]
+        return _page(records, limit)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.version = None
+            self._files = {}
+            self._order = []
+            self._usable = False
+
+
+cache = CatalogCache(CATALOG_CACHE_MAX_FILES)
+
+
+class FileFilter(NamedTuple):
+    """Filtros da listagem: arquivos de um usuário, com nomes começando por `prefix`, e enviados a partir de
+    `uploaded_after` e antes de `uploaded_before`. Cada um usa um índice (ver FileUpload), então o custo de uma
+    página depende de quantos arquivos atendem aos filtros, e não do tamanho do catálogo."""
+    uploaded_by: Optional[str] = None
+    prefix: Optional[str] = None
+    uploaded_after: Optional[datetime] = None
+    uploaded_before: Optional[datetime] = None
+
+
+def _local_time(value: datetime) -> datetime:
+    # As datas de envio são gravadas no horário local, sem fuso
+    return value.astimezone().replace(tzinfo=None) if value.tzinfo is not None else value
+
+
+def _prefix_end(prefix: str) -> Optional[str]:
+    """Menor texto maior que todos os que começam com `prefix`, na ordem binária dos caracteres."""
+    prefix = prefix.rstrip(chr(0x10ffff))
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+
+
+def query_files(limit: int, cursor: Optional[str] = None, filters: FileFilter = FileFilter()) -> dict:
+    """Como `list_files`, mas sempre consultando o banco de dados."""
+    query = (_select_records()
+             .order_by(FileUpload.uploaded_at, FileUpload.filename)
+             .limit(limit + 1))
+    if cursor is not None:
+        # Com a comparação de tuplas, a consulta começa direto na posição do cursor no índice
+        query = query.where(Tuple(FileUpload.uploaded_at, FileUpload.filename) > Tuple(*decode_cursor(cursor)))
+    if filters.uploaded_by is not None:
+        query = query.where(FileUpload.uploaded_by == filters.uploaded_by)
+    if filters.prefix:
+        # Um intervalo, e não LIKE, pra usar o índice da chave primária
+        query = query.where(FileUpload.filename >= filters.prefix)
+        end = _prefix_end(filters.prefix)
+        if end is not None:
+            query = query.where(FileUpload.filename < end)
+    if filters.uploaded_after is not None:
+        query = query.where(FileUpload.uploaded_at >= _local_time(filters.uploaded_after))
+    if filters.uploaded_before is not None:
+        query = query.where(FileUpload.uploaded_at < _local_time(filters.uploaded_before))
+    return _page(list(map(FileRecord._make, query.tuples())), limit)
+
+
+def list_files(limit: int, cursor: Optional[str] = None, version: Optional[int] = None,
+               filters: FileFilter = FileFilter()) -> dict:
+    """Retorna até `limit` arquivos a partir de `cursor` que atendam a `filters`, e o cursor da próxima página (None
+    na última). `version` é a versão do catálogo, se já tiver sido lida."""
+    # As buscas são feitas no banco de dados, pelos índices; o cache só tem a ordem da listagem completa
+    if filters == FileFilter() and cache.sync(version):
+        return cache.page(limit, cursor)
+    return query_files(limit, cursor, filters)
+
+
+def file_exists(filename: str) -> bool:
+    if cache.sync():
+        return cache.get(filename) is not None
+    return FileUpload.select().where(FileUpload.filename == filename).count() > 0
+
+
+def get_file(filename: str) -> Optional[FileRecord]:
+    """Dados do arquivo `filename`, ou None se ele não existir."""
+    record = cache.get(filename) if cache.sync() else None
+    # Arquivos anteriores ao armazenamento por conteúdo mudam de lugar ao ser migrados (ver migrate_storage.py),
+    # então eles, e os nomes que o cache não conhece, são sempre buscados no banco de dados
+    if record is None or record.blob_id is None:
+        row = _select_records().where(FileUpload.filename == filename).tuples().first()
+        record = FileRecord._make(row) if row is not None else None
+    return record
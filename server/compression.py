@@ -0,0 +1,299 @@
+import collections
+import os
+import zlib
+from typing import Iterator, Optional
+
+from fastapi import HTTPException
+
+from config import COMPRESSION_SAMPLE_SIZE, COMPRESSION_MAX_RATIO
+from storage import StoredFile
+from utils import remove_if_exists
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressão, em dois lugares:
+#
+# - na transferência: corpos de requisição com `Content-Encoding: gzip` ou `zstd` são descomprimidos durante o
+#   streaming, antes do hash e da escrita em disco, então o servidor só vê o conteúdo original;
+# - no armazenamento, se STORAGE_CODEC estiver definido: cada blob novo é comprimido antes de ser armazenado, a
+#   não ser que uma amostra do início mostre que não compensa (ex.: arquivos já comprimidos). O codec fica
+#   registrado no blob, e os downloads o descomprimem, ou o enviam comprimido, se o cliente aceitar.
+#
+# O zstd requer o pacote `zstandard`; sem ele, só o gzip está disponível.
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# Máximo de bytes gerados por vez ao descomprimir, pra que um bloco pequeno muito comprimido não ocupe memória demais
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+READ_SIZE = 1024 * 1024
+
+
+def available_codecs() -> tuple:
+    return (GZIP, ZSTD) if zstandard is not None else (GZIP,)
+
+
+class DecodeError(ValueError):
+    pass
+
+
+class Decoder:
+    """Descompressão incremental; `decompress` levanta DecodeError se os dados forem inválidos."""
+
+    def decompress(self, data: bytes) -> Iterator[bytes]:
+        raise NotImplementedError
+
+    @property
+    def eof(self) -> bool:
+        raise NotImplementedError
+
+
+class GzipDecoder(Decoder):
+    def __init__(self):
+        self._obj = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+    def decompress(self, data: bytes) -> Iterator[bytes]:
+        try:
+            while True:
+                output = self._obj.decompress(data, DECODE_CHUNK_SIZE)
+                if output:
+                    yield output
+                if self._obj.eof:
+                    # Um arquivo gzip pode ter vários membros concatenados (ex.: gerado pelo pigz)
+                    data = self._obj.unused_data
+                    if not data:
+                        return
+                    self._obj = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                else:
+                    data = self._obj.unconsumed_tail
+                    # Com a saída no limite, o zlib ainda pode ter dados pendentes mesmo sem entrada sobrando
+                    if not data and len(output) < DECODE_CHUNK_SIZE:
+                        return
+        except zlib.error as error:
+            raise DecodeError(str(error))
+
+    @property
+    def eof(self) -> bool:
+        return self._obj.eof
+
+
+class _NeedInput(Exception):
+    pass
+
+
+class _PendingInput:
+    """Fonte do `stream_reader` do zstandard com os dados recebidos e ainda não lidos; sem dados, levanta
+    _NeedInput, que interrompe a leitura até o próximo bloco chegar."""
+
+    def __init__(self):
+        self.chunks = collections.deque()
+
+    def read(self, size: int) -> bytes:
+        if not self.chunks:
+            raise _NeedInput()
+        chunk = self.chunks.popleft()
+        if len(chunk) > size:
+            self.chunks.appendleft(chunk[size:])
+            chunk = chunk[:size]
+        return chunk
+
+
+class _ZstdFrameScanner:
+    """Acompanha a estrutura de um frame zstd (cabeçalho, blocos e checksum) nos dados recebidos, pra saber onde
+    ele termina: o `stream_reader` do zstandard não indica isso, e aceita em silêncio um frame truncado."""
+
+    def __init__(self):
+        self._data = bytearray()
+        self._skip = 0
+        self._stage = 'header'
+        self._checksum = False
+
+    @property
+    def done(self) -> bool:
+        return self._stage == 'done' and not self._skip
+
+    def feed(self, data: bytes) -> None:
+        if self.done and data:
+            raise DecodeError('Data after the end of the zstd frame')
+        self._data += data
+        while True:
+            if self._skip:
+                skipped = min(self._skip, len(self._data))
+                del self._data[:skipped]
+                self._skip -= skipped
+                if self._skip:
+                    return
+            if self._stage == 'header':
+                if len(self._data) < 5:
+                    return
+                try:
+                    size = zstandard.frame_header_size(bytes(self._data[:18]))
+                    if len(self._data) < size:
+                        return
+                    self._checksum = zstandard.get_frame_parameters(bytes(self._data[:size])).has_checksum
+                except zstandard.ZstdError as error:
+                    raise DecodeError(str(error))
+                self._skip, self._stage = size, 'block'
+            elif self._stage == 'block':
+                if len(self._data) < 3:
+                    return
+                # Cabeçalho de bloco: último bloco (1 bit), tipo (2 bits) e tamanho (21 bits); um bloco RLE tem 1 byte
+                header = int.from_bytes(self._data[:3], 'little')
+                self._skip = 3 + (1 if (header >> 1) & 3 == 1 else header >> 3)
+                if header & 1:
+                    self._stage = 'checksum'
+            elif self._stage == 'checksum':
+                self._skip, self._stage = 4 if self._checksum else 0, 'done'
+            else:
+                if self._data:
+                    raise DecodeError('Data after the end of the zstd frame')
+                return
+
+
+class ZstdDecoder(Decoder):
+    def __init__(self):
+        # O decompressobj do zstandard não limita a saída, então lemos do stream_reader: o `read1` só pede mais
+        # dados à fonte quando ainda não gerou nada, então interrompê-lo com _NeedInput não perde saída
+        self._input = _PendingInput()
+        self._reader = zstandard.ZstdDecompressor().stream_reader(self._input)
+        self._frame = _ZstdFrameScanner()
+
+    def decompress(self, data: bytes) -> Iterator[bytes]:
+        self._frame.feed(data)
+        if data:
+            self._input.chunks.append(bytes(data))
+        try:
+            while True:
+                output = self._reader.read1(DECODE_CHUNK_SIZE)
+                if not output:
+                    return
+                yield output
+        except _NeedInput:
+            return
+        except zstandard.ZstdError as error:
+            raise DecodeError(str(error))
+
+    @property
+    def eof(self) -> bool:
+        return self._frame.done
+
+
+def new_decoder(codec: str) -> Decoder:
+    if codec == GZIP:
+        return GzipDecoder()
+    if codec == ZSTD and zstandard is not None:
+        return ZstdDecoder()
+    raise ValueError(f'Unsupported codec: {codec}')
+
+
+def request_decoder(content_encoding: Optional[str]) -> Optional[Decoder]:
+    """Decodificador pro corpo de uma requisição com o `Content-Encoding` dado, ou None se não for comprimido."""
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return None
+    if encoding == 'x-gzip':
+        encoding = GZIP
+    if encoding not in available_codecs():
+        raise HTTPException(415, f'Unsupported Content-Encoding: {encoding}.',
+                            headers={'Accept-Encoding': ', '.join(available_codecs())})
+    return new_decoder(encoding)
+
+
+def _new_compressor(codec: str):
+    if codec == GZIP:
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    if codec == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError(f'Unsupported codec: {codec}')
+
+
+def _worth_compressing(sample: bytes, codec: str) -> bool:
+    compressor = _new_compressor(codec)
+    compressed = len(compressor.compress(sample)) + len(compressor.flush())
+    return compressed <= len(sample) * COMPRESSION_MAX_RATIO
+
+
+def compress_file(source_path: str, target_path: str, codec: str) -> bool:
+    """Grava em `target_path` o conteúdo de `source_path` comprimido com `codec`.
+
+    Retorna False, sem deixar `target_path`, se a compressão não compensar: se a amostra do início do arquivo, ou
+    o arquivo inteiro, não ficar menor que COMPRESSION_MAX_RATIO do tamanho original. A amostra evita gastar
+    tempo comprimindo arquivos inteiros que já vêm comprimidos.
+    """
+    with open(source_path, 'rb') as source:
+        if not _worth_compressing(source.read(COMPRESSION_SAMPLE_SIZE), codec):
+            return False
+        source.seek(0)
+
+        compressor = _new_compressor(codec)
+        try:
+            with open(target_path, 'wb') as target:
+                while True:
+                    chunk = source.read(READ_SIZE)
+                    if not chunk:
+                        break
+                    target.write(compressor.compress(chunk))
+                target.write(compressor.flush())
+            if os.path.getsize(target_path) > os.path.getsize(source_path) * COMPRESSION_MAX_RATIO:
+                remove_if_exists(target_path)
+                return False
+        except BaseException:
+            remove_if_exists(target_path)
+            raise
+    return True
+
+
+class DecodedFile(StoredFile):
+    """Leitura do conteúdo original de um blob comprimido, com `size` bytes.
+
+    Leituras sequenciais (como num download) custam só a descompressão dos dados lidos. Ler a partir de um offset
+    exige descomprimir tudo até ele, e voltar pra trás recomeça do início.
+    """
+
+    def __init__(self, raw: StoredFile, codec: str, size: int):
+        super().__init__(size, raw.mtime)
+        self.raw = raw
+        self.codec = codec
+        self._reset()
+
+    def _reset(self) -> None:
+        self._decoder = new_decoder(self.codec)
+        self._raw_offset = 0
+        # Dados descomprimidos ainda não lidos, começando na posição `_position` do conteúdo original
+        self._buffer = bytearray()
+        self._position = 0
+
+    def _fill(self) -> bool:
+        raw = self.raw.read(self._raw_offset, READ_SIZE)
+        if not raw:
+            return False
+        self._raw_offset += len(raw)
+        for output in self._decoder.decompress(raw):
+            self._buffer += output
+        return True
+
+    def read(self, offset: int, size: int) -> bytes:
+        if offset < self._position:
+            self._reset()
+        while self._position + len(self._buffer) < offset + size:
+            if self._position + len(self._buffer) <= offset:
+                # Ainda antes do offset pedido: descartamos o que foi descomprimido
+                self._position += len(self._buffer)
+                self._buffer.clear()
+            if not self._fill():
+                break
+        start = offset - self._position
+        data = bytes(self._buffer[start:start + size])
+        del self._buffer[:start + len(data)]
+        self._position += start + len(data)
+        return data
+
+    def close(self) -> None:
+        self.raw.close()
+
@@ -1,20 +1,62 @@
 import os
 
 import peewee
+from playhouse.db_url import parse
+from playhouse.migrate import SchemaMigrator, migrate
+from playhouse.pool import PooledPostgresqlDatabase, PooledSqliteDatabase
 
+from config import SERVER_DIR, DATABASE_URL, DB_MAX_CONNECTIONS, DB_POOL_TIMEOUT
 from utils import log
 
-db = peewee.SqliteDatabase(os.path.join(os.getcwd(), 'uploads.db'))
+# Configuração das conexões SQLite. Com WAL, leituras (como /files) não esperam escritas em andamento nem as
+# bloqueiam, e com synchronous=normal só os checkpoints fazem fsync; um commit ainda sobrevive a uma queda do
+# processo, só não necessariamente a uma queda de energia.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -32 * 1024,  # 32 MiB por conexão
+    'temp_store': 'memory',
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+# As conexões ficam num pool: cada unidade de trabalho com o banco de dados (ver threadpool.run_db) pega uma
+# conexão e a devolve no fim, em vez de cada thread manter a sua aberta pra sempre
+POOL_OPTIONS = {'max_connections': DB_MAX_CONNECTIONS, 'timeout': DB_POOL_TIMEOUT, 'stale_timeout': 300}
+
+
+def create_database(url: str = None) -> peewee.Database:
+    if url is not None and url.startswith(('postgres://', 'postgresql://')):
+        params = parse(url)
+        return PooledPostgresqlDatabase(params.pop('database'), **params, **POOL_OPTIONS)
+    path = parse(url)['database'] if url is not None else os.path.join(SERVER_DIR, 'uploads.db')
+    # Uma conexão do pool pode ser usada por threads diferentes, mas só uma de cada vez
+    return PooledSqliteDatabase(path, pragmas=SQLITE_PRAGMAS, check_same_thread=False, **POOL_OPTIONS)
+
 
 # Se estivermos executando um teste, usamos um arquivo novo de banco de dados
 if 'TEST_DB' in os.environ:
     log.info('Using test database.')
 
-    # Limpar banco de dados de testes, se existir
-    if os.path.exists(os.path.join(os.getcwd(), 'test_uploads.db')):
-        os.remove(os.path.join(os.getcwd(), 'test_uploads.db'))
+    # Limpar banco de dados de testes, se existir, junto com os arquivos do WAL
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(os.path.join(os.getcwd(), 'test_uploads.db' + suffix)):
+            os.remove(os.path.join(os.getcwd(), 'test_uploads.db' + suffix))
+
+    db = create_database('sqlite:///test_uploads.db')
+else:
+    db = create_database(DATABASE_URL)
+
 
-    db = peewee.SqliteDatabase('test_uploads.db')
+def write_transaction():
+    """Transação que vai escrever no banco de dados.
+
+    No SQLite, o lock de escrita é pego já no início (BEGIN IMMEDIATE), esperando o busy timeout se outra escrita
+    estiver em andamento. Uma transação comum só o pede na primeira escrita, e se outra transação tiver escrito
+    depois da sua primeira leitura, falha na hora com "database is locked".
+    """
+    if isinstance(db, peewee.SqliteDatabase):
+        return db.atomic(lock_type='IMMEDIATE')
+    return db.atomic()
 
 
 class User(peewee.Model):
@@ -25,13 +67,137 @@ class User(peewee.Model):
         database = db
 
 
+# Conteúdo armazenado, identificado pelo seu hash SHA-256. Arquivos com o mesmo conteúdo compartilham o mesmo
+# blob, e `refcount` conta quantos arquivos o referenciam.
+class Blob(peewee.Model):
+    digest = peewee.CharField(primary_key=True)
+    size = peewee.BigIntegerField()
+    refcount = peewee.IntegerField(default=0)
+    created_at = peewee.DateTimeField()
+    # Compressão do conteúdo armazenado (ver compression.py), ou None se armazenado como chegou; `size` é
+    # sempre o tamanho original
+    codec = peewee.CharField(null=True)
+
+    class Meta:
+        database = db
+
+
 class FileUpload(peewee.Model):
     filename = peewee.CharField(primary_key=True)
     uploaded_by = peewee.ForeignKeyField(User, backref='uploads')
     uploaded_at = peewee.DateTimeField()
 
+    # Nulo para arquivos enviados antes do armazenamento por conteúdo, guardados na pasta de uploads com o
+    # nome original
+    blob = peewee.ForeignKeyField(Blob, null=True, backref='files')
+
+    class Meta:
+        database = db
+        # Índices da paginação de /files, que percorre os arquivos na ordem (uploaded_at, filename), com ou sem
+        # o filtro por usuário. A busca por prefixo do nome usa o índice da chave primária.
+        indexes = (
+            (('uploaded_at', 'filename'), False),
+            (('uploaded_by', 'uploaded_at', 'filename'), False),
+        )
+
+
+# Upload em andamento, que pode ser retomado. Os bytes já recebidos ficam num arquivo parcial, e `offset` é
+# a quantidade deles que já foi confirmada (gravada em disco). Se `part_size` estiver definido, o upload é
+# feito em partes numeradas, que podem ser enviadas em paralelo e fora de ordem.
+class UploadSession(peewee.Model):
+    id = peewee.CharField(primary_key=True)
+    filename = peewee.CharField()
+    owner = peewee.ForeignKeyField(User, backref='upload_sessions')
+    size = peewee.BigIntegerField(null=True)
+    offset = peewee.BigIntegerField(default=0)
+    created_at = peewee.DateTimeField()
+    part_size = peewee.BigIntegerField(null=True)
+    # Hash SHA-256 informado pelo cliente, conferido na finalização
+    sha256 = peewee.CharField(null=True)
+
+    class Meta:
+        database = db
+
+
+# Parte já confirmada de um upload em partes
+class UploadPart(peewee.Model):
+    session = peewee.ForeignKeyField(UploadSession, backref='parts', on_delete='CASCADE')
+    number = peewee.IntegerField()
+    size = peewee.BigIntegerField()
+
+    class Meta:
+        database = db
+        primary_key = peewee.CompositeKey('session', 'number')
+
+
+# Envio em andamento numa sessão de upload, em qualquer processo do servidor. Impede que dois envios simultâneos
+# escrevam na mesma região do arquivo parcial, e que a sessão seja finalizada durante um envio. `number` é o número
+# da parte, ou -1 num upload sequencial. O envio renova `expires_at` periodicamente; se o processo morrer no meio
+# dele, o lock expira sozinho.
+class UploadLock(peewee.Model):
+    session = peewee.ForeignKeyField(UploadSession, backref='locks', on_delete='CASCADE')
+    number = peewee.IntegerField()
+    expires_at = peewee.DateTimeField()
+
+    class Meta:
+        database = db
+        primary_key = peewee.CompositeKey('session', 'number')
+
+
+# Reserva temporária de um nome de arquivo, feita antes do envio dos bytes. Enquanto não expira, só o dono pode
+# criar um arquivo com esse nome, então um upload de outro usuário com o mesmo nome é rejeitado antes de começar.
+class Reservation(peewee.Model):
+    filename = peewee.CharField(primary_key=True)
+    owner = peewee.ForeignKeyField(User, backref='reservations')
+    size = peewee.BigIntegerField(null=True)
+    expires_at = peewee.DateTimeField()
+
+    class Meta:
+        database = db
+
+
+# Mudança no catálogo de arquivos ('added' ou 'deleted'), registrada na mesma transação da própria mudança. `seq`
+# é crescente, então um cliente do feed de mudanças pode retomá-lo a partir do último evento que recebeu.
+class CatalogEvent(peewee.Model):
+    seq = peewee.AutoField()
+    kind = peewee.CharField()
+    filename = peewee.CharField()
+    uploaded_by = peewee.CharField()
+    uploaded_at = peewee.DateTimeField()
+
+    class Meta:
+        database = db
+
+
+# Token de autenticação revogado (ex.: por logout), identificado pelo claim `jti`. Só precisa ser guardado até
+# `expires_at`, quando o token expiraria de qualquer jeito.
+class RevokedToken(peewee.Model):
+    jti = peewee.CharField(primary_key=True)
+    expires_at = peewee.DateTimeField(index=True)
+
     class Meta:
         database = db
 
 
-db.create_tables([User, FileUpload])
+# Tabelas criadas por versões anteriores do servidor não têm as colunas adicionadas depois nos modelos; elas são
+# criadas aqui, com o valor padrão (ou nulo) nas linhas existentes. Precisa rodar antes de create_tables, que
+# cria os índices novos e falharia (ou indexaria a coluna errada) se as colunas ainda não existissem.
+def add_missing_columns(models):
+    migrator = SchemaMigrator.from_database(db)
+    operations = []
+    for model in models:
+        if not model.table_exists():
+            continue
+        existing = {column.name for column in db.get_columns(model._meta.table_name)}
+        for field in model._meta.sorted_fields:
+            if field.column_name not in existing:
+                log.info('Adding column %s.%s', model._meta.table_name, field.column_name)
+                operations.append(migrator.add_column(model._meta.table_name, field.column_name, field))
+    if operations:
+        migrate(*operations)
+
+
+MODELS = [User, Blob, FileUpload, UploadSession, UploadPart, UploadLock, Reservation, CatalogEvent, RevokedToken]
+
+add_missing_columns(MODELS)
+db.create_tables(MODELS)
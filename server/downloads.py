@@ -0,0 +1,212 @@
+import asyncio
+import base64
+import mimetypes
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from catalog import etag_matches
+from compression import DecodedFile
+from config import DOWNLOAD_CHUNK_SIZE
+from storage import StoredFile
+from threadpool import run_io
+
+# Download dos arquivos armazenados. O arquivo é enviado em blocos de DOWNLOAD_CHUNK_SIZE lidos do armazenamento
+# (ver storage.py) no pool de I/O, com no máximo uma leitura adiantada; como o uvicorn só aceita o próximo bloco
+# depois que o socket consegue escoar o anterior, a memória usada não depende do tamanho do arquivo nem da
+# velocidade do cliente. O envio é sempre feito assim, em blocos: o uvicorn usado aqui não oferece a extensão
+# `http.response.zerocopy` do ASGI, que permitiria mandar arquivos locais com `sendfile`, sem passar pelo Python.
+#
+# Também são suportados intervalos (`Range`), pra retomar downloads ou baixar partes em paralelo, e requisições
+# condicionais (`If-None-Match`, `If-Modified-Since`, `If-Range`).
+#
+# Um blob armazenado comprimido é enviado como está, com `Content-Encoding`, se o cliente aceitar o codec e não pedir
+# um intervalo; senão, é descomprimido durante o envio.
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Interpreta o cabeçalho Range; retorna o intervalo pedido como (início, fim exclusivo).
+
+    Retorna None quando o cabeçalho deve ser ignorado e o arquivo enviado por inteiro: ausente, com sintaxe
+    inválida, com outra unidade, ou com vários intervalos (não enviamos multipart/byteranges). Levanta
+    RangeNotSatisfiable se o intervalo começar depois do fim do arquivo.
+    """
+    if header is None:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, dash, last = spec.strip().partition('-')
+    if not dash or not (first.isdigit() or first == '') or not (last.isdigit() or last == ''):
+        return None
+
+    if first == '':
+        # Sufixo: os últimos `last` bytes
+        if last == '':
+            return None
+        if int(last) == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - int(last)), size
+
+    start = int(first)
+    if last != '' and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, size if last == '' else min(size, int(last) + 1)
+
+
+def http_date(value: datetime) -> str:
+    return formatdate(value.timestamp(), usegmt=True)
+
+
+def not_modified_since(header: Optional[str], last_modified: datetime) -> bool:
+    if header is None:
+        return False
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    # Datas HTTP têm resolução de segundos
+    return int(last_modified.timestamp()) <= since.timestamp()
+
+
+def accepts_encoding(header: Optional[str], encoding: str) -> bool:
+    """Se o cabeçalho Accept-Encoding aceita `encoding`, por nome ou por `*`, com qualidade diferente de zero."""
+    for item in (header or '').split(','):
+        name, _, params = item.partition(';')
+        if name.strip().lower() not in (encoding, '*'):
+            continue
+        quality = params.strip()
+        if not quality.startswith('q='):
+            return True
+        try:
+            return float(quality[2:]) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def content_disposition(filename: str) -> str:
+    # Nomes não-ASCII vão codificados em filename* (RFC 6266), com uma versão ASCII em filename pra clientes antigos
+    fallback = filename.encode('ascii', 'replace').decode().replace('"', '_').replace('\\', '_')
+    return f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{quote(filename)}'
+
+
+class FileDownload(Response):
+    """Resposta que envia o intervalo [`start`, `end`) do conteúdo aberto `content`, e o fecha ao terminar."""
+
+    def __init__(self, content: StoredFile, start: int, end: int, status_code: int, headers: dict,
+                 send_body: bool = True):
+        self.content = content
+        self.start = start
+        self.end = end
+        self.send_body = send_body
+        super().__init__(status_code=status_code, headers=headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+            if not self.send_body or self.start == self.end:
+                await send({'type': 'http.response.body', 'body': b''})
+            else:
+                await self._send_blocks(receive, send)
+        finally:
+            await run_io(self.content.close)
+
+    async def _send_blocks(self, receive: Receive, send: Send) -> None:
+        # Se o cliente desconectar, o uvicorn descarta os blocos em silêncio; sem isso leríamos o arquivo até o fim
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        read = self.content.read
+        position = self.start
+        pending = asyncio.ensure_future(run_io(read, position, min(DOWNLOAD_CHUNK_SIZE, self.end - position)))
+        try:
+            while pending is not None:
+                data = await pending
+                pending = None
+                if not data:
+                    raise RuntimeError('Stored content is shorter than expected')
+                position += len(data)
+                if position < self.end:
+                    # A leitura do próximo bloco se sobrepõe ao envio do atual
+                    pending = asyncio.ensure_future(
+                        run_io(read, position, min(DOWNLOAD_CHUNK_SIZE, self.end - position)))
+                await send({'type': 'http.response.body', 'body': data, 'more_body': pending is not None})
+                if disconnected.done():
+                    break
+        finally:
+            disconnected.cancel()
+            if pending is not None:
+                # O conteúdo só pode ser fechado depois que a leitura em andamento terminar
+                await asyncio.wait([pending])
+
+
+async def _wait_disconnect(receive: Receive) -> None:
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def file_response(request: Request, content: StoredFile, filename: str, last_modified: datetime,
+                        etag: Optional[str] = None, digest: Optional[str] = None) -> Response:
+    """Monta a resposta de download de `content`, respeitando os cabeçalhos condicionais e Range; `content` é
+    fechado pela resposta.
+
+    `etag` deve ser um validador forte (ex.: o hash do conteúdo); sem ele, um é derivado do tamanho e da data de
+    modificação do arquivo. `digest`, o hash SHA-256 do conteúdo em hexadecimal, é enviado em `Repr-Digest`
+    (RFC 9530), pra que o cliente possa conferir o que recebeu.
+    """
+    if etag is None:
+        etag = f'"{int(content.mtime * 1e6):x}-{content.size:x}"'
+    headers = {'ETag': etag, 'Last-Modified': http_date(last_modified), 'Accept-Ranges': 'bytes'}
+    if digest is not None:
+        headers['Repr-Digest'] = f'sha-256=:{base64.b64encode(bytes.fromhex(digest)).decode()}:'
+    if isinstance(content, DecodedFile):
+        headers['Vary'] = 'Accept-Encoding'
+        if 'range' not in request.headers and accepts_encoding(request.headers.get('accept-encoding'),
+                                                               content.codec):
+            # Os bytes comprimidos são outra representação do arquivo, e precisam de outro validador
+            headers['ETag'] = etag = etag[:-1] + f'-{content.codec}"'
+            headers['Content-Encoding'] = content.codec
+            # O hash é do conteúdo original, não dos bytes comprimidos
+            headers.pop('Repr-Digest', None)
+            content = content.raw
+    size = content.size
+
+    try:
+        if_none_match = request.headers.get('if-none-match')
+        if etag_matches(if_none_match, etag) or (
+                if_none_match is None and not_modified_since(request.headers.get('if-modified-since'),
+                                                             last_modified)):
+            await run_io(content.close)
+            return Response(status_code=304, headers=headers)
+
+        # Com If-Range, o intervalo só vale se o arquivo ainda for o mesmo que o cliente tem em parte
+        if_range = request.headers.get('if-range')
+        byte_range = None
+        if if_range is None or if_range == etag:
+            byte_range = parse_range(request.headers.get('range'), size)
+    except RangeNotSatisfiable:
+        await run_io(content.close)
+        return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{size}'})
+    except BaseException:
+        await run_io(content.close)
+        raise
+
+    start, end = byte_range if byte_range is not None else (0, size)
+    headers.update({
+        'Content-Length': str(end - start),
+        'Content-Type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        'Content-Disposition': content_disposition(filename),
+    })
+    if byte_range is not None:
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    return FileDownload(content, start, end, 206 if byte_range is not None else 200, headers,
+                        send_body=request.method != 'HEAD')
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import threading
+from typing import Awaitable, Callable, Optional
+
+import peewee
+from fastapi.encoders import jsonable_encoder
+
+from config import EVENTS_HEARTBEAT, EVENTS_POLL_INTERVAL
+from database import CatalogEvent, FileUpload, db
+from threadpool import run_db
+
+# Feed de mudanças do catálogo, no formato Server-Sent Events. Cada arquivo criado ou removido gera um evento com
+# número de sequência crescente, gravado no banco de dados junto com a mudança, e os clientes recebem os eventos
+# assim que acontecem, em vez de baixarem a lista inteira periodicamente. Um cliente que perca a conexão a retoma
+# enviando o último número recebido (cabeçalho Last-Event-ID), sem perder nem repetir eventos.
+
+# Máximo de eventos lidos do banco de dados por consulta
+EVENTS_BATCH_SIZE = 500
+
+# Chave do advisory lock do PostgreSQL que ordena as transações que gravam eventos (ver `record_event`)
+EVENT_LOG_LOCK = 0x6576656e7473
+
+
+class ChangeNotifier:
+    """Acorda os feeds abertos quando o catálogo muda.
+
+    `notify` pode ser chamado de qualquer thread. Um feed registra seu `waiter` antes de consultar os eventos, então
+    uma mudança confirmada entre a consulta e a espera não se perde. `close` encerra os feeds, no desligamento do
+    servidor, já que eles não terminariam sozinhos.
+    """
+
+    def __init__(self):
+        self._waiters = set()
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def waiter(self) -> asyncio.Future:
+        waiter = asyncio.get_event_loop().create_future()
+        with self._lock:
+            self._waiters.add(waiter)
+        waiter.add_done_callback(self._discard)
+        return waiter
+
+    def _discard(self, waiter: asyncio.Future) -> None:
+        with self._lock:
+            self._waiters.discard(waiter)
+
+    def notify(self) -> None:
+        with self._lock:
+            waiters = list(self._waiters)
+        for waiter in waiters:
+            waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+    def has_waiters(self) -> bool:
+        with self._lock:
+            return bool(self._waiters)
+
+    def close(self) -> None:
+        self.closed = True
+        self.notify()
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+notifier = ChangeNotifier()
+
+
+# Deve ser chamada dentro da transação que faz a mudança.
+#
+# Os leitores (o feed, o ETag de /files e o cache do catálogo) guardam o último número de sequência visto e depois
+# só consultam os maiores, então os eventos precisam ficar visíveis na ordem dos números. No SQLite, a transação
+# já tem o lock de escrita (ver `write_transaction`); no PostgreSQL, o número vem da sequência na hora do INSERT e
+# transações concorrentes podem ser confirmadas fora de ordem, então pegamos um advisory lock, que vale até o fim
+# da transação, antes de gravar o evento: o número só é gerado depois de confirmada a transação anterior.
+def record_event(kind: str, file_upload: FileUpload) -> None:
+    lock_event_log()
+    CatalogEvent.create(kind=kind, filename=file_upload.filename, uploaded_by=file_upload.uploaded_by_id,
+                        uploaded_at=file_upload.uploaded_at)
+
+
+def lock_event_log() -> None:
+    """Espera as outras transações que gravam eventos terminarem, e as seguintes esperarem esta (ver `record_event`);
+    serve também pra ordenar outras transações com as que mudam o catálogo."""
+    if isinstance(db, peewee.PostgresqlDatabase):
+        db.execute_sql('SELECT pg_advisory_xact_lock(%s)', (EVENT_LOG_LOCK,))
+
+
+def last_seq() -> int:
+    return CatalogEvent.select(CatalogEvent.seq).order_by(CatalogEvent.seq.desc()).scalar() or 0
+
+
+def events_since(seq: int) -> list:
+    return list(CatalogEvent.select()
+                .where(CatalogEvent.seq > seq)
+                .order_by(CatalogEvent.seq)
+                .limit(EVENTS_BATCH_SIZE))
+
+
+async def poll_changes(interval: float = EVENTS_POLL_INTERVAL) -> None:
+    """Acorda os feeds deste processo quando outro processo do servidor grava um evento.
+
+    Mudanças feitas neste processo já chamam `notifier.notify`; as dos outros só são vistas pelo banco de dados.
+    Sem feeds abertos, o banco de dados não é consultado.
+    """
+    seq = None
+    while True:
+        await asyncio.sleep(interval)
+        if not notifier.has_waiters():
+            seq = None
+            continue
+        # Na primeira verificação com feeds abertos, não sabemos o que eles já viram, então os acordamos de qualquer
+        # forma; cada um só consulta os eventos seguintes aos que já recebeu
+        current = await run_db(last_seq)
+        if current != seq:
+            notifier.notify()
+        seq = current
+
+
+def format_event(kind: str, seq: int, data: dict) -> bytes:
+    return f'id: {seq}\nevent: {kind}\ndata: {json.dumps(jsonable_encoder(data))}\n\n'.encode()
+
+
+async def iter_events(since: Optional[int], is_disconnected: Callable[[], Awaitable[bool]],
+                      heartbeat: float = EVENTS_HEARTBEAT):
+    """Gera as mensagens do feed a partir do evento seguinte a `since`, até o cliente desconectar.
+
+    Sem `since`, o feed começa no evento atual com uma mensagem `ready`: o cliente carrega a lista de arquivos
+    depois de recebê-la, e os eventos seguintes a atualizam. Se `since` for maior que o último evento (ex.: o
+    banco de dados foi recriado), o feed envia `reset`, e o cliente deve carregar a lista de novo.
+    """
+    current = await run_db(last_seq)
+    if since is None or since > current:
+        yield format_event('ready' if since is None else 'reset', current, {})
+        since = current
+
+    while not notifier.closed and not await is_disconnected():
+        waiter = notifier.waiter()
+        try:
+            events = await run_db(events_since, since)
+            for event in events:
+                yield format_event(event.kind, event.seq, {
+                    'filename': event.filename,
+                    'uploaded_by': event.uploaded_by,
+                    'uploaded_at': event.uploaded_at
+                })
+                since = event.seq
+            if events:
+                continue
+
+            # Sem eventos novos, esperamos uma notificação. Se ela não vier, mandamos um comentário, que mantém a
+            # conexão aberta em proxies e nos permite notar se o cliente desconectou.
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), heartbeat)
+            except asyncio.TimeoutError:
+                yield b': keepalive\n\n'
+        finally:
+            waiter.cancel()
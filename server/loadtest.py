@@ -0,0 +1,356 @@
+"""Teste de carga de ponta a ponta: sobe o servidor de verdade (serve.py) e o exercita com clientes simultâneos.
+
+Uso: python loadtest.py [--duration 30] [--workers 1] [--output resultado.json] [--compare anterior.json]
+
+Cada cliente é uma thread com sua própria sessão HTTP, repetindo uma operação até o fim do teste:
+- auth: cadastro de um usuário novo seguido de login (dominado pelo Argon2);
+- large: upload de um arquivo grande (--large-mb), enviado em streaming;
+- small: uploads de arquivos pequenos (--small-kb), um por requisição;
+- poll: GET /files com If-None-Match, como o cliente desktop faz.
+
+O número de clientes de cada tipo é dado por --auth-clients, --large-clients etc. O servidor roda num diretório
+temporário, com um banco de dados SQLite próprio, e é encerrado no final. Com --url, o teste é feito contra um
+servidor já no ar (sem a medição de memória).
+
+São reportados, por operação, a vazão (req/s e MiB/s) e as latências p50/p95/p99, além da memória (RSS) do
+servidor, somando seus processos de trabalho e de senhas. O resultado completo é gravado em JSON com --output, e
+--compare mostra a variação em relação a um resultado anterior.
+"""
+import argparse
+import json
+import os
+import secrets
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVER_DIR)
+
+from bench import percentile  # noqa: E402
+
+BOUNDARY = 'loadtestboundary'
+PASSWORD = 'loadtest-password'
+RSS_SAMPLE_INTERVAL = 0.5
+STARTUP_TIMEOUT = 30
+
+
+class MultipartBody:
+    """Corpo multipart de um upload de `size` bytes, gerado conforme é lido, pra que arquivos grandes não ocupem
+    memória no cliente. O início é aleatório, pra que cada upload seja um conteúdo novo (sem deduplicação)."""
+
+    def __init__(self, filename: str, size: int, block: bytes):
+        self._header = (f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                        f'Content-Type: application/octet-stream\r\n\r\n').encode() + os.urandom(min(size, 32))
+        self._footer = f'\r\n--{BOUNDARY}--\r\n'.encode()
+        self._block = block
+        self._remaining = size - min(size, 32)
+        self._length = len(self._header) + self._remaining + len(self._footer)
+
+    def __len__(self) -> int:
+        # O requests usa o tamanho pra enviar Content-Length, em vez de chunked
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        if self._header:
+            data, self._header = self._header, b''
+            return data
+        if self._remaining:
+            data = self._block[:min(self._remaining, len(self._block))]
+            self._remaining -= len(data)
+            return data
+        data, self._footer = self._footer, b''
+        return data
+
+
+class ServerProcess:
+    """serve.py num diretório temporário, numa porta livre."""
+
+    def __init__(self, workers: int, env: dict):
+        self.workdir = tempfile.mkdtemp(prefix='upload_loadtest_')
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.log_path = os.path.join(self.workdir, 'server.log')
+
+        environment = dict(os.environ, UPLOAD_DIR=os.path.join(self.workdir, 'uploads'),
+                           DATABASE_URL=f'sqlite:///{os.path.join(self.workdir, "loadtest.db")}')
+        environment.pop('TEST_DB', None)
+        environment.update(env)
+        os.mkdir(environment['UPLOAD_DIR'])
+        with open(self.log_path, 'wb') as log_file:
+            self.process = subprocess.Popen(
+                [sys.executable, os.path.join(SERVER_DIR, 'serve.py'), '--host', '127.0.0.1',
+                 '--port', str(self.port), '--workers', str(workers)],
+                env=environment, stdout=log_file, stderr=subprocess.STDOUT)
+
+    def wait_ready(self) -> None:
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Server exited during startup, see {self.log_path}')
+            try:
+                requests.get(self.url + '/metrics', timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        raise RuntimeError(f'Server did not start in {STARTUP_TIMEOUT} s, see {self.log_path}')
+
+    def rss(self) -> int:
+        """Memória residente, em bytes, do processo principal e de todos os seus descendentes."""
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as fd:
+                    # O nome do processo, entre parênteses, pode conter espaços
+                    parent = int(fd.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(parent, []).append(int(entry))
+
+        total = 0
+        pending = [self.process.pid]
+        while pending:
+            pid = pending.pop()
+            pending.extend(children.get(pid, ()))
+            try:
+                with open(f'/proc/{pid}/status') as fd:
+                    for line in fd:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                continue
+        return total
+
+    def stop(self, keep: bool = False) -> None:
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(STARTUP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if not keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class Client(threading.Thread):
+    """Repete `operation` até `deadline`, registrando (operação, início, latência, bytes, status) de cada uma."""
+
+    def __init__(self, name: str, url: str, operation, deadline: float, args):
+        super().__init__(name=name, daemon=True)
+        self.url = url
+        self.operation = operation
+        self.deadline = deadline
+        self.args = args
+        self.session = requests.Session()
+        self.samples = []
+        self.errors = {}
+        self.username = f'lt{secrets.token_hex(3)}{name.rsplit("-", 1)[-1]}'[:12]
+        self.sequence = 0
+
+    def request(self, kind: str, method: str, path: str, sent: int = 0, **kwargs) -> requests.Response:
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url + path, **kwargs)
+        except requests.RequestException as error:
+            self.errors[type(error).__name__] = self.errors.get(type(error).__name__, 0) + 1
+            self.samples.append((kind, started, time.perf_counter() - started, sent, None))
+            return None
+        self.samples.append((kind, started, time.perf_counter() - started, sent + len(response.content),
+                             response.status_code))
+        return response
+
+    def login(self) -> None:
+        self.session.cookies.clear()
+        credentials = {'username': self.username, 'password': PASSWORD}
+        self.request('register', 'POST', '/register', json=credentials)
+        response = self.request('login', 'POST', '/login', json=credentials)
+        if response is None or response.status_code != 200:
+            raise RuntimeError(f'{self.name} could not log in')
+
+    def run(self) -> None:
+        try:
+            self.login()
+            while time.perf_counter() < self.deadline:
+                self.operation(self)
+        except Exception as error:
+            self.errors[repr(error)] = self.errors.get(repr(error), 0) + 1
+
+
+def auth_operation(client: Client) -> None:
+    client.username = f'lt{secrets.token_hex(5)}'
+    client.login()
+
+
+def upload(client: Client, kind: str, size: int, block: bytes) -> None:
+    client.sequence += 1
+    filename = f'{client.username}-{client.sequence}.bin'
+    body = MultipartBody(filename, size, block)
+    client.request(kind, 'POST', '/upload', sent=len(body), data=body,
+                   headers={'Content-Type': f'multipart/form-data; boundary={BOUNDARY}'})
+
+
+def poll_operation(client: Client) -> None:
+    headers = {}
+    if getattr(client, 'etag', None):
+        headers['If-None-Match'] = client.etag
+    response = client.request('poll', 'GET', '/files', headers=headers)
+    if response is not None and response.status_code in (200, 304):
+        client.etag = response.headers.get('etag')
+    time.sleep(client.args.poll_interval)
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    results = {}
+    for kind in sorted({sample[0] for sample in samples}):
+        selected = [sample for sample in samples if sample[0] == kind]
+        latencies = [sample[2] for sample in selected]
+        failed = sum(1 for sample in selected if sample[4] is None or sample[4] >= 400)
+        transferred = sum(sample[3] for sample in selected)
+        results[kind] = {
+            'requests': len(selected),
+            'errors': failed,
+            'requests_per_second': len(selected) / elapsed,
+            'mib_per_second': transferred / elapsed / (1024 * 1024),
+            'latency_ms': {name: 1000 * percentile(latencies, fraction)
+                           for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))},
+            'max_latency_ms': 1000 * max(latencies),
+        }
+    return results
+
+
+def run(args) -> dict:
+    server = None
+    url = args.url
+    if url is None:
+        server = ServerProcess(args.workers, dict(env.split('=', 1) for env in args.env))
+        server.wait_ready()
+        url = server.url
+
+    large_size = args.large_mb * 1024 * 1024
+    small_size = args.small_kb * 1024
+    block = os.urandom(1024 * 1024)
+    operations = [
+        ('auth', args.auth_clients, auth_operation),
+        ('large', args.large_clients, lambda client: upload(client, 'large', large_size, block)),
+        ('small', args.small_clients, lambda client: upload(client, 'small', small_size, block)),
+        ('poll', args.poll_clients, poll_operation),
+    ]
+
+    rss_samples = []
+    stop_sampling = threading.Event()
+
+    def sample_rss():
+        while not stop_sampling.wait(RSS_SAMPLE_INTERVAL):
+            rss_samples.append(server.rss())
+
+    try:
+        if server is not None:
+            rss_samples.append(server.rss())
+            sampler = threading.Thread(target=sample_rss, daemon=True)
+            sampler.start()
+        started = time.perf_counter()
+        deadline = started + args.duration
+        clients = [Client(f'{name}-{index}', url, operation, deadline, args)
+                   for name, count, operation in operations for index in range(count)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - started
+        stop_sampling.set()
+    finally:
+        if server is not None:
+            stop_sampling.set()
+            server.stop(keep=args.keep)
+
+    samples = [sample for client in clients for sample in client.samples]
+    errors = {}
+    for client in clients:
+        for error, count in client.errors.items():
+            errors[error] = errors.get(error, 0) + count
+    result = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'options': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'elapsed_seconds': elapsed,
+        'operations': summarize(samples, elapsed),
+        'total': summarize([('total',) + sample[1:] for sample in samples], elapsed)['total'] if samples else None,
+        'client_errors': errors,
+    }
+    if rss_samples:
+        result['server_rss_mib'] = {'start': rss_samples[0] / (1024 * 1024),
+                                    'peak': max(rss_samples) / (1024 * 1024),
+                                    'end': rss_samples[-1] / (1024 * 1024)}
+    return result
+
+
+def report(result: dict, previous: dict = None) -> None:
+    def change(current, old):
+        if not old:
+            return ''
+        return f' ({100 * (current - old) / old:+6.1f}%)'
+
+    print(f'{"operation":10s} {"requests":>9s} {"errors":>7s} {"req/s":>9s} {"MiB/s":>9s} '
+          f'{"p50 ms":>9s} {"p95 ms":>9s} {"p99 ms":>9s}')
+    rows = dict(result['operations'], total=result['total']) if result['total'] else {}
+    for kind, stats in rows.items():
+        old = (previous or {}).get('operations', {}).get(kind) if kind != 'total' else (previous or {}).get('total')
+        latency = stats['latency_ms']
+        print(f'{kind:10s} {stats["requests"]:9d} {stats["errors"]:7d} {stats["requests_per_second"]:9.1f} '
+              f'{stats["mib_per_second"]:9.1f} {latency["p50"]:9.1f} {latency["p95"]:9.1f} {latency["p99"]:9.1f}')
+        if old:
+            print(f'{"":10s} vs previous: req/s{change(stats["requests_per_second"], old["requests_per_second"])}'
+                  f'  MiB/s{change(stats["mib_per_second"], old["mib_per_second"])}'
+                  f'  p95{change(latency["p95"], old["latency_ms"]["p95"])}')
+    if 'server_rss_mib' in result:
+        rss = result['server_rss_mib']
+        print(f'Server RSS: {rss["start"]:.1f} MiB at start, {rss["peak"]:.1f} MiB peak, {rss["end"]:.1f} MiB at end'
+              + change(rss['peak'], (previous or {}).get('server_rss_mib', {}).get('peak')))
+    if result['client_errors']:
+        print(f'Client errors: {result["client_errors"]}')
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--workers', type=int, default=1, help='server worker processes')
+    parser.add_argument('--url', help='test an already running server instead of starting one')
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment variable for the server (e.g. STORAGE_CODEC=gzip)')
+    parser.add_argument('--auth-clients', type=int, default=1)
+    parser.add_argument('--large-clients', type=int, default=2)
+    parser.add_argument('--large-mb', type=int, default=64)
+    parser.add_argument('--small-clients', type=int, default=4)
+    parser.add_argument('--small-kb', type=int, default=16)
+    parser.add_argument('--poll-clients', type=int, default=4)
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='pause between polls of each client')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    parser.add_argument('--keep', action='store_true', help='keep the server directory (database, log)')
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as fd:
+            previous = json.load(fd)
+    result = run(args)
+    report(result, previous)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            json.dump(result, fd, indent=2)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,211 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import uuid
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from time import perf_counter
+from typing import Optional
+
+import metrics
+from config import LOG_FORMAT, LOG_QUEUE_SIZE
+
+# Os logs são emitidos sem bloquear quem loga: cada registro vai pra uma fila limitada e é formatado e escrito por
+# uma thread própria. Se a saída ficar lenta (ex.: um pipe cheio ou o journald sobrecarregado), a fila enche e os
+# registros passam a ser descartados, primeiro os abaixo de WARNING, em vez de a latência das requisições subir
+# junto; a thread avisa quantos foram descartados, e eles são contados em log_records_dropped_total.
+#
+# Como a formatação acontece na thread de escrita, use a forma preguiçosa, `log.info('Deleted %s', filename)`, e
+# não f-strings, e não altere depois os objetos passados como argumentos.
+
+# A partir dessa fração da fila cheia, registros abaixo de WARNING são descartados, pra sobrar espaço pros outros
+SHED_FRACTION = 0.75
+
+# Identificador da requisição sendo atendida no contexto atual, incluído em todos os registros feitos nela
+request_id: contextvars.ContextVar = contextvars.ContextVar('request_id', default=None)
+
+LOG_RECORDS_DROPPED = metrics.Counter('log_records_dropped_total', 'Log records dropped because the log queue was '
+                                      'full.')
+
+# Atributos de todo LogRecord; os demais vêm de `extra` e são incluídos nos registros em JSON
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime',
+                                                                                   'request_id'}
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get() or '-'
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Põe os registros na fila sem nunca esperar por espaço nela; o que não couber é descartado e contado."""
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # A thread de escrita é deste processo, então o registro vai como está, e a mensagem só é formatada lá
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if record.levelno < logging.WARNING and self.queue.qsize() >= SHED_FRACTION * self.queue.maxsize:
+            self._drop()
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._drop()
+
+    def _drop(self) -> None:
+        with self._dropped_lock:
+            self.dropped += 1
+        LOG_RECORDS_DROPPED.inc()
+
+    def take_dropped(self) -> int:
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+class LogWriter(QueueListener):
+    """Thread que formata e escreve os registros da fila, avisando quando houve descartes."""
+
+    def __init__(self, records: queue.Queue, source: DroppingQueueHandler, *handlers: logging.Handler):
+        super().__init__(records, *handlers, respect_handler_level=True)
+        self.source = source
+
+    def handle(self, record: logging.LogRecord) -> None:
+        dropped = self.source.take_dropped()
+        if dropped:
+            super().handle(logging.makeLogRecord({
+                'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING', 'request_id': '-',
+                'msg': 'Dropped %d log records: log output is too slow', 'args': (dropped,)}))
+        super().handle(record)
+
+    def enqueue_sentinel(self) -> None:
+        # Ao parar, esperamos espaço na fila, pra que os registros já aceitos sejam todos escritos
+        self.queue.put(self._sentinel)
+
+
+class JsonFormatter(logging.Formatter):
+    """Um objeto JSON por linha, com a mensagem, o id da requisição e os campos passados em `extra`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        if getattr(record, 'request_id', '-') != '-':
+            data['request_id'] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def _create_formatter() -> logging.Formatter:
+    if LOG_FORMAT == 'json':
+        return JsonFormatter()
+    return logging.Formatter('[%(levelname)s] %(asctime)s [%(request_id)s] - %(message)s')
+
+
+_handler: Optional[DroppingQueueHandler] = None
+_writer: Optional[LogWriter] = None
+
+
+def _start_writer() -> None:
+    global _writer
+    # O handler de saída é criado agora, e não na importação, pra escrever no sys.stdout atual
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(_create_formatter())
+    _handler._dropped_lock = threading.Lock()
+    _handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    _writer = LogWriter(_handler.queue, _handler, output)
+    _writer.start()
+
+
+def configure(logger: logging.Logger) -> None:
+    """Faz `logger` emitir seus registros pela fila, com a thread de escrita deste módulo."""
+    global _handler
+    if _handler is None:
+        _handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        _handler.addFilter(RequestIdFilter())
+        _start_writer()
+        atexit.register(stop)
+        # Um processo criado com fork (serve.py) não herda a thread de escrita, nem pode confiar nos locks da fila
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_start_writer)
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+
+def stop() -> None:
+    """Escreve os registros pendentes e para a thread de escrita (ex.: antes de os._exit)."""
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+class RequestLogMiddleware:
+    """Dá um id a cada requisição (o do cabeçalho X-Request-ID, se vier, ou um novo), devolvido no mesmo cabeçalho
+    da resposta, e, com `access`, registra uma linha por requisição com status, duração e bytes recebidos e
+    enviados."""
+
+    def __init__(self, app, logger: logging.Logger, access: bool = True):
+        self.app = app
+        self.logger = logger
+        self.access = access
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        current_id = None
+        for name, value in scope['headers']:
+            if name == b'x-request-id':
+                current_id = value.decode('latin-1')[:64]
+        current_id = current_id or uuid.uuid4().hex[:16]
+        reset_token = request_id.set(current_id)
+
+        start = perf_counter()
+        status = 500
+        received = sent = 0
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get('body', b''))
+            return message
+
+        async def send_with_id(message):
+            nonlocal status, sent
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message = dict(message, headers=list(message.get('headers', [])) +
+                               [(b'x-request-id', current_id.encode('latin-1'))])
+            elif message['type'] == 'http.response.body':
+                sent += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, send_with_id)
+        finally:
+            if self.access:
+                self._log(scope, status, 1000 * (perf_counter() - start), received, sent)
+            request_id.reset(reset_token)
+
+    def _log(self, scope, status: int, duration_ms: float, received: int, sent: int) -> None:
+        self.logger.info('%s %s %d %.1f ms, %d bytes in, %d bytes out', scope['method'], scope['path'], status,
+                         duration_ms, received, sent,
+                         extra={'method': scope['method'], 'path': scope['path'], 'status': status,
+                                'duration_ms': round(duration_ms, 3), 'bytes_in': received, 'bytes_out': sent})
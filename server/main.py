@@ -1,76 +1,141 @@
-import os
+import asyncio
 from datetime import datetime
+from urllib.parse import unquote
 
 import uvicorn
 from starlette.requests import Request
-from starlette.responses import Response
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
-
-import jwt
-
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError
-
-from models import UserModel
-from utils import log
-
-from database import User, FileUpload
-
-JWT_SECRET = 'this-is-very-secret-dont-leak'
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi.encoders import jsonable_encoder
+
+from peewee import IntegrityError
+
+from auth import get_current_user, get_token, issue_token, revoke_token
+from config import (FILES_PAGE_SIZE, MAX_FILES_PAGE_SIZE, SWEEP_INTERVAL, ORPHAN_MAX_AGE, BATCH_MAX_FILES,
+                    METRICS_FLUSH_INTERVAL, LOG_ACCESS)
+from models import UserModel, LinkFileModel, ReservationModel
+from utils import log, remove_if_exists
+
+import blobs
+import catalog
+import downloads
+import logs
+import metrics
+import passwords
+import profiling
+from database import db, User, Blob
+from events import iter_events, last_seq, notifier, poll_changes
+from sessions import router as sessions_router, sweep_partial_files
+from streaming import iter_multipart, PartEvent
+from threadpool import run_io, run_db, AsyncFileWriter
 
 app = FastAPI()
-pw_hasher = PasswordHasher()
-
-
-def get_current_user(request: Request) -> str:
-    jwt_token = request.cookies.get('Authorization')
+app.include_router(sessions_router)
+app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(logs.RequestLogMiddleware, logger=log, access=LOG_ACCESS)
+metrics.instrument_database(db)
+
+
+async def sweep_orphans():
+    while True:
+        try:
+            removed = (await run_io(blobs.sweep_temp_files, ORPHAN_MAX_AGE) +
+                       await run_db(sweep_partial_files, ORPHAN_MAX_AGE))
+            if removed:
+                log.info('Removed %d abandoned upload files', removed)
+        except Exception:
+            log.exception('Failed to remove abandoned upload files')
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+
+# Com vários processos, grava periodicamente as métricas deste, pra que qualquer um possa somá-las em /metrics
+async def write_metrics():
+    while metrics.directory is not None:
+        try:
+            await run_io(metrics.write_snapshot)
+        except Exception:
+            log.exception('Failed to write metrics snapshot')
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+
+
+@app.on_event('startup')
+async def startup():
+    # Acorda os feeds deste processo com mudanças feitas pelos outros processos do servidor
+    app.state.poller = asyncio.ensure_future(poll_changes())
+    app.state.sweeper = asyncio.ensure_future(sweep_orphans())
+    app.state.metrics_writer = asyncio.ensure_future(write_metrics())
+    # O cache do catálogo é carregado já na inicialização, e não na primeira requisição
+    await run_db(catalog.cache.sync)
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    app.state.poller.cancel()
+    app.state.sweeper.cancel()
+    app.state.metrics_writer.cancel()
+    if metrics.directory is not None:
+        await run_io(metrics.write_snapshot)
+    notifier.close()
+    passwords.shutdown()
+
+
+def _user_exists(username: str) -> bool:
+    return User.select().where(User.username == username).count() > 0
+
+
+def _create_user(username: str, password_hash: str) -> None:
+    # Outro cadastro com o mesmo nome pode ter sido concluído enquanto o hash era calculado
+    try:
+        User.create(username=username, password_hash=password_hash)
+    except IntegrityError:
+        raise HTTPException(409, 'Username already exists.')
 
-    if jwt_token is None:
-        raise HTTPException(403, 'You need to login to use this feature.')
 
-    jwt_token = jwt_token.split(' ')[-1]
-    username = jwt.decode(jwt_token, key=JWT_SECRET, algorithms=['HS256']).get('username')
-    return username
+def _update_password_hash(username: str, password_hash: str) -> None:
+    User.update(password_hash=password_hash).where(User.username == username).execute()
 
 
 # Cadastro de usuário
 @app.post('/register')
-def register(user_in: UserModel):
-    if User.select().where(User.username == user_in.username).count() > 0:
-        log.info(f'Tried to register existing username {user_in.username} (returned 409)')
+async def register(user_in: UserModel):
+    if await run_db(_user_exists, user_in.username):
+        log.info('Tried to register existing username %s (returned 409)', user_in.username)
         raise HTTPException(409, 'Username already exists.')
 
-    # Calculamos o hash a partir da senha e criamos o usuário no banco de dados
-    password_hash = pw_hasher.hash(user_in.password.get_secret_value())
-    new_user = User.create(username=user_in.username, password_hash=password_hash)
-    assert new_user is not None
+    # Calculamos o hash a partir da senha (no pool de processos de senhas) e criamos o usuário no banco de dados
+    password_hash = await passwords.hash_password(user_in.password.get_secret_value())
+    await run_db(_create_user, user_in.username, password_hash)
 
-    log.info(f'Registered user {user_in.username}')
+    log.info('Registered user %s', user_in.username)
     return user_in.dict(exclude={'password'})
 
 # Fazemos o login e retornamos no corpo e cookies o token JWT a ser usado para autenticação.
 @app.post('/login')
-def login(response: Response, user_in: UserModel):
+async def login(response: Response, user_in: UserModel):
 
     # Pegar usuário do banco de dados
-    user_db = User.select().where(User.username == user_in.username).first()
+    user_db = await run_db(User.get_or_none, User.username == user_in.username)
 
     # Verificar existência de usuário
     if not user_db:
-        log.info(f'Tried to login with non-existent user {user_in.username}')
+        log.info('Tried to login with non-existent user %s', user_in.username)
         raise HTTPException(404, 'User not found.')
 
-    # Verificar hash de senha
-    try:
-        pw_hasher.verify(user_db.password_hash, user_in.password.get_secret_value())
-    except VerifyMismatchError:
-        log.info(f'Tried to login with wrong password for user {user_in.username}')
+    # Verificar hash de senha. Se ele tiver sido gerado com parâmetros diferentes dos atuais, aproveitamos que
+    # temos a senha pra armazenar um hash novo.
+    valid, new_hash = await passwords.verify_password(user_db.password_hash, user_in.password.get_secret_value())
+    if not valid:
+        log.info('Tried to login with wrong password for user %s', user_in.username)
         raise HTTPException(403, f'Invalid password for username {user_in.username}')
+    if new_hash is not None:
+        await run_db(_update_password_hash, user_in.username, new_hash)
+        log.info('Updated password hash parameters for user %s', user_in.username)
 
     # Gerar token JWT de autenticação
-    jwt_token = jwt.encode({'username': user_in.username}, key=JWT_SECRET, algorithm='HS256').decode()
+    jwt_token = issue_token(user_in.username)
 
-    log.info(f'Successfully logged in {user_in.username}')
+    log.info('Successfully logged in %s', user_in.username)
     response.set_cookie('Authorization', f'Bearer {jwt_token}')
     return {
         'username': user_in.username,
@@ -78,45 +143,295 @@ def login(response: Response, user_in: UserModel):
     }
 
 
-# Retornar lista com arquivos já enviados
+# Encerrar a sessão: o token atual é revogado e deixa de ser aceito
+@app.post('/logout')
+async def logout(request: Request, response: Response, current_user: str = Depends(get_current_user)):
+    await run_db(revoke_token, get_token(request))
+    log.info('Logged out %s', current_user)
+    response.delete_cookie('Authorization')
+    return {'username': current_user}
+
+
+# Retornar uma página da lista de arquivos já enviados, em ordem de envio. A próxima página é obtida passando o
+# `next_cursor` retornado como `cursor`; ele é nulo na última página. A lista pode ser filtrada pelo usuário que
+# enviou os arquivos, pelo início do nome e pelo intervalo de datas de envio (`uploaded_after` inclusive,
+# `uploaded_before` exclusive).
+#
+# A resposta tem um ETag derivado da versão do catálogo. Se o cliente enviar o ETag que já tem em If-None-Match e
+# nada tiver mudado, respondemos 304 sem corpo e sem consultar o banco de dados.
 @app.get('/files')
-def get_files(current_user: str = Depends(get_current_user)):
+async def get_files(request: Request, limit: int = Query(FILES_PAGE_SIZE, ge=1, le=MAX_FILES_PAGE_SIZE),
+                    cursor: str = None, uploaded_by: str = None, prefix: str = None,
+                    uploaded_after: datetime = None, uploaded_before: datetime = None,
+                    current_user: str = Depends(get_current_user)):
+    # O ETag é lido antes da consulta: se o catálogo mudar durante ela, o cliente só busca a página de novo. A
+    # página sai do cache do catálogo, atualizado até a mesma versão.
+    version = await run_db(last_seq)
+    etag = catalog.version_etag(version)
+    if catalog.etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers={'ETag': etag})
+    with metrics.FILES_QUERY_DURATION.time():
+        page = await run_db(catalog.list_files, limit, cursor, version,
+                            catalog.FileFilter(uploaded_by, prefix, uploaded_after, uploaded_before))
+    return JSONResponse(jsonable_encoder(page), headers={'ETag': etag})
+
+
+# Feed de mudanças na lista de arquivos, em Server-Sent Events (ver events.py). Pra retomar o feed, o cliente
+# envia o id do último evento recebido no cabeçalho Last-Event-ID, ou em `since`.
+@app.get('/events')
+async def get_events(request: Request, since: int = Query(None, ge=0), current_user: str = Depends(get_current_user)):
+    last_event_id = request.headers.get('last-event-id', '')
+    if since is None and last_event_id.isdigit():
+        since = int(last_event_id)
+    return StreamingResponse(iter_events(since, request.is_disconnected), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
 
-    db_files = []
-    for file in FileUpload.select():
-        db_files.append({
-            'filename': file.filename,
-            'uploaded_by': file.uploaded_by.username,
-            'uploaded_at': file.uploaded_at
-        })
-    return db_files
 
 # Rota de upload de arquivo
 @app.post("/upload")
-async def upload_file(current_user: str = Depends(get_current_user), file: UploadFile = File(...)):
-
-    # Verificamos se o arquivo existe no banco de dados, e não na pasta de upload, pela simplicidade
-    if FileUpload.select().where(FileUpload.filename == file.filename).count() > 0:
-        log.info(f'Tried to upload existing filename {file.filename} (returned 409)')
-        raise HTTPException(409, 'Filename already exists.')
-
-    file_path = os.path.join(os.getcwd(), 'uploads', file.filename)
-
-    # Lemos o corpo da mensagem pra escrita em disco de forma iterativa, a fim de não estourar
-    # a memória disponível do servidor em caso de um arquivo grande
-    with open(file_path, 'wb') as fd:
-        while True:
-            chunk = file.file.read(1000)
-            fd.write(chunk)
-            if chunk == b'':
-                break
-
-    # Criamos entrada do arquivo no banco de dados
-    FileUpload.create(uploaded_by=current_user, uploaded_at=datetime.now(), filename=file.filename)
-    log.info(f'Successfully created uploaded file {file.filename}')
-
-    return {"filename": file.filename}
+async def upload_file(request: Request, current_user: str = Depends(get_current_user)):
+
+    # Em vez de receber um UploadFile (que faria o Starlette gravar o corpo inteiro num arquivo temporário
+    # antes de chamar a rota), fazemos o parsing do multipart diretamente do stream da requisição e
+    # escrevemos a parte "file" em disco em blocos grandes, calculando o hash do conteúdo durante a escrita.
+    # Toda operação bloqueante (disco e banco de dados) é feita no pool de I/O, pra não travar o event loop e
+    # as outras requisições.
+    #
+    # Conflitos informados pelos cabeçalhos são rejeitados antes de lermos qualquer byte do corpo; um cliente que
+    # envie `Expect: 100-continue` nem chega a transmiti-lo, já que o servidor só responde "100 Continue" quando a
+    # rota começa a ler o corpo.
+    #
+    # O cliente pode informar o hash SHA-256 do arquivo no cabeçalho X-Upload-SHA256 ou numa parte "sha256" depois
+    # do arquivo; ele é comparado com o hash calculado durante a escrita, e um conteúdo diferente é rejeitado antes
+    # de o arquivo ser criado.
+    expected_digest = request.headers.get('x-upload-sha256')
+    if expected_digest is not None:
+        expected_digest = blobs.parse_digest(expected_digest)
+    declared_filename = request.headers.get('x-upload-filename')
+    if declared_filename is not None:
+        declared_filename = unquote(declared_filename)
+        blobs.validate_filename(declared_filename)
+        await run_db(blobs.check_filename, declared_filename, current_user)
+    content_length = request.headers.get('content-length', '')
+    if content_length.isdigit():
+        await run_io(blobs.check_free_space, int(content_length))
+
+    filename = None
+    writer = None
+    part = None  # Parte sendo recebida: 'file', 'sha256', ou None se for ignorada
+    digest_field = bytearray()
+    metrics.UPLOADS_IN_PROGRESS.inc()
+    try:
+        async for event, value in iter_multipart(request):
+            if event is PartEvent.BEGIN:
+                part = None
+                if value.name == 'sha256':
+                    part = 'sha256'
+                if value.name != 'file' or value.filename is None or filename is not None:
+                    continue
+
+                part = 'file'
+                filename = value.filename
+                blobs.validate_filename(filename)
+                if declared_filename is not None and filename != declared_filename:
+                    raise HTTPException(400, 'File name does not match the X-Upload-Filename header.')
+
+                # Verificamos se o arquivo existe no banco de dados, e não na pasta de upload, pela simplicidade
+                await run_db(blobs.check_filename, filename, current_user)
+
+                writer = await AsyncFileWriter(await run_io(blobs.temp_path), hasher=blobs.new_hasher()).open()
+            elif event is PartEvent.DATA and part == 'file':
+                await writer.write(value)
+            elif event is PartEvent.DATA and part == 'sha256':
+                digest_field += value
+                if len(digest_field) > 128:
+                    raise HTTPException(400, 'Invalid SHA-256 digest.')
+            elif event is PartEvent.END and part == 'file':
+                await writer.close()
+    except BaseException:
+        # Não deixamos arquivos parciais para trás se o upload falhar no meio (ex.: conexão perdida)
+        if writer is not None:
+            await writer.abort()
+        raise
+    finally:
+        metrics.UPLOADS_IN_PROGRESS.dec()
+
+    if filename is None:
+        raise HTTPException(422, 'Missing file field.')
+
+    # Criamos entrada do arquivo no banco de dados, armazenando o conteúdo se ele ainda não existir
+    try:
+        if digest_field:
+            expected_digest = blobs.parse_digest(digest_field.decode('ascii', 'replace'))
+        blobs.check_digest(expected_digest, writer.hasher.hexdigest(), filename)
+        await run_db(blobs.store_file, filename, current_user, writer.path, writer.hasher.hexdigest(),
+                     writer.bytes_written)
+    except BaseException:
+        await run_io(remove_if_exists, writer.path)
+        raise
+    catalog.catalog_changed()
+    metrics.UPLOADED_FILES.inc(labels=('upload',))
+    metrics.UPLOAD_SIZE.observe(writer.bytes_written)
+    log.info('Successfully created uploaded file %s', filename,
+             extra={'file': filename, 'bytes': writer.bytes_written})
+
+    return {"filename": filename}
+
+
+# Upload de vários arquivos numa única requisição, como partes "file" repetidas de um corpo multipart. Cada
+# arquivo é gravado num temporário conforme chega (os pequenos, inteiros numa só operação de disco), e todas as
+# entradas são criadas no final, numa única transação. A resposta traz o resultado de cada arquivo: um conflito
+# (ex.: nome já existente) rejeita só aquele arquivo, com o status que ele teria em /upload. Uma parte "sha256"
+# logo depois de um arquivo traz o hash dele, conferido como em /upload.
+@app.post('/upload/batch')
+async def upload_batch(request: Request, current_user: str = Depends(get_current_user)):
+    content_length = request.headers.get('content-length', '')
+    if content_length.isdigit():
+        await run_io(blobs.check_free_space, int(content_length))
+
+    uploads = []  # (nome, caminho, hash, tamanho), como em blobs.create_files
+    rejected = {}  # Posição em `uploads` -> resultado, pros arquivos com hash diferente do informado
+    filename = None
+    data = None
+    writer = None
+    digest_field = None
+    metrics.UPLOADS_IN_PROGRESS.inc()
+    try:
+        async for event, value in iter_multipart(request):
+            if event is PartEvent.BEGIN:
+                filename = value.filename if value.name == 'file' else None
+                if filename is not None and len(uploads) >= BATCH_MAX_FILES:
+                    raise HTTPException(413, f'Too many files in batch (maximum {BATCH_MAX_FILES}).')
+                if filename is not None:
+                    blobs.validate_filename(filename)
+                data = bytearray()
+                digest_field = bytearray() if value.name == 'sha256' and uploads else None
+            elif event is PartEvent.DATA and digest_field is not None:
+                digest_field += value
+                if len(digest_field) > 128:
+                    raise HTTPException(400, 'Invalid SHA-256 digest.')
+            elif event is PartEvent.END and digest_field is not None:
+                name, path, digest, _ = uploads[-1]
+                try:
+                    blobs.check_digest(blobs.parse_digest(digest_field.decode('ascii', 'replace')), digest, name)
+                except HTTPException as error:
+                    rejected[len(uploads) - 1] = {'filename': name, 'status': error.status_code,
+                                                  'detail': error.detail}
+                    await run_io(remove_if_exists, path)
+                digest_field = None
+            elif event is PartEvent.DATA and filename is not None:
+                if writer is None and not data:
+                    # Um arquivo de até UPLOAD_BUFFER_SIZE bytes chega num único bloco
+                    data = value
+                    continue
+                if writer is None:
+                    writer = await AsyncFileWriter(await run_io(blobs.temp_path), hasher=blobs.new_hasher()).open()
+                    await writer.write(data)
+                await writer.write(value)
+            elif event is PartEvent.END and filename is not None:
+                if writer is not None:
+                    await writer.close()
+                    uploads.append((filename, writer.path, writer.hasher.hexdigest(), writer.bytes_written))
+                    writer = None
+                else:
+                    path, digest = await run_io(blobs.write_temp_file, data)
+                    uploads.append((filename, path, digest, len(data)))
+                filename = None
+    except BaseException:
+        if writer is not None:
+            await writer.abort()
+        for _, path, _, _ in uploads:
+            await run_io(remove_if_exists, path)
+        raise
+    finally:
+        metrics.UPLOADS_IN_PROGRESS.dec()
+
+    if not uploads:
+        raise HTTPException(422, 'Missing file field.')
+
+    created_results = iter(await run_db(blobs.create_files, current_user,
+                                        [upload for i, upload in enumerate(uploads) if i not in rejected]))
+    results = [rejected[i] if i in rejected else next(created_results) for i in range(len(uploads))]
+    created = sum(result['status'] == 200 for result in results)
+    if created:
+        catalog.catalog_changed()
+        metrics.UPLOADED_FILES.inc(created, ('batch',))
+    log.info('Created %d of %d files from batch upload by %s', created, len(results), current_user)
+    return {'files': results}
+
+
+# Reservar um nome de arquivo antes do upload. Se o nome já existir, estiver reservado por outro usuário ou não
+# houver espaço em disco pro tamanho informado, o cliente fica sabendo antes de enviar qualquer byte.
+@app.post('/upload/reserve')
+async def reserve_filename(reservation_in: ReservationModel, current_user: str = Depends(get_current_user)):
+    reservation = await run_db(blobs.reserve_filename, reservation_in.filename, current_user, reservation_in.size)
+    log.info('Reserved filename %s for %s', reservation.filename, current_user)
+    return {'filename': reservation.filename, 'size': reservation.size, 'expires_at': reservation.expires_at}
+
+
+# Verificar se um conteúdo já está armazenado no servidor, pelo seu hash SHA-256. Se estiver, o cliente pode
+# criar o arquivo com /upload/by-hash sem enviar os bytes.
+@app.get('/blobs/{digest}')
+async def get_blob(digest: str, current_user: str = Depends(get_current_user)):
+    blob = await run_db(Blob.get_or_none, Blob.digest == digest)
+    if blob is None:
+        raise HTTPException(404, 'Content not found.')
+    return {'sha256': blob.digest, 'size': blob.size}
+
+
+# Criar um arquivo a partir de um conteúdo já armazenado. Como a lista de arquivos e seus conteúdos já são
+# visíveis a todos os usuários logados, conhecer o hash não dá acesso a nada que já não estivesse disponível.
+@app.post('/upload/by-hash')
+async def upload_file_by_hash(file_in: LinkFileModel, current_user: str = Depends(get_current_user)):
+    await run_db(blobs.link_file, file_in.filename, current_user, file_in.sha256)
+    catalog.catalog_changed()
+    metrics.UPLOADED_FILES.inc(labels=('by-hash',))
+    log.info('Successfully created file %s from stored content %s', file_in.filename, file_in.sha256)
+    return {'filename': file_in.filename}
+
+
+# Baixar um arquivo. O conteúdo de um blob nunca muda, então seu hash serve de ETag forte, e o arquivo pode ser
+# baixado em intervalos (Range), por exemplo em paralelo ou retomando um download interrompido.
+@app.api_route('/files/{filename}', methods=['GET', 'HEAD'])
+async def download_file(filename: str, request: Request, current_user: str = Depends(get_current_user)):
+    file_upload = await run_db(blobs.get_file, filename)
+    etag = f'"{file_upload.blob_id}"' if file_upload.blob_id is not None else None
+    content = await run_io(blobs.open_content, file_upload)
+    return await downloads.file_response(request, content, filename, file_upload.uploaded_at, etag,
+                                         file_upload.blob_id)
+
+
+# Métricas do servidor no formato do Prometheus (ver metrics.py). Não exigem login, pra que o Prometheus possa
+# coletá-las; não contêm nomes de arquivos nem de usuários.
+@app.get('/metrics')
+async def get_metrics():
+    return Response(await run_io(metrics.render), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Perfis gravados de requisições profiladas (ver profiling.py), só com o cabeçalho X-Profile-Token
+@app.get('/profiles')
+async def get_profiles(request: Request):
+    profiling.check_token(request)
+    return {'profiles': await run_io(profiling.list_profiles)}
+
+
+@app.get('/profiles/{name}')
+async def get_profile(name: str, request: Request):
+    profiling.check_token(request)
+    return Response(await run_io(profiling.read_profile, name), media_type='application/octet-stream',
+                    headers={'Content-Disposition': f'attachment; filename="{name}"'})
+
+
+# Remover um arquivo enviado pelo usuário atual
+@app.delete('/files/{filename}')
+async def delete_file(filename: str, current_user: str = Depends(get_current_user)):
+    await run_db(blobs.delete_file, filename, current_user)
+    catalog.catalog_changed()
+    log.info('Deleted file %s', filename)
+    return {'filename': filename}
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="localhost", port=8000, reload=True)
+    # Servidor de desenvolvimento, com um só processo; em produção use serve.py. Os logs do uvicorn também passam
+    # pela fila de logs, e o log de acesso é o do RequestLogMiddleware.
+    uvicorn.run("main:app", host="localhost", port=8000, reload=True, logger=log, access_log=False)
@@ -0,0 +1,297 @@
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Optional, Tuple
+
+from config import METRICS_DIR
+
+# Métricas do servidor, expostas em GET /metrics no formato de texto do Prometheus. São só contadores em memória,
+# atualizados sob um lock curto, então podem ficar ligadas em produção: o custo por requisição é de poucos
+# microssegundos, e a formatação só acontece quando alguém lê /metrics.
+#
+# Com vários processos (serve.py), cada um grava periodicamente suas métricas num arquivo em `directory`, e quem
+# atende /metrics soma as de todos. Contadores e histogramas de processos que já terminaram continuam somados, pra
+# que os totais nunca diminuam; gauges só valem enquanto o processo existir. Os arquivos são identificados pelo pid e
+# pelo horário de início do processo, já que um processo novo pode receber o pid de um que terminou.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(11))  # 1 KiB a 1 GiB
+
+# Pasta compartilhada pelos processos do servidor, ou None com um só processo
+directory: Optional[str] = METRICS_DIR
+
+_registry = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def samples(self) -> dict:
+        with self._lock:
+            return {labels: self._copy(value) for labels, value in self._values.items()}
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: tuple = ()) -> None:
+        self.inc(-amount, labels)
+
+    def set(self, value: float, labels: tuple = ()) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        # Cada observação conta só no seu intervalo; a contagem acumulada do formato do Prometheus sai na exposição
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, labels: tuple = ()):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, labels)
+
+    def _copy(self, value):
+        return [list(value[0]), value[1]]
+
+
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP requests handled.', ('method', 'route', 'status'))
+HTTP_DURATION = Histogram('http_request_duration_seconds', 'Time to handle an HTTP request, until the last byte of '
+                          'the response is sent.', ('method', 'route'))
+HTTP_IN_PROGRESS = Gauge('http_requests_in_progress', 'HTTP requests being handled.')
+
+UPLOAD_RECEIVED_BYTES = Counter('upload_received_bytes_total', 'Upload request body bytes received, as sent by the '
+                                'client (compressed, if it was).')
+UPLOADS_IN_PROGRESS = Gauge('uploads_in_progress', 'Upload requests whose body is being received.')
+UPLOADED_FILES = Counter('uploaded_files_total', 'Files created by uploads.', ('method',))
+UPLOAD_SIZE = Histogram('upload_file_size_bytes', 'Size of files created by POST /upload.', buckets=SIZE_BUCKETS)
+
+FILES_QUERY_DURATION = Histogram('files_query_duration_seconds', 'Time spent querying a page of GET /files.')
+
+PASSWORD_DURATION = Histogram('password_hash_duration_seconds', 'Argon2 computation time.', ('operation',))
+PASSWORD_WAIT_DURATION = Histogram('password_hash_wait_seconds', 'Total time of a password hashing call, including '
+                                   'the wait for a free process.', ('operation',))
+PASSWORD_PENDING = Gauge('password_hash_pending', 'Password hashing calls running or waiting.')
+
+DB_QUERY_DURATION = Histogram('db_query_duration_seconds', 'Database statement execution time.', ('statement',))
+
+
+def instrument_database(db) -> None:
+    """Mede o tempo de cada comando executado por `db`, pelo tipo (SELECT, INSERT...)."""
+    execute_sql = db.execute_sql
+
+    def timed_execute_sql(sql, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return execute_sql(sql, *args, **kwargs)
+        finally:
+            DB_QUERY_DURATION.observe(perf_counter() - start, (sql.split(None, 1)[0].upper(),))
+
+    db.execute_sql = timed_execute_sql
+
+
+class MetricsMiddleware:
+    """Conta as requisições HTTP e mede sua duração, por rota (o padrão da rota, ex.: /files/{filename}, pra que
+    o número de séries não cresça com os nomes de arquivos)."""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        HTTP_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_IN_PROGRESS.dec()
+            route = self._route(scope)
+            HTTP_REQUESTS.inc(labels=(scope['method'], route, str(status)))
+            HTTP_DURATION.observe(perf_counter() - start, (scope['method'], route))
+
+    def _route(self, scope) -> str:
+        # O roteador do Starlette deixa a função da rota encontrada em scope['endpoint']
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        if self._routes is None:
+            self._routes = {getattr(route, 'endpoint', None): route.path for route in scope['app'].routes}
+        return self._routes.get(endpoint, 'unmatched')
+
+
+def _snapshot() -> Dict[str, dict]:
+    return {metric.name: metric.samples() for metric in _registry}
+
+
+# (pid, horário de início) deste processo; recalculado depois de um fork
+_instance: Optional[Tuple[int, int]] = None
+
+
+def _current_instance() -> Tuple[int, int]:
+    global _instance
+    if _instance is None or _instance[0] != os.getpid():
+        _instance = (os.getpid(), time.time_ns())
+    return _instance
+
+
+def _snapshot_path(pid: int, started: int) -> str:
+    return os.path.join(directory, f'{pid}-{started}.json')
+
+
+def write_snapshot() -> None:
+    """Grava as métricas deste processo em `directory`, pros outros processos."""
+    pid, started = _current_instance()
+    data = {'pid': pid, 'started': started,
+            'metrics': {name: [[list(labels), value] for labels, value in samples.items()]
+                        for name, samples in _snapshot().items()}}
+    path = _snapshot_path(pid, started)
+    with open(path + '.tmp', 'w') as fd:
+        json.dump(data, fd)
+    os.replace(path + '.tmp', path)
+
+
+def clear_directory() -> None:
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect() -> Dict[str, dict]:
+    """Métricas deste processo, somadas às dos outros processos do servidor, se houver."""
+    merged = _snapshot()
+    if directory is None:
+        return merged
+
+    write_snapshot()
+    kinds = {metric.name: metric.kind for metric in _registry}
+    snapshots = []
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as fd:
+                snapshots.append(json.load(fd))
+        except (OSError, ValueError):
+            continue
+    # Com o mesmo pid, só o processo iniciado por último pode estar vivo
+    latest = {}
+    for data in snapshots:
+        latest[data['pid']] = max(latest.get(data['pid'], 0), data.get('started', 0))
+
+    for data in snapshots:
+        if (data['pid'], data.get('started', 0)) == _current_instance():
+            continue
+        alive = data.get('started', 0) == latest[data['pid']] and _is_alive(data['pid'])
+        for name, samples in data['metrics'].items():
+            kind = kinds.get(name)
+            if kind is None or (kind == 'gauge' and not alive):
+                continue
+            target = merged[name]
+            for labels, value in samples:
+                labels = tuple(labels)
+                current = target.get(labels)
+                if kind != 'histogram':
+                    target[labels] = (current or 0) + value
+                elif current is None:
+                    target[labels] = value
+                else:
+                    target[labels] = [[a + b for a, b in zip(current[0], value[0])], current[1] + value[1]]
+    return merged
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+def _format_number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render() -> str:
+    """As métricas no formato de texto do Prometheus (versão 0.0.4)."""
+    samples = collect()
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for labels, value in sorted(samples[metric.name].items()):
+            if metric.kind != 'histogram':
+                lines.append(f'{metric.name}{_format_labels(metric.labelnames, labels)} {_format_number(value)}')
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = _format_labels(metric.labelnames + ('le',), labels + (bound,))
+                lines.append(f'{metric.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{metric.name}_sum{_format_labels(metric.labelnames, labels)} {_format_number(total)}')
+            lines.append(f'{metric.name}_count{_format_labels(metric.labelnames, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
@@ -0,0 +1,97 @@
+"""Migra os arquivos armazenados no formato antigo pro backend de armazenamento atual (ver storage.py).
+
+Uso: python migrate_storage.py [--dry-run]
+
+São migrados:
+- os arquivos enviados antes do armazenamento por conteúdo, guardados em UPLOAD_DIR com o próprio nome: cada um
+  é armazenado como blob (ou ligado ao blob já existente com o mesmo conteúdo) e sua entrada passa a apontar pra
+  ele;
+- os blobs guardados diretamente em UPLOAD_DIR/.blobs, antes da divisão em subpastas, que são movidos pro lugar
+  atual no backend (subpastas, ou o object store de STORAGE_URL).
+
+Pode ser executado com o servidor no ar e interrompido a qualquer momento: cada arquivo é migrado numa transação
+própria, e uma nova execução continua de onde a anterior parou.
+"""
+import argparse
+import os
+import re
+import sys
+from datetime import datetime
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVER_DIR)
+
+import blobs  # noqa: E402
+import storage  # noqa: E402
+from config import UPLOAD_DIR  # noqa: E402
+from database import db, write_transaction, Blob, FileUpload  # noqa: E402
+from utils import log, remove_if_exists  # noqa: E402
+
+FLAT_BLOB_DIR = os.path.join(UPLOAD_DIR, '.blobs')
+DIGEST_PATTERN = re.compile('^[0-9a-f]{64}$')
+
+
+def migrate_legacy_file(file_upload: FileUpload) -> bool:
+    path = blobs.legacy_path(file_upload.filename)
+    if not os.path.isfile(path):
+        log.warning('Legacy file %s is missing, skipping', file_upload.filename)
+        return False
+
+    digest = blobs.hash_file(path)
+    # Uma cópia, pra que o original só seja removido depois da transação
+    staged = blobs.staged_copy(path)
+    try:
+        with write_transaction():
+            updated = (FileUpload.update(blob=digest)
+                       .where((FileUpload.filename == file_upload.filename) & FileUpload.blob.is_null())
+                       .execute())
+            if not updated:
+                # O arquivo foi removido ou migrado por outro processo nesse meio tempo
+                return False
+            already_stored = Blob.update(refcount=Blob.refcount + 1).where(Blob.digest == digest).execute() > 0
+            if not already_stored:
+                Blob.create(digest=digest, size=os.path.getsize(staged), refcount=1, created_at=datetime.now())
+                storage.backend.put(digest, staged)
+    finally:
+        remove_if_exists(staged)
+    remove_if_exists(path)
+    return True
+
+
+def migrate_flat_blob(digest: str) -> None:
+    storage.backend.put(digest, os.path.join(FLAT_BLOB_DIR, digest))
+
+
+def flat_blobs() -> list:
+    if not os.path.isdir(FLAT_BLOB_DIR):
+        return []
+    return [entry.name for entry in os.scandir(FLAT_BLOB_DIR)
+            if entry.is_file() and DIGEST_PATTERN.match(entry.name)]
+
+
+def migrate(dry_run: bool = False) -> dict:
+    legacy_files = list(FileUpload.select().where(FileUpload.blob.is_null()))
+    digests = flat_blobs()
+    log.info('Found %d legacy files and %d unsharded blobs to migrate', len(legacy_files), len(digests))
+    if dry_run:
+        return {'legacy_files': len(legacy_files), 'flat_blobs': len(digests)}
+
+    migrated_files = sum(migrate_legacy_file(file_upload) for file_upload in legacy_files)
+    for count, digest in enumerate(digests, 1):
+        migrate_flat_blob(digest)
+        if count % 1000 == 0:
+            log.info('Migrated %d of %d blobs', count, len(digests))
+    log.info('Migrated %d legacy files and %d blobs', migrated_files, len(digests))
+    return {'legacy_files': migrated_files, 'flat_blobs': len(digests)}
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='only count what would be migrated')
+    args = parser.parse_args()
+    with db.connection_context():
+        migrate(args.dry_run)
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,6 +1,9 @@
 from pydantic import BaseModel, Schema
 from pydantic.types import SecretStr
 
+# Tamanho máximo de um nome de arquivo, em todas as rotas de upload
+MAX_FILENAME_LENGTH = 255
+
 
 # Modelo de entrada da API (corpo da requisição deve conter campos "username" e "password"
 class UserModel(BaseModel):
@@ -10,3 +13,25 @@ class UserModel(BaseModel):
     # da senha do usuário; quando printada, ela produz somente "*******". Pra conseguir seu valor real é
     # necessário chamar um método específico do objeto.
     password: SecretStr = ...
+
+
+# Criação de uma sessão de upload retomável; `size` é opcional, mas permite validar o tamanho na finalização.
+# Com `part_size`, o upload é feito em partes numeradas desse tamanho (a última pode ser menor), e `size`
+# passa a ser obrigatório. `sha256`, também opcional, é comparado com o hash do conteúdo recebido na finalização.
+class UploadSessionModel(BaseModel):
+    filename: str = Schema(..., min_length=1, max_length=MAX_FILENAME_LENGTH)
+    size: int = Schema(None, ge=0)
+    part_size: int = Schema(None, ge=1)
+    sha256: str = Schema(None, regex='^[0-9a-f]{64}$')
+
+
+# Criação de um arquivo a partir de conteúdo já armazenado no servidor, identificado pelo hash SHA-256
+class LinkFileModel(BaseModel):
+    filename: str = Schema(..., min_length=1, max_length=MAX_FILENAME_LENGTH)
+    sha256: str = Schema(..., regex='^[0-9a-f]{64}$')
+
+
+# Reserva de um nome de arquivo antes do upload; `size`, se informado, é comparado com o espaço livre em disco
+class ReservationModel(BaseModel):
+    filename: str = Schema(..., min_length=1, max_length=MAX_FILENAME_LENGTH)
+    size: int = Schema(None, ge=0)
@@ -0,0 +1,111 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from typing import Optional, Tuple
+
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHash
+from fastapi import HTTPException
+
+import metrics
+import profiling
+from config import (ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM, PASSWORD_WORKERS,
+                    PASSWORD_QUEUE_LIMIT)
+from utils import log
+
+# O Argon2 é feito pra ser caro em CPU e memória, então os hashes de senha são calculados num pool de processos
+# próprio e de tamanho limitado, e não nas threads que atendem as outras rotas. Quando há mais de
+# PASSWORD_QUEUE_LIMIT cálculos pendentes (ex.: uma rajada de logins depois de um deploy), novos pedidos são
+# recusados na hora com 503, em vez de ficarem numa fila cada vez mais longa.
+_executor: Optional[ProcessPoolExecutor] = None
+_pending = 0
+
+# Instância de PasswordHasher de cada processo do pool
+_pw_hasher: Optional[PasswordHasher] = None
+
+
+def _init_worker(time_cost: int, memory_cost: int, parallelism: int) -> None:
+    global _pw_hasher
+    _pw_hasher = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+
+
+def _hash(password: str) -> str:
+    return _pw_hasher.hash(password)
+
+
+# Retorna se a senha confere e, se o hash tiver sido gerado com outros parâmetros, um hash novo com os atuais
+def _verify(password_hash: str, password: str) -> Tuple[bool, Optional[str]]:
+    try:
+        _pw_hasher.verify(password_hash, password)
+    except (VerifyMismatchError, InvalidHash):
+        return False, None
+    if _pw_hasher.check_needs_rehash(password_hash):
+        return True, _pw_hasher.hash(password)
+    return True, None
+
+
+# Executa `func` no processo do pool e retorna também quanto tempo ela levou lá, sem a espera na fila
+def _timed(func, *args):
+    start = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - start
+
+
+# Como `_timed`, mas também com o perfil da execução, pra uma requisição sendo profilada (ver profiling.py)
+def _profiled(func, *args):
+    start = perf_counter()
+    result, stats = profiling.profile_call(func, *args)
+    return result, perf_counter() - start, stats
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Processos criados com spawn, e não fork, não herdam o socket do servidor nem os tratadores de sinais do
+        # event loop, e terminam sozinhos se o processo do servidor morrer, em vez de ficarem com a porta aberta
+        _executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_init_worker,
+                                        initargs=(ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM))
+    return _executor
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+
+
+async def _run(operation: str, func, *args):
+    global _pending
+    if _pending >= PASSWORD_QUEUE_LIMIT:
+        log.info('Password hashing queue is full (returned 503)')
+        raise HTTPException(503, 'Server is busy, try again later.', headers={'Retry-After': '1'})
+
+    _pending += 1
+    metrics.PASSWORD_PENDING.set(_pending)
+    try:
+        profile = profiling.current.get()
+        with metrics.PASSWORD_WAIT_DURATION.time((operation,)):
+            if profile is None:
+                result, duration = await asyncio.get_event_loop().run_in_executor(get_executor(), _timed, func,
+                                                                                  *args)
+            else:
+                result, duration, stats = await asyncio.get_event_loop().run_in_executor(get_executor(), _profiled,
+                                                                                         func, *args)
+                profile.add_stats(stats)
+        metrics.PASSWORD_DURATION.observe(duration, (operation,))
+        return result
+    finally:
+        _pending -= 1
+        metrics.PASSWORD_PENDING.set(_pending)
+
+
+async def hash_password(password: str) -> str:
+    return await _run('hash', _hash, password)
+
+
+async def verify_password(password_hash: str, password: str) -> Tuple[bool, Optional[str]]:
+    """Verifica a senha; retorna se ela confere e, se for preciso atualizar o hash armazenado, o hash novo."""
+    return await _run('verify', _verify, password_hash, password)
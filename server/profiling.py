@@ -0,0 +1,227 @@
+import asyncio
+import cProfile
+import contextvars
+import functools
+import hmac
+import os
+import pstats
+import random
+import re
+import threading
+from datetime import datetime
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from config import PROFILE_TOKEN, PROFILE_SAMPLE_RATE, PROFILE_DIR, PROFILE_MAX_FILES, PROFILE_MAX_SECONDS
+from utils import log
+
+# Profiling opcional de requisições selecionadas, pra descobrir onde foi o tempo de um /upload ou /login lento.
+# Uma requisição é profilada se trouxer o cabeçalho X-Profile-Token com o valor de PROFILE_TOKEN, ou por
+# amostragem, com probabilidade PROFILE_SAMPLE_RATE. O perfil (formato do pstats, ex.: `python -m pstats arquivo`
+# ou snakeviz) é gravado em `directory` e pode ser baixado em GET /profiles/{nome}, com o mesmo cabeçalho.
+#
+# O perfil junta o event loop (parsing do multipart, rotas), as funções executadas pelo pool de I/O em nome da
+# requisição (peewee, escritas em disco, hash do conteúdo) e o Argon2, calculado no processo do pool de senhas. Só uma
+# requisição é profilada por vez em cada processo; o perfil do event loop inclui também o que as outras requisições
+# fizeram nele enquanto isso, então a amostragem ignora as rotas que ficam abertas por muito tempo (o feed de mudanças e
+# os downloads), e todo perfil é encerrado depois de `max_seconds`. Desligado (o padrão), o custo é uma comparação por
+# requisição e uma leitura de contextvar por chamada ao pool de I/O.
+
+token: Optional[str] = PROFILE_TOKEN
+sample_rate: float = PROFILE_SAMPLE_RATE
+directory: str = PROFILE_DIR
+max_seconds: float = PROFILE_MAX_SECONDS
+
+PROFILE_NAME = re.compile(r'[\w.-]+\.prof')
+
+# Rotas cujas respostas podem durar indefinidamente (o feed de mudanças e os downloads, com GET ou HEAD), que não
+# entram na amostragem; DELETE /files/{nome}, rápido, continua entrando
+LONG_RUNNING_PATHS = re.compile(r'/events|/files/.+')
+LONG_RUNNING_METHODS = ('GET', 'HEAD')
+
+# Perfil da requisição sendo atendida no contexto atual, se ela estiver sendo profilada
+current: contextvars.ContextVar = contextvars.ContextVar('profile', default=None)
+
+# Se há uma requisição sendo profilada neste processo; só é alterado no event loop
+_active = False
+
+
+class RequestProfile:
+    """Perfil de uma requisição: o do event loop, mais os das chamadas feitas em outras threads e processos."""
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.stopped = False
+        self._parts = []
+        self._lock = threading.Lock()
+
+    def run(self, func: Callable, *args, **kwargs):
+        """Executa `func` (numa thread do pool de I/O) registrando seu perfil."""
+        if self.stopped:
+            return func(*args, **kwargs)
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # A partir do Python 3.12 só pode haver um profiler ativo, e o do event loop já vê todas as threads
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with self._lock:
+                self._parts.append(profiler)
+
+    def add_stats(self, stats: dict) -> None:
+        """Acrescenta estatísticas já coletadas em outro processo (ver `profile_call`)."""
+        with self._lock:
+            self._parts.append(SimpleNamespace(stats=stats, create_stats=lambda: None))
+
+    def dump(self, path: str) -> None:
+        stats = pstats.Stats(self.profiler)
+        with self._lock:
+            if self._parts:
+                stats.add(*self._parts)
+        stats.dump_stats(path)
+
+
+def wrap(func: Callable) -> Callable:
+    """Retorna `func` preparada pra rodar noutra thread em nome da requisição atual: se ela estiver sendo
+    profilada, a chamada entra no seu perfil. Deve ser chamada no event loop."""
+    profile = current.get()
+    if profile is None or profile.stopped:
+        return func
+    return functools.partial(profile.run, func)
+
+
+def profile_call(func: Callable, *args):
+    """Executa `func` com o profiler ligado e retorna o resultado e as estatísticas, que podem ser enviadas de
+    volta a outro processo e passadas a `RequestProfile.add_stats`."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = func(*args)
+    finally:
+        profiler.disable()
+    profiler.create_stats()
+    return result, profiler.stats
+
+
+def check_token(request: Request) -> None:
+    """Permite o acesso só com o cabeçalho X-Profile-Token correto; sem PROFILE_TOKEN, os perfis não existem."""
+    if token is None:
+        raise HTTPException(404, 'Not Found')
+    if not hmac.compare_digest(request.headers.get('x-profile-token', ''), token):
+        raise HTTPException(403, 'Invalid profiling token.')
+
+
+def list_profiles() -> List[dict]:
+    """Perfis gravados, do mais recente pro mais antigo. Faz I/O bloqueante."""
+    try:
+        entries = [entry for entry in os.scandir(directory) if PROFILE_NAME.fullmatch(entry.name)]
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    return [{'name': entry.name, 'size': entry.stat().st_size,
+             'created_at': datetime.fromtimestamp(entry.stat().st_mtime)} for entry in entries]
+
+
+def read_profile(name: str) -> bytes:
+    """Conteúdo de um perfil gravado. Faz I/O bloqueante."""
+    if not PROFILE_NAME.fullmatch(name):
+        raise HTTPException(404, 'Profile not found.')
+    try:
+        with open(os.path.join(directory, name), 'rb') as fd:
+            return fd.read()
+    except FileNotFoundError:
+        raise HTTPException(404, 'Profile not found.')
+
+
+def _save(profile: RequestProfile, name: str) -> None:
+    os.makedirs(directory, exist_ok=True)
+    profile.dump(os.path.join(directory, name))
+
+    # Mantemos só os PROFILE_MAX_FILES perfis mais recentes
+    for old in list_profiles()[PROFILE_MAX_FILES:]:
+        try:
+            os.remove(os.path.join(directory, old['name']))
+        except FileNotFoundError:
+            pass
+
+
+class ProfilingMiddleware:
+    """Profila as requisições selecionadas, do início até o envio do último byte da resposta, cujo cabeçalho
+    X-Profile-Id traz o nome do perfil gravado."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _selected(self, scope) -> bool:
+        if token is None and sample_rate <= 0:
+            return False
+        if token is not None:
+            for name, value in scope['headers']:
+                if name == b'x-profile-token':
+                    return hmac.compare_digest(value, token.encode())
+        if scope['method'] in LONG_RUNNING_METHODS and LONG_RUNNING_PATHS.fullmatch(scope['path']):
+            return False
+        return sample_rate > 0 and random.random() < sample_rate
+
+    async def __call__(self, scope, receive, send):
+        global _active
+        if scope['type'] != 'http' or _active or not self._selected(scope):
+            await self.app(scope, receive, send)
+            return
+
+        path = re.sub(r'[^\w-]+', '_', scope['path']).strip('_')[:60] or 'root'
+        name = f'{datetime.now():%Y%m%dT%H%M%S%f}-{os.getpid()}-{scope["method"]}-{path}.prof'
+
+        async def send_with_id(message):
+            if message['type'] == 'http.response.start':
+                message = dict(message, headers=list(message.get('headers', [])) +
+                               [(b'x-profile-id', name.encode())])
+            await send(message)
+
+        profile = RequestProfile()
+        reset_token = current.set(profile)
+        _active = True
+        start = perf_counter()
+        profile.profiler.enable()
+        # Passado o limite, o perfil é encerrado e gravado, e a requisição continua sem ele
+        timer = asyncio.get_event_loop().call_later(max_seconds, self._time_out, profile, scope, start, name)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            timer.cancel()
+            current.reset(reset_token)
+            if self._stop(profile, scope, start, name):
+                await _save_async(profile, name)
+
+    def _time_out(self, profile: RequestProfile, scope, start: float, name: str) -> None:
+        if self._stop(profile, scope, start, name):
+            asyncio.ensure_future(_save_async(profile, name))
+
+    @staticmethod
+    def _stop(profile: RequestProfile, scope, start: float, name: str) -> bool:
+        """Encerra o perfil, se ainda não tiver sido encerrado, e retorna se o fez. Deve ser chamada no event loop."""
+        global _active
+        if profile.stopped:
+            return False
+        profile.profiler.disable()
+        profile.stopped = True
+        _active = False
+        log.info('Profiled %s %s for %.3f s: %s', scope['method'], scope['path'], perf_counter() - start, name)
+        return True
+
+
+async def _save_async(profile: RequestProfile, name: str) -> None:
+    # O perfil é gravado no pool de I/O, sem segurar o event loop; importado aqui por depender deste módulo
+    from threadpool import run_io
+    try:
+        await run_io(_save, profile, name)
+    except Exception:
+        log.exception('Failed to save request profile')
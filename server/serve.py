@@ -0,0 +1,176 @@
+"""Servidor de produção, com vários processos atendendo a mesma porta.
+
+Uso: python serve.py [--host 0.0.0.0] [--port 8000] [--workers N] [--graceful-timeout 30]
+
+A aplicação é importada uma vez, no processo principal, antes de criar os processos de trabalho, que a herdam
+já carregada. O processo principal recria os que terminarem inesperadamente. Ao receber SIGTERM ou SIGINT (Ctrl+C),
+ele pede a cada processo que pare de aceitar conexões e termine as requisições em andamento, esperando no máximo
+`--graceful-timeout` segundos; um segundo sinal encerra tudo na hora.
+
+Todo o estado compartilhado entre requisições (sessões de upload e seus locks, reservas de nomes, versão do
+catálogo, eventos) fica no banco de dados, então qualquer processo pode atender qualquer requisição. Com mais de
+um processo, prefira o PostgreSQL (`DATABASE_URL`); o SQLite em modo WAL também funciona, mas serializa as escritas.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import uvicorn
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SERVER_DIR)
+
+from config import SERVER_WORKERS, GRACEFUL_TIMEOUT  # noqa: E402
+import logs  # noqa: E402
+from utils import log  # noqa: E402
+
+# Um processo que termina antes disso é recriado só depois de uma pausa, pra não ficar num ciclo de falhas
+MIN_WORKER_LIFETIME = 1.0
+
+
+class WorkerServer(uvicorn.Server):
+    """Servidor de um processo de trabalho; desligado pelo processo principal com SIGTERM."""
+
+    def __init__(self, config: uvicorn.Config, graceful_timeout: float):
+        super().__init__(config)
+        self.graceful_timeout = graceful_timeout
+
+    def install_signal_handlers(self):
+        # O Ctrl+C do terminal chega a todos os processos; só o principal o trata, e repassa SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, self.handle_exit, signal.SIGTERM, None)
+
+    def handle_exit(self, sig, frame):
+        from events import notifier
+
+        if not self.should_exit:
+            # Os feeds de eventos nunca terminam sozinhos, e a espera pelas conexões abertas tem um limite
+            notifier.close()
+            asyncio.get_event_loop().call_later(self.graceful_timeout, self._force_exit)
+        super().handle_exit(sig, frame)
+
+    def _force_exit(self):
+        log.warning('Graceful shutdown timed out, closing remaining connections')
+        self.force_exit = True
+
+
+class Supervisor:
+    def __init__(self, config: uvicorn.Config, workers: int, graceful_timeout: float):
+        self.config = config
+        self.workers = workers
+        self.graceful_timeout = graceful_timeout
+        self.sockets = []
+        self.children = {}  # pid -> instante de criação
+        self.stopping = False
+        self.killing = False
+
+    def spawn(self) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                WorkerServer(self.config, self.graceful_timeout).run(sockets=self.sockets)
+            except BaseException:
+                log.exception('Worker crashed')
+                code = 1
+            finally:
+                # os._exit não executa os tratadores do atexit, então escrevemos os logs pendentes antes
+                logs.stop()
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+
+    def handle_signal(self, sig, frame) -> None:
+        if self.stopping:
+            self.killing = True
+        self.stopping = True
+
+    def reap(self) -> list:
+        """Retorna os processos que terminaram, sem bloquear."""
+        finished = []
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            started = self.children.pop(pid, None)
+            if started is not None:
+                finished.append((pid, status, started))
+        return finished
+
+    def run(self) -> None:
+        import metrics
+        from database import db
+
+        # Os processos somam as métricas uns dos outros por arquivos numa pasta compartilhada
+        temporary_metrics_dir = None
+        if metrics.directory is None:
+            metrics.directory = temporary_metrics_dir = tempfile.mkdtemp(prefix='upload-server-metrics-')
+        else:
+            os.makedirs(metrics.directory, exist_ok=True)
+            metrics.clear_directory()
+
+        self.sockets = [self.config.bind_socket()]
+        # Os processos não podem compartilhar conexões com o banco de dados abertas durante a importação
+        if not db.is_closed():
+            db.close()
+        db.close_all()
+
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        for _ in range(self.workers):
+            self.spawn()
+        log.info('Started %d workers [%s]', self.workers, ', '.join(str(pid) for pid in self.children))
+
+        while not self.stopping:
+            for pid, status, started in self.reap():
+                log.warning('Worker %d exited unexpectedly (status %d), restarting', pid, status)
+                if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                    time.sleep(MIN_WORKER_LIFETIME)
+                if not self.stopping:
+                    self.spawn()
+            time.sleep(0.2)
+
+        log.info('Shutting down %d workers', len(self.children))
+        for pid in self.children:
+            os.kill(pid, signal.SIGTERM)
+        # Os processos encerram as conexões restantes sozinhos depois de graceful_timeout; o prazo extra cobre o
+        # desligamento da aplicação
+        deadline = time.monotonic() + self.graceful_timeout + 5
+        while self.children and not self.killing and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.children:
+            log.warning('Killing worker %d', pid)
+            os.kill(pid, signal.SIGKILL)
+        while self.children:
+            pid, _ = os.wait()
+            self.children.pop(pid, None)
+        for sock in self.sockets:
+            sock.close()
+        if temporary_metrics_dir is not None:
+            shutil.rmtree(temporary_metrics_dir, ignore_errors=True)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS)
+    parser.add_argument('--graceful-timeout', type=float, default=GRACEFUL_TIMEOUT)
+    args = parser.parse_args()
+
+    # Carregada antes de criar os processos, que a recebem pronta e compartilham sua memória
+    import main
+
+    # O uvicorn loga pelo nosso logger, sem bloquear; o log de acesso é o do RequestLogMiddleware
+    config = uvicorn.Config(main.app, host=args.host, port=args.port, lifespan='on', logger=log, access_log=False)
+    Supervisor(config, max(1, args.workers), args.graceful_timeout).run()
+
+
+if __name__ == '__main__':
+    cli()
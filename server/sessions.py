@@ -0,0 +1,394 @@
+import functools
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from fastapi import APIRouter, Depends, HTTPException
+from peewee import IntegrityError
+from starlette.requests import Request
+
+import blobs
+import catalog
+import metrics
+from auth import get_current_user
+from config import UPLOAD_DIR, MAX_UPLOAD_PARTS, UPLOAD_LOCK_TTL
+from database import db, write_transaction, UploadSession, UploadPart, UploadLock
+from models import UploadSessionModel
+from streaming import iter_body
+from threadpool import run_db, run_io, AsyncFileWriter
+from utils import log, remove_if_exists
+
+# Uploads retomáveis: o cliente cria uma sessão, envia os bytes a partir do offset já confirmado (quantas vezes
+# precisar, se a conexão cair) e finaliza a sessão, o que cria a entrada do arquivo no banco de dados.
+#
+# Em sessões com `part_size`, o arquivo é dividido em partes numeradas, que podem ser enviadas em paralelo por
+# várias conexões. O arquivo parcial é pré-alocado com o tamanho final e cada parte é escrita diretamente na sua
+# posição, então a finalização não precisa copiar nem concatenar nada: é só uma renomeação.
+router = APIRouter()
+
+PARTIAL_DIR = os.path.join(UPLOAD_DIR, '.partial')
+
+# Número do lock de um upload sequencial, que ocupa a sessão inteira (ver UploadLock)
+SEQUENTIAL = -1
+
+
+# Estado do hash das sessões sequenciais que receberam dados neste processo, como id -> (offset, hasher). Assim o
+# hash do conteúdo é calculado durante o envio; se a sessão for retomada em outro processo ou depois de um
+# reinício, ele é recalculado a partir do arquivo parcial na finalização.
+_session_hashers = OrderedDict()
+MAX_SESSION_HASHERS = 1024
+
+
+def partial_path(session_id: str) -> str:
+    return os.path.join(PARTIAL_DIR, session_id)
+
+
+def session_info(session: UploadSession) -> dict:
+    return {
+        'id': session.id,
+        'filename': session.filename,
+        'size': session.size,
+        'offset': session.offset,
+        'part_size': session.part_size,
+        'sha256': session.sha256
+    }
+
+
+def part_count(session: UploadSession) -> int:
+    return max(1, -(-session.size // session.part_size))
+
+
+# Posição e tamanho da parte `number` dentro do arquivo
+def part_range(session: UploadSession, number: int):
+    start = number * session.part_size
+    return start, min(session.part_size, session.size - start)
+
+
+def get_session(session_id: str, current_user: str) -> UploadSession:
+    session = UploadSession.get_or_none(UploadSession.id == session_id)
+    if session is None or session.owner_id != current_user:
+        raise HTTPException(404, 'Upload session not found.')
+    return session
+
+
+def _lock_session(session_id: str, current_user: str, number: int) -> UploadSession:
+    """Pega o lock de envio da parte `number` (ou da sessão inteira, com SEQUENTIAL) e retorna a sessão já com o
+    lock, lida de novo do banco de dados."""
+    now = datetime.now()
+    with write_transaction():
+        session = get_session(session_id, current_user)
+        UploadLock.delete().where((UploadLock.session == session_id) & (UploadLock.expires_at <= now)).execute()
+        conflicts = UploadLock.select().where(UploadLock.session == session_id)
+        if number != SEQUENTIAL:
+            conflicts = conflicts.where(UploadLock.number << [number, SEQUENTIAL])
+        busy = HTTPException(409, 'Upload session is busy.' if number == SEQUENTIAL else f'Part {number} is busy.')
+        if conflicts.exists():
+            raise busy
+        # No SQLite a transação já tem o lock de escrita, mas no PostgreSQL duas requisições concorrentes podem
+        # passar pela verificação acima; quem decide é a chave primária, e a segunda recebe o mesmo 409
+        try:
+            with db.atomic():
+                UploadLock.create(session=session_id, number=number,
+                                  expires_at=now + timedelta(seconds=UPLOAD_LOCK_TTL))
+        except IntegrityError:
+            raise busy
+    return session
+
+
+def _renew_lock(session_id: str, number: int) -> None:
+    UploadLock.update(expires_at=datetime.now() + timedelta(seconds=UPLOAD_LOCK_TTL)).where(
+        (UploadLock.session == session_id) & (UploadLock.number == number)).execute()
+
+
+def _release_lock(session_id: str, number: int) -> None:
+    UploadLock.delete().where((UploadLock.session == session_id) & (UploadLock.number == number)).execute()
+
+
+def _is_locked(session: UploadSession) -> bool:
+    return session.locks.where(UploadLock.expires_at > datetime.now()).exists()
+
+
+class SessionLock:
+    """Lock de envio numa sessão, compartilhado por todos os processos do servidor pelo banco de dados."""
+
+    def __init__(self, session_id: str, current_user: str, number: int):
+        self.session_id = session_id
+        self.current_user = current_user
+        self.number = number
+        self._renewed_at = None
+
+    async def acquire(self) -> UploadSession:
+        session = await run_db(_lock_session, self.session_id, self.current_user, self.number)
+        self._renewed_at = time.monotonic()
+        return session
+
+    async def keep_alive(self) -> None:
+        """Renova o lock, se já tiver passado um terço da validade; chamado a cada bloco recebido."""
+        if time.monotonic() - self._renewed_at > UPLOAD_LOCK_TTL / 3:
+            await run_db(_renew_lock, self.session_id, self.number)
+            self._renewed_at = time.monotonic()
+
+    async def release(self) -> None:
+        await run_db(_release_lock, self.session_id, self.number)
+
+
+def _create_session(session_in: UploadSessionModel, current_user: str) -> UploadSession:
+    if session_in.part_size is not None:
+        if session_in.size is None:
+            raise HTTPException(400, 'Multipart uploads must declare their size.')
+        if -(-session_in.size // session_in.part_size) > MAX_UPLOAD_PARTS:
+            raise HTTPException(400, f'Multipart uploads are limited to {MAX_UPLOAD_PARTS} parts.')
+
+    # A sessão reserva o nome do arquivo, então conflitos aparecem aqui e não na finalização
+    blobs.reserve_filename(session_in.filename, current_user, session_in.size)
+
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    session = UploadSession.create(id=uuid.uuid4().hex, filename=session_in.filename, owner=current_user,
+                                   size=session_in.size, part_size=session_in.part_size, sha256=session_in.sha256,
+                                   created_at=datetime.now())
+    with open(partial_path(session.id), 'wb') as fd:
+        if session.part_size is not None:
+            _preallocate(fd, session.size)
+    return session
+
+
+def _preallocate(fd, size: int) -> None:
+    # Reservar os blocos de uma vez evita fragmentação com partes chegando fora de ordem; sem suporte do sistema
+    # de arquivos, um arquivo esparso do tamanho final serve do mesmo jeito
+    if size == 0:
+        return
+    try:
+        os.posix_fallocate(fd.fileno(), 0, size)
+    except (AttributeError, OSError):
+        fd.truncate(size)
+
+
+def _session_status(session_id: str, current_user: str) -> dict:
+    session = get_session(session_id, current_user)
+    info = session_info(session)
+    if session.part_size is not None:
+        info['parts'] = [part.number for part in session.parts.order_by(UploadPart.number)]
+    return info
+
+
+def _check_partial_data(session: UploadSession) -> None:
+    # Se o arquivo parcial sumiu ou está menor que o offset confirmado, não há como retomar
+    try:
+        partial_size = os.path.getsize(partial_path(session.id))
+    except FileNotFoundError:
+        partial_size = -1
+    if partial_size < session.offset:
+        session.delete_instance(recursive=True)
+        raise HTTPException(410, 'Partial upload data was lost; start a new upload session.')
+
+
+def _commit_offset(session_id: str, old_offset: int, new_offset: int) -> None:
+    UploadSession.update(offset=new_offset).where(
+        (UploadSession.id == session_id) & (UploadSession.offset == old_offset)).execute()
+
+
+def _commit_part(session_id: str, number: int, size: int) -> None:
+    with write_transaction():
+        if UploadPart.get_or_none((UploadPart.session == session_id) & (UploadPart.number == number)) is None:
+            UploadPart.create(session=session_id, number=number, size=size)
+            UploadSession.update(offset=UploadSession.offset + size).where(UploadSession.id == session_id).execute()
+
+
+def _check_complete(session_id: str, current_user: str) -> UploadSession:
+    session = get_session(session_id, current_user)
+    if _is_locked(session):
+        raise HTTPException(409, 'Upload session is busy.')
+    if session.size is not None and session.offset != session.size:
+        raise HTTPException(400, f'Upload incomplete: {session.offset} of {session.size} bytes received.')
+    return session
+
+
+def _remove_completed_session(session_id: str, current_user: str, offset: int) -> None:
+    # Chamada na transação que cria o arquivo; a sessão pode ter mudado desde a verificação, feita antes do hash
+    session = _check_complete(session_id, current_user)
+    if session.offset != offset:
+        raise HTTPException(409, 'Upload session is busy.')
+    session.delete_instance(recursive=True)
+
+
+# `hashed_offset` e `digest` vêm do hash calculado durante o envio, se houver; só são usados se corresponderem a
+# todo o conteúdo confirmado. `expected_digest` é o hash informado pelo cliente na finalização, se houver.
+#
+# O hash e a compressão são feitos no pool de I/O, sem conexão com o banco de dados; depois, a entrada do arquivo
+# é criada, o arquivo parcial vira blob e a sessão é removida numa única transação curta (ver `blobs.create_file`).
+async def _finalize_session(session_id: str, current_user: str, hashed_offset: int = None, digest: str = None,
+                            expected_digest: str = None) -> str:
+    session = await run_db(_check_complete, session_id, current_user)
+    path = partial_path(session.id)
+    if digest is None or hashed_offset != session.offset:
+        digest = await run_io(blobs.hash_file, path)
+    blobs.check_digest(session.sha256, digest, session.filename)
+    blobs.check_digest(expected_digest, digest, session.filename)
+
+    stored = await run_db(blobs.is_stored, digest)
+    stored_path, codec = await run_io(blobs.compress_content, path, digest, stored)
+    try:
+        await run_db(blobs.create_file, session.filename, current_user, stored_path, digest, session.offset, codec,
+                     functools.partial(_remove_completed_session, session_id, current_user, session.offset))
+    except BaseException:
+        if stored_path != path:
+            await run_io(remove_if_exists, stored_path)
+        raise
+    if stored_path != path:
+        await run_io(remove_if_exists, path)
+    return session.filename
+
+
+def sweep_partial_files(max_age: float) -> int:
+    """Remove os arquivos parciais sem sessão (ex.: o processo morreu ao remover a sessão), sem modificação há mais
+    de `max_age` segundos; retorna quantos foram removidos."""
+    if not os.path.isdir(PARTIAL_DIR):
+        return 0
+    removed = 0
+    limit = time.time() - max_age
+    for entry in os.scandir(PARTIAL_DIR):
+        try:
+            if entry.stat().st_mtime >= limit or UploadSession.select().where(UploadSession.id == entry.name).exists():
+                continue
+            os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def _delete_session(session_id: str, current_user: str) -> None:
+    session = get_session(session_id, current_user)
+    session.delete_instance(recursive=True)
+    _session_hashers.pop(session_id, None)
+    remove_if_exists(partial_path(session.id))
+
+
+# Criar sessão de upload
+@router.post('/uploads', status_code=201)
+async def create_upload_session(session_in: UploadSessionModel, current_user: str = Depends(get_current_user)):
+    session = await run_db(_create_session, session_in, current_user)
+    log.info('Created upload session %s for %s', session.id, session.filename)
+    return session_info(session)
+
+
+# Consultar o offset já confirmado de uma sessão
+@router.get('/uploads/{session_id}')
+async def get_upload_session(session_id: str, current_user: str = Depends(get_current_user)):
+    return await run_db(_session_status, session_id, current_user)
+
+
+# Enviar os bytes de um arquivo a partir de `offset`, que deve ser igual ao offset confirmado da sessão
+@router.put('/uploads/{session_id}')
+async def upload_session_data(session_id: str, offset: int, request: Request,
+                              current_user: str = Depends(get_current_user)):
+    session = await run_db(get_session, session_id, current_user)
+    if session.part_size is not None:
+        raise HTTPException(400, 'Multipart upload sessions receive data through their parts.')
+    if offset != session.offset:
+        raise HTTPException(409, f'Upload session is at offset {session.offset}.')
+
+    lock = SessionLock(session_id, current_user, SEQUENTIAL)
+    session = await lock.acquire()
+    metrics.UPLOADS_IN_PROGRESS.inc()
+    try:
+        # O offset é verificado de novo com o lock, já que outro envio pode ter terminado nesse meio tempo
+        if offset != session.offset:
+            raise HTTPException(409, f'Upload session is at offset {session.offset}.')
+        await run_db(_check_partial_data, session)
+
+        cached_offset, hasher = _session_hashers.pop(session_id, (None, None))
+        if cached_offset != offset:
+            hasher = blobs.new_hasher() if offset == 0 else None
+
+        writer = await AsyncFileWriter(partial_path(session_id), offset=offset, hasher=hasher).open()
+        try:
+            async for block in iter_body(request):
+                if session.size is not None and offset + writer.bytes_written + len(block) > session.size:
+                    raise HTTPException(413, 'Data exceeds the declared upload size.')
+                await writer.write(block)
+                await lock.keep_alive()
+        finally:
+            # Mesmo se a conexão cair no meio do envio, confirmamos o que já foi gravado em disco, pra que o
+            # cliente só precise reenviar o restante
+            await writer.close(sync=True)
+            session.offset = offset + writer.bytes_written
+            await run_db(_commit_offset, session_id, offset, session.offset)
+            if writer.hasher is not None:
+                _session_hashers[session_id] = (session.offset, writer.hasher)
+                while len(_session_hashers) > MAX_SESSION_HASHERS:
+                    _session_hashers.popitem(last=False)
+    finally:
+        metrics.UPLOADS_IN_PROGRESS.dec()
+        await lock.release()
+
+    return session_info(session)
+
+
+# Enviar uma parte de um upload em partes. Partes diferentes podem ser enviadas ao mesmo tempo, em qualquer ordem,
+# e reenviar uma parte já confirmada simplesmente a sobrescreve.
+@router.put('/uploads/{session_id}/parts/{number}')
+async def upload_session_part(session_id: str, number: int, request: Request,
+                              current_user: str = Depends(get_current_user)):
+    session = await run_db(get_session, session_id, current_user)
+    if session.part_size is None:
+        raise HTTPException(400, 'Upload session is not a multipart upload.')
+    if not 0 <= number < part_count(session):
+        raise HTTPException(400, f'Part number must be between 0 and {part_count(session) - 1}.')
+
+    lock = SessionLock(session_id, current_user, number)
+    session = await lock.acquire()
+    metrics.UPLOADS_IN_PROGRESS.inc()
+    try:
+        await run_db(_check_partial_data, session)
+        start, length = part_range(session, number)
+        writer = await AsyncFileWriter(partial_path(session_id), offset=start, truncate=False).open()
+        try:
+            async for block in iter_body(request):
+                if writer.bytes_written + len(block) > length:
+                    raise HTTPException(413, f'Part {number} must have {length} bytes.')
+                await writer.write(block)
+                await lock.keep_alive()
+        finally:
+            await writer.close(sync=True)
+
+        # Partes incompletas não são confirmadas e precisam ser reenviadas por inteiro
+        if writer.bytes_written != length:
+            raise HTTPException(400, f'Part {number} must have {length} bytes.')
+        await run_db(_commit_part, session_id, number, length)
+    finally:
+        metrics.UPLOADS_IN_PROGRESS.dec()
+        await lock.release()
+
+    return {'id': session_id, 'number': number, 'size': length}
+
+
+# Finalizar sessão, criando a entrada do arquivo no banco de dados. O hash do conteúdo, se informado na criação da
+# sessão ou no cabeçalho X-Upload-SHA256, é conferido antes.
+@router.post('/uploads/{session_id}/complete')
+async def complete_upload_session(session_id: str, request: Request, current_user: str = Depends(get_current_user)):
+    expected_digest = request.headers.get('x-upload-sha256')
+    if expected_digest is not None:
+        expected_digest = blobs.parse_digest(expected_digest)
+    cached_offset, hasher = _session_hashers.pop(session_id, (None, None))
+    try:
+        filename = await _finalize_session(session_id, current_user, cached_offset, hasher and hasher.hexdigest(),
+                                           expected_digest)
+    except HTTPException:
+        if hasher is not None:
+            _session_hashers[session_id] = (cached_offset, hasher)
+        raise
+    catalog.catalog_changed()
+    metrics.UPLOADED_FILES.inc(labels=('session',))
+    log.info('Successfully created uploaded file %s from session %s', filename, session_id)
+    return {'filename': filename}
+
+
+# Cancelar sessão, descartando os dados já enviados
+@router.delete('/uploads/{session_id}')
+async def delete_upload_session(session_id: str, current_user: str = Depends(get_current_user)):
+    await run_db(_delete_session, session_id, current_user)
+    log.info('Deleted upload session %s', session_id)
+    return {'id': session_id}
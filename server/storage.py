@@ -0,0 +1,236 @@
+import os
+import shutil
+from datetime import datetime
+from typing import Optional
+from urllib.parse import urlparse
+
+from config import UPLOAD_DIR, STORAGE_URL
+from utils import remove_if_exists
+
+# Armazenamento dos blobs (ver blobs.py), identificados pelo hash do conteúdo. Os uploads são sempre recebidos
+# em arquivos locais, em UPLOAD_DIR, e só depois de completos passam ao backend com `put`; os downloads leem
+# intervalos do conteúdo com `open`. O backend é escolhido por STORAGE_URL:
+#
+# - sem STORAGE_URL, `LocalStorage`: arquivos em UPLOAD_DIR/.blobs, em subpastas pelos primeiros caracteres do
+#   hash (ex.: .blobs/3f/a2/3fa2...), pra que nenhuma pasta fique com centenas de milhares de arquivos;
+# - `s3://bucket/prefixo`, `ObjectStorage`: um object store compatível com S3 (requer o boto3).
+#
+# Os métodos fazem I/O bloqueante e devem ser chamados pelo pool de I/O nas rotas assíncronas.
+
+
+class StoredFile:
+    """Conteúdo armazenado aberto pra leitura, de tamanho `size`.
+
+    `read` lê `size` bytes a partir de `offset`, sem depender de posição corrente, então pode ser chamado de
+    qualquer thread.
+    """
+
+    def __init__(self, size: int, mtime: float):
+        self.size = size
+        self.mtime = mtime
+
+    def read(self, offset: int, size: int) -> bytes:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class LocalFile(StoredFile):
+    def __init__(self, path: str):
+        fd = open(path, 'rb')
+        stat = os.fstat(fd.fileno())
+        super().__init__(stat.st_size, stat.st_mtime)
+        self.file = fd
+        self.name = path
+
+    def read(self, offset: int, size: int) -> bytes:
+        return os.pread(self.file.fileno(), size, offset)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class Storage:
+    def put(self, key: str, source_path: str) -> None:
+        """Armazena o arquivo local `source_path` com a chave `key`; o arquivo é movido, e deixa de existir."""
+        raise NotImplementedError
+
+    def open(self, key: str) -> StoredFile:
+        """Abre o conteúdo de `key`; levanta FileNotFoundError se ele não existir."""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        """Remove o conteúdo de `key`, se existir."""
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    def __init__(self, root: str, shard_levels: int = 2, shard_width: int = 2):
+        self.root = root
+        self.shard_levels = shard_levels
+        self.shard_width = shard_width
+
+    def path(self, key: str) -> str:
+        shards = [key[level * self.shard_width:(level + 1) * self.shard_width] for level in range(self.shard_levels)]
+        return os.path.join(self.root, *shards, key)
+
+    # Caminho dos blobs gravados antes da divisão em subpastas, ainda lidos até a migração (ver migrate_storage.py)
+    def flat_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def put(self, key: str, source_path: str) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # `source_path` fica em UPLOAD_DIR, no mesmo sistema de arquivos, então isso é só uma renomeação
+        os.replace(source_path, path)
+
+    def open(self, key: str) -> StoredFile:
+        try:
+            return LocalFile(self.path(key))
+        except FileNotFoundError:
+            return LocalFile(self.flat_path(key))
+
+    def delete(self, key: str) -> None:
+        remove_if_exists(self.path(key))
+        remove_if_exists(self.flat_path(key))
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key)) or os.path.exists(self.flat_path(key))
+
+
+class ObjectFile(StoredFile):
+    def __init__(self, client, bucket: str, key: str):
+        head = client.head_object(Bucket=bucket, Key=key)
+        super().__init__(head['ContentLength'], head['LastModified'].timestamp())
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+
+    def read(self, offset: int, size: int) -> bytes:
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                          Range=f'bytes={offset}-{offset + size - 1}')
+        with response['Body'] as body:
+            return body.read()
+
+
+class ObjectStorage(Storage):
+    """Backend sobre um object store, por meio de um cliente com a interface do boto3 (`upload_file`,
+    `head_object`, `get_object` e `delete_object`); nos testes, `LocalObjectStore`."""
+
+    def __init__(self, client, bucket: str, prefix: str = ''):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_key(self, key: str) -> str:
+        return self.prefix + key
+
+    def put(self, key: str, source_path: str) -> None:
+        # O boto3 envia arquivos grandes em partes, em paralelo, lendo do disco aos poucos
+        self.client.upload_file(Filename=source_path, Bucket=self.bucket, Key=self.object_key(key))
+        os.remove(source_path)
+
+    # O boto3 sinaliza objeto inexistente com NoSuchKey em get_object, mas com um ClientError de código 404 em
+    # head_object
+    def _is_missing(self, error: Exception) -> bool:
+        code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+        return isinstance(error, self.client.exceptions.NoSuchKey) or code in ('404', 'NoSuchKey')
+
+    def open(self, key: str) -> StoredFile:
+        try:
+            return ObjectFile(self.client, self.bucket, self.object_key(key))
+        except Exception as error:
+            if self._is_missing(error):
+                raise FileNotFoundError(key)
+            raise
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except Exception as error:
+            if self._is_missing(error):
+                return False
+            raise
+        return True
+
+
+class LocalObjectStore:
+    """Substituto local de um object store, com o subconjunto da interface do cliente S3 do boto3 usado por
+    `ObjectStorage`. Cada bucket é uma pasta em `root`, e cada objeto, um arquivo com a chave como nome."""
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key.replace('/', '%2F'))
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str) -> None:
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path + '.uploading')
+        os.replace(path + '.uploading', path)
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        try:
+            stat = os.stat(self._path(Bucket, Key))
+        except FileNotFoundError:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'ContentLength': stat.st_size, 'LastModified': datetime.fromtimestamp(stat.st_mtime)}
+
+    def get_object(self, Bucket: str, Key: str, Range: Optional[str] = None) -> dict:
+        try:
+            body = open(self._path(Bucket, Key), 'rb')
+        except FileNotFoundError:
+            raise self.exceptions.NoSuchKey(Key)
+        if Range is None:
+            return {'Body': body}
+        start, end = Range[len('bytes='):].split('-')
+        body.seek(int(start))
+        return {'Body': _LimitedReader(body, int(end) - int(start) + 1)}
+
+    def delete_object(self, Bucket: str, Key: str) -> None:
+        remove_if_exists(self._path(Bucket, Key))
+
+
+class _LimitedReader:
+    def __init__(self, fd, limit: int):
+        self.fd = fd
+        self.limit = limit
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.limit if size < 0 else min(size, self.limit)
+        data = self.fd.read(size)
+        self.limit -= len(data)
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.fd.close()
+
+
+def create_storage(url: Optional[str]) -> Storage:
+    if url is None:
+        return LocalStorage(os.path.join(UPLOAD_DIR, '.blobs'))
+    parsed = urlparse(url)
+    if parsed.scheme == 's3':
+        import boto3
+
+        prefix = parsed.path.lstrip('/')
+        return ObjectStorage(boto3.client('s3'), parsed.netloc, prefix + '/' if prefix else '')
+    raise ValueError(f'Unsupported STORAGE_URL: {url}')
+
+
+backend = create_storage(STORAGE_URL)
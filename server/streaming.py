@@ -0,0 +1,197 @@
+from enum import Enum
+from typing import AsyncIterator, Dict, Optional, Tuple, Union
+
+from fastapi import HTTPException
+from multipart.multipart import parse_options_header
+from starlette.requests import ClientDisconnect, Request
+
+from compression import request_decoder, DecodeError
+from config import UPLOAD_BUFFER_SIZE
+from metrics import UPLOAD_RECEIVED_BYTES
+
+# Tamanho máximo aceito para o bloco de cabeçalhos de uma parte
+MAX_PART_HEADERS_SIZE = 16 * 1024
+
+
+class PartEvent(Enum):
+    BEGIN = 1
+    DATA = 2
+    END = 3
+
+
+class _State(Enum):
+    PREAMBLE = 1
+    AFTER_DELIMITER = 2
+    HEADERS = 3
+    DATA = 4
+    DONE = 5
+
+
+# Metadados de uma parte do corpo multipart, disponíveis assim que seus cabeçalhos terminam de chegar
+class PartInfo:
+    __slots__ = ('name', 'filename', 'content_type')
+
+    def __init__(self, name: str, filename: Optional[str], content_type: str):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+
+
+def _decode(value: bytes) -> str:
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+def _parse_part_headers(block: bytes) -> PartInfo:
+    headers: Dict[bytes, bytes] = {}
+    for line in block.split(b'\r\n'):
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip()
+
+    _, options = parse_options_header(headers.get(b'content-disposition', b''))
+    filename = options.get(b'filename')
+    return PartInfo(name=_decode(options.get(b'name', b'')),
+                    filename=_decode(filename) if filename is not None else None,
+                    content_type=_decode(headers.get(b'content-type', b'')))
+
+
+async def iter_stream(request: Request) -> AsyncIterator[bytes]:
+    """`request.stream()`, descomprimido se o corpo vier com `Content-Encoding` (ver compression.py).
+
+    A descompressão é feita no event loop, em pedaços limitados, como o resto do parsing; tamanhos e offsets de
+    quem consome o corpo se referem sempre aos dados descomprimidos.
+    """
+    decoder = request_decoder(request.headers.get('content-encoding'))
+    if decoder is None:
+        async for chunk in request.stream():
+            UPLOAD_RECEIVED_BYTES.inc(len(chunk))
+            yield chunk
+        return
+
+    try:
+        async for chunk in request.stream():
+            UPLOAD_RECEIVED_BYTES.inc(len(chunk))
+            for output in decoder.decompress(chunk):
+                yield output
+    except DecodeError:
+        raise HTTPException(400, 'Invalid compressed body.')
+    if not decoder.eof:
+        raise HTTPException(400, 'Truncated compressed body.')
+
+
+async def iter_multipart(request: Request,
+                         buffer_size: int = UPLOAD_BUFFER_SIZE
+                         ) -> AsyncIterator[Tuple[PartEvent, Union[PartInfo, bytearray, None]]]:
+    """Faz o parsing incremental de um corpo multipart/form-data diretamente do stream da requisição (ver
+    `iter_stream`).
+
+    Gera tuplas `(PartEvent.BEGIN, PartInfo)`, `(PartEvent.DATA, bytearray)` e `(PartEvent.END, None)` para
+    cada parte. Os dados de uma parte são acumulados até `buffer_size` bytes antes de serem entregues,
+    de modo que quem consome o gerador pode escrevê-los diretamente no destino final em blocos grandes,
+    sem arquivo temporário intermediário.
+
+    A busca pelo delimitador é feita com `bytearray.find`, em C; o parser do python-multipart percorre
+    os dados byte a byte em Python e era o gargalo do upload.
+    """
+    content_type, params = parse_options_header(request.headers.get('Content-Type', ''))
+    boundary = params.get(b'boundary')
+    if content_type != b'multipart/form-data' or not boundary:
+        raise HTTPException(400, 'Expected a multipart/form-data body.')
+
+    delimiter = b'\r\n--' + boundary
+    # Uma cauda desse tamanho pode conter o começo de um delimitador dividido entre dois pedaços
+    keep = len(delimiter) - 1
+
+    # Começamos com um CRLF pra que o primeiro delimitador possa ser encontrado como os demais
+    buffer = bytearray(b'\r\n')
+    output = bytearray()
+    state = _State.PREAMBLE
+
+    async for chunk in iter_stream(request):
+        buffer += chunk
+
+        while state is not _State.DONE:
+            if state is _State.PREAMBLE:
+                index = buffer.find(delimiter)
+                if index < 0:
+                    del buffer[:-keep]
+                    break
+                del buffer[:index + len(delimiter)]
+                state = _State.AFTER_DELIMITER
+
+            elif state is _State.AFTER_DELIMITER:
+                if len(buffer) < 2:
+                    break
+                if buffer[:2] == b'--':
+                    state = _State.DONE
+                    break
+                index = buffer.find(b'\r\n')
+                if index < 0:
+                    if len(buffer) > MAX_PART_HEADERS_SIZE:
+                        raise HTTPException(400, 'Malformed multipart body.')
+                    break
+                del buffer[:index + 2]
+                state = _State.HEADERS
+
+            elif state is _State.HEADERS:
+                if buffer[:2] == b'\r\n':
+                    block, consumed = b'', 2
+                else:
+                    index = buffer.find(b'\r\n\r\n')
+                    if index < 0:
+                        if len(buffer) > MAX_PART_HEADERS_SIZE:
+                            raise HTTPException(400, 'Multipart part headers too large.')
+                        break
+                    block, consumed = bytes(buffer[:index]), index + 4
+                del buffer[:consumed]
+                yield PartEvent.BEGIN, _parse_part_headers(block)
+                state = _State.DATA
+
+            elif state is _State.DATA:
+                index = buffer.find(delimiter)
+                end = index if index >= 0 else len(buffer) - keep
+                if end > 0:
+                    with memoryview(buffer) as view:
+                        output += view[:end]
+                    del buffer[:end]
+
+                if index < 0:
+                    if len(output) >= buffer_size:
+                        yield PartEvent.DATA, output
+                        output = bytearray()
+                    break
+
+                del buffer[:len(delimiter)]
+                if output:
+                    yield PartEvent.DATA, output
+                    output = bytearray()
+                yield PartEvent.END, None
+                state = _State.AFTER_DELIMITER
+
+        if state is _State.DONE:
+            # O que vem depois do delimitador final (o epílogo) é ignorado, sem acumular
+            buffer.clear()
+
+    if state is not _State.DONE:
+        raise HTTPException(400, 'Malformed multipart body.')
+
+
+async def iter_body(request: Request, buffer_size: int = UPLOAD_BUFFER_SIZE) -> AsyncIterator[bytearray]:
+    """Lê um corpo bruto (não multipart) do stream da requisição (ver `iter_stream`), em blocos de pelo menos
+    `buffer_size` bytes."""
+    output = bytearray()
+    try:
+        async for chunk in iter_stream(request):
+            output += chunk
+            if len(output) >= buffer_size:
+                yield output
+                output = bytearray()
+    except ClientDisconnect:
+        # Entregamos o que já chegou antes de propagar a desconexão, pra que possa ser aproveitado
+        if output:
+            yield output
+        raise
+    if output:
+        yield output
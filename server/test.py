@@ -1,4 +1,13 @@
+import hashlib
 import os
+import shutil
+import time
+
+from config import UPLOAD_DIR
+
+# Os testes usam uma pasta de uploads própria (ver pytest.ini), limpa a cada execução
+shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
+os.makedirs(UPLOAD_DIR)
 
 from starlette.testclient import TestClient
 from main import app
@@ -8,6 +17,12 @@ client = TestClient(app)
 jwt_token = None
 
 
+# Caminho em que um conteúdo enviado fica armazenado, em subpastas pelo início do hash
+def stored_path(data: bytes) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    return os.path.join(UPLOAD_DIR, '.blobs', digest[:2], digest[2:4], digest)
+
+
 def test_register():
     r = client.post('/register', json={
         'username': 'pedrovhb',
@@ -67,14 +82,10 @@ def test_login():
 def test_get_empty_files():
     r = client.get('/files')
     assert r.status_code == 200
-    assert r.json() == []
+    assert r.json() == {'files': [], 'next_cursor': None}
 
 
 def test_upload_file():
-    test_file_path = os.path.join(os.getcwd(), 'uploads', 'testfile.py')
-    if os.path.exists(test_file_path):
-        os.remove(test_file_path)
-
     with open('main.py', 'rb') as fd:
         files = {"file": ('testfile.py', fd, 'multipart/form-data')}
         r = client.post('/upload', files=files)
@@ -90,6 +101,1237 @@ def test_upload_existing_file():
 
 def test_get_files():
     r = client.get('/files')
-    assert r.json()[0]['filename'] == 'testfile.py'
-    assert r.json()[0]['uploaded_by'] == 'pedrovhb'
+    assert r.json()['files'][0]['filename'] == 'testfile.py'
+    assert r.json()['files'][0]['uploaded_by'] == 'pedrovhb'
+    assert r.json()['next_cursor'] is None
+    assert r.status_code == 200
+
+
+def test_upload_large_file():
+    # Arquivo maior que o buffer de escrita, pra garantir que o conteúdo é montado corretamente entre blocos
+    data = os.urandom(3 * 1024 * 1024 + 123)
+    files = {"file": ('large_file.bin', data, 'application/octet-stream')}
+    r = client.post('/upload', files=files)
+    assert r.status_code == 200
+
+    with open(stored_path(data), 'rb') as fd:
+        assert fd.read() == data
+
+
+def test_upload_missing_file_field():
+    r = client.post('/upload', files={"other": ('other.txt', b'abc', 'text/plain')})
+    assert r.status_code == 422
+    r = client.post('/upload', data=b'abc', headers={'Content-Type': 'application/octet-stream'})
+    assert r.status_code == 400
+
+
+def test_upload_invalid_filename():
+    # Os nomes precisam ter de 1 a 255 caracteres, como nas rotas com corpo em JSON
+    body = (b'--xyz\r\nContent-Disposition: form-data; name="file"; filename=""\r\n\r\nabc\r\n--xyz--\r\n')
+    headers = {'Content-Type': 'multipart/form-data; boundary=xyz'}
+    assert client.post('/upload', data=body, headers=headers).status_code == 400
+    assert client.post('/upload/batch', data=body, headers=headers).status_code == 400
+    long_name = 'a' * 256
+    r = client.post('/upload', files={"file": (long_name, b'abc', 'text/plain')})
+    assert r.status_code == 400
+    r = client.post('/upload/batch', files=[('file', ('ok.txt', b'abc')), ('file', (long_name, b'abc'))])
+    assert r.status_code == 400
+    assert client.post('/upload', files={"file": ('a' * 255, b'abc', 'text/plain')}).status_code == 200
+    assert client.delete('/files/' + 'a' * 255).status_code == 200
+    assert client.get('/files', params={'prefix': 'ok.txt'}).json()['files'] == []
+
+
+def test_multipart_parser_small_chunks():
+    # O delimitador pode chegar dividido entre pedaços do stream, e os dados podem conter um prefixo dele;
+    # alimentamos o parser de 7 em 7 bytes
+    import asyncio
+    from starlette.requests import Request
+    from streaming import iter_multipart, PartEvent
+
+    data = os.urandom(5000) + b'\r\n--xy'
+    body = (b'--xyz\r\nContent-Disposition: form-data; name="note"\r\n\r\nhello\r\n'
+            b'--xyz\r\nContent-Disposition: form-data; name="file"; filename="a.bin"\r\n'
+            b'Content-Type: application/octet-stream\r\n\r\n' + data + b'\r\n--xyz--\r\n')
+    chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+
+    async def receive():
+        return {'type': 'http.request', 'body': chunks.pop(0), 'more_body': bool(chunks)}
+
+    async def collect():
+        request = Request({'type': 'http', 'headers': [(b'content-type', b'multipart/form-data; boundary=xyz')]},
+                          receive)
+        parts = []
+        async for event, value in iter_multipart(request, buffer_size=1024):
+            if event is PartEvent.BEGIN:
+                parts.append([value.name, value.filename, b''])
+            elif event is PartEvent.DATA:
+                parts[-1][2] += value
+        return parts
+
+    parts = asyncio.new_event_loop().run_until_complete(collect())
+    assert parts == [['note', None, b'hello'], ['file', 'a.bin', data]]
+
+
+def test_multipart_parser_discards_epilogue():
+    import asyncio
+    import tracemalloc
+    from starlette.requests import Request
+    from streaming import iter_multipart
+
+    # Depois do delimitador final, o restante do corpo é lido mas não acumulado
+    chunks = [b'--xyz\r\nContent-Disposition: form-data; name="note"\r\n\r\nhello\r\n--xyz--\r\n']
+    chunks += [bytes(1024 * 1024)] * 64
+
+    async def receive():
+        return {'type': 'http.request', 'body': chunks.pop(0), 'more_body': bool(chunks)}
+
+    async def consume():
+        request = Request({'type': 'http', 'headers': [(b'content-type', b'multipart/form-data; boundary=xyz')]},
+                          receive)
+        async for _ in iter_multipart(request):
+            pass
+
+    tracemalloc.start()
+    try:
+        asyncio.new_event_loop().run_until_complete(consume())
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert not chunks
+    assert peak < 16 * 1024 * 1024
+
+
+def test_async_file_writer_abort():
+    import asyncio
+    from threadpool import AsyncFileWriter
+
+    path = os.path.join(UPLOAD_DIR, 'aborted.bin')
+
+    async def write_and_abort():
+        writer = await AsyncFileWriter(path).open()
+        await writer.write(b'partial data')
+        await writer.abort()
+
+    asyncio.new_event_loop().run_until_complete(write_and_abort())
+    assert not os.path.exists(path)
+
+
+def test_resumable_upload_session(monkeypatch):
+    import blobs
+    import catalog
+    import sessions
+    from database import db
+    from events import last_seq
+
+    data = os.urandom(200000)
+    r = client.post('/uploads', json={'filename': 'resumed.bin', 'size': len(data)})
+    assert r.status_code == 201
+    session_id = r.json()['id']
+    assert r.json()['offset'] == 0
+
+    # Primeiro envio, interrompido no meio
+    r = client.put(f'/uploads/{session_id}?offset=0', data=data[:50000])
+    assert r.status_code == 200
+    assert r.json()['offset'] == 50000
+
+    # Offset divergente do confirmado é rejeitado
+    r = client.put(f'/uploads/{session_id}?offset=0', data=data)
+    assert r.status_code == 409
+
+    # Incompleto ainda não pode ser finalizado
+    r = client.post(f'/uploads/{session_id}/complete')
+    assert r.status_code == 400
+
+    # Retomada a partir do offset consultado
+    offset = client.get(f'/uploads/{session_id}').json()['offset']
+    r = client.put(f'/uploads/{session_id}?offset={offset}', data=data[offset:])
+    assert r.json()['offset'] == len(data)
+
+    # Como se a sessão tivesse sido retomada em outro processo, o hash é recalculado na finalização, sem ocupar
+    # uma conexão com o banco de dados; a transação que cria o arquivo já atualiza o cache do catálogo
+    hash_file = blobs.hash_file
+    hashed = []
+
+    def hash_without_connection(path):
+        assert db.is_closed()
+        hashed.append(path)
+        return hash_file(path)
+
+    monkeypatch.setattr(blobs, 'hash_file', hash_without_connection)
+    sessions._session_hashers.pop(session_id)
+    r = client.post(f'/uploads/{session_id}/complete')
+    assert r.status_code == 200
+    assert client.get(f'/uploads/{session_id}').status_code == 404
+    assert catalog.cache.version == last_seq()
+    assert catalog.cache.get('resumed.bin') is not None
+    assert len(hashed) == 1
+
+    with open(stored_path(data), 'rb') as fd:
+        assert fd.read() == data
+
+    # O arquivo já existe, então não é possível criar outra sessão com o mesmo nome
+    r = client.post('/uploads', json={'filename': 'resumed.bin'})
+    assert r.status_code == 409
+
+
+def test_upload_session_exceeds_size():
+    session_id = client.post('/uploads', json={'filename': 'small.bin', 'size': 10}).json()['id']
+    r = client.put(f'/uploads/{session_id}?offset=0', data=b'x' * 11)
+    assert r.status_code == 413
+    r = client.delete(f'/uploads/{session_id}')
+    assert r.status_code == 200
+
+
+def test_multipart_upload_session():
+    data = os.urandom(250000)
+    r = client.post('/uploads', json={'filename': 'parts.bin', 'size': len(data), 'part_size': 100000})
+    assert r.status_code == 201
+    session_id = r.json()['id']
+
+    # Partes podem chegar fora de ordem; uma parte com tamanho errado não é confirmada
+    assert client.put(f'/uploads/{session_id}/parts/2', data=data[200000:]).status_code == 200
+    assert client.put(f'/uploads/{session_id}/parts/0', data=data[:99999]).status_code == 400
+    assert client.put(f'/uploads/{session_id}/parts/0', data=data[:100000]).status_code == 200
+    assert client.put(f'/uploads/{session_id}/parts/3', data=b'x').status_code == 400
+
+    r = client.get(f'/uploads/{session_id}')
+    assert r.json()['parts'] == [0, 2]
+    assert client.post(f'/uploads/{session_id}/complete').status_code == 400
+
+    assert client.put(f'/uploads/{session_id}/parts/1', data=data[100000:200000]).status_code == 200
+    r = client.post(f'/uploads/{session_id}/complete')
+    assert r.status_code == 200
+
+    with open(stored_path(data), 'rb') as fd:
+        assert fd.read() == data
+
+    # Sessões em partes precisam declarar o tamanho
+    r = client.post('/uploads', json={'filename': 'no-size.bin', 'part_size': 100000})
+    assert r.status_code == 400
+
+
+def test_compressed_request_bodies():
+    import gzip
+
+    data = ' '.join(str(i) for i in range(50000)).encode()
+    session_id = client.post('/uploads', json={'filename': 'gzipped.txt', 'size': len(data)}).json()['id']
+
+    # Offsets e tamanhos se referem aos dados descomprimidos
+    r = client.put(f'/uploads/{session_id}?offset=0', data=gzip.compress(data[:100000]),
+                   headers={'Content-Encoding': 'gzip'})
+    assert r.json()['offset'] == 100000
+    assert client.put(f'/uploads/{session_id}?offset=100000', data=b'not gzip',
+                      headers={'Content-Encoding': 'gzip'}).status_code == 400
+    assert client.put(f'/uploads/{session_id}?offset=100000', data=data[100000:],
+                      headers={'Content-Encoding': 'br'}).status_code == 415
+    r = client.put(f'/uploads/{session_id}?offset=100000', data=gzip.compress(data[100000:]),
+                   headers={'Content-Encoding': 'gzip'})
+    assert r.json()['offset'] == len(data)
+    assert client.post(f'/uploads/{session_id}/complete').status_code == 200
+    assert client.get('/files/gzipped.txt').content == data
+
+    data = data.replace(b' ', b',')
+    body = (b'--boundary\r\nContent-Disposition: form-data; name="file"; filename="gzipped.csv"\r\n\r\n' + data +
+            b'\r\n--boundary--\r\n')
+    r = client.post('/upload', data=gzip.compress(body),
+                    headers={'Content-Type': 'multipart/form-data; boundary=boundary', 'Content-Encoding': 'gzip'})
+    assert r.status_code == 200
+    assert client.get('/files/gzipped.csv').content == data
+
+
+def test_zstd_request_bodies():
+    import pytest
+    zstandard = pytest.importorskip('zstandard')
+    import compression
+
+    data = os.urandom(1000) * 300
+    session_id = client.post('/uploads', json={'filename': 'zstd.bin', 'size': len(data)}).json()['id']
+    compressed = zstandard.ZstdCompressor().compress(data)
+    assert client.put(f'/uploads/{session_id}?offset=0', data=compressed[:-10],
+                      headers={'Content-Encoding': 'zstd'}).status_code == 400
+    assert client.put(f'/uploads/{session_id}?offset=0', data=b'not zstd',
+                      headers={'Content-Encoding': 'zstd'}).status_code == 400
+    r = client.put(f'/uploads/{session_id}?offset=0', data=compressed, headers={'Content-Encoding': 'zstd'})
+    assert r.json()['offset'] == len(data)
+    assert client.post(f'/uploads/{session_id}/complete').status_code == 200
+    assert client.get('/files/zstd.bin').content == data
+
+    # Um bloco pequeno muito comprimido é descomprimido aos poucos, com no máximo DECODE_CHUNK_SIZE por vez
+    compressor = zstandard.ZstdCompressor().compressobj()
+    bomb = b''.join(compressor.compress(bytes(1024 * 1024)) for _ in range(64)) + compressor.flush()
+    assert len(bomb) < 64 * 1024
+    decoder = compression.ZstdDecoder()
+    sizes = [len(output) for output in decoder.decompress(bomb[:len(bomb) // 2])]
+    sizes += [len(output) for output in decoder.decompress(bomb[len(bomb) // 2:])]
+    assert max(sizes) <= compression.DECODE_CHUNK_SIZE
+    assert sum(sizes) == 64 * 1024 * 1024
+    assert decoder.eof
+
+
+def test_compressed_storage(monkeypatch):
+    import gzip
+    import blobs
+    from database import Blob
+
+    monkeypatch.setattr(blobs, 'STORAGE_CODEC', 'gzip')
+    data = ' '.join(str(i) for i in range(200000)).encode()
+    assert client.post('/upload', files={"file": ('compressed.txt', data, 'text/plain')}).status_code == 200
+    digest = hashlib.sha256(data).hexdigest()
+    assert Blob.get(Blob.digest == digest).codec == 'gzip'
+    assert Blob.get(Blob.digest == digest).size == len(data)
+    with open(stored_path(data), 'rb') as fd:
+        stored = fd.read()
+    assert len(stored) < len(data) / 2
+    assert gzip.decompress(stored) == data
+
+    # Quem aceita gzip recebe os bytes armazenados; os outros, e quem pede um intervalo, o conteúdo original
+    r = client.get('/files/compressed.txt', headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert r.headers['Content-Length'] == str(len(stored))
+    assert r.headers['ETag'] == f'"{digest}-gzip"'
+    assert r.content == data
+    r = client.get('/files/compressed.txt', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in r.headers
+    assert r.headers['ETag'] == f'"{digest}"'
+    assert r.headers['Vary'] == 'Accept-Encoding'
+    assert r.content == data
+    r = client.get('/files/compressed.txt', headers={'Range': 'bytes=500000-500099'})
+    assert r.status_code == 206
+    assert r.content == data[500000:500100]
+
+    content = blobs.open_content(blobs.get_file('compressed.txt'))
+    assert content.read(1000000, 10) == data[1000000:1000010]
+    assert content.read(10, 10) == data[10:20]
+    assert content.read(len(data) - 5, 10) == data[-5:]
+    content.close()
+
+    # Pelas sessões de upload também
+    data = data.replace(b' ', b';')
+    session_id = client.post('/uploads', json={'filename': 'compressed-session.txt'}).json()['id']
+    client.put(f'/uploads/{session_id}?offset=0', data=data)
+    assert client.post(f'/uploads/{session_id}/complete').status_code == 200
+    assert Blob.get(Blob.digest == hashlib.sha256(data).hexdigest()).codec == 'gzip'
+    assert client.get('/files/compressed-session.txt').content == data
+
+    # Conteúdo que não se comprime é armazenado como chegou
+    data = os.urandom(300000)
+    assert client.post('/upload', files={"file": ('random.bin', data, 'application/octet-stream')}).status_code == 200
+    assert Blob.get(Blob.digest == hashlib.sha256(data).hexdigest()).codec is None
+    with open(stored_path(data), 'rb') as fd:
+        assert fd.read() == data
+    assert not os.listdir(os.path.join(UPLOAD_DIR, '.tmp'))
+
+
+def test_download_file():
+    data = os.urandom(300000)
+    client.post('/upload', files={"file": ('download.bin', data, 'application/octet-stream')})
+
+    r = client.get('/files/download.bin')
+    assert r.status_code == 200
+    assert r.content == data
+    assert r.headers['ETag'] == f'"{hashlib.sha256(data).hexdigest()}"'
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert r.headers['Content-Disposition'].startswith('attachment; filename="download.bin"')
+    etag, last_modified = r.headers['ETag'], r.headers['Last-Modified']
+
+    r = client.get('/files/download.bin', headers={'Range': 'bytes=1000-1999'})
+    assert r.status_code == 206
+    assert r.content == data[1000:2000]
+    assert r.headers['Content-Range'] == f'bytes 1000-1999/{len(data)}'
+    assert client.get('/files/download.bin', headers={'Range': 'bytes=-100'}).content == data[-100:]
+    assert client.get('/files/download.bin', headers={'Range': 'bytes=299000-'}).content == data[299000:]
+
+    r = client.get('/files/download.bin', headers={'Range': f'bytes={len(data)}-'})
+    assert r.status_code == 416
+    assert r.headers['Content-Range'] == f'bytes */{len(data)}'
+
+    # Intervalos inválidos ou múltiplos, e If-Range de outra versão, fazem o arquivo inteiro ser enviado
+    for headers in ({'Range': 'bytes=20-10'}, {'Range': 'bytes=0-1,5-6'},
+                    {'Range': 'bytes=0-9', 'If-Range': '"other"'}):
+        r = client.get('/files/download.bin', headers=headers)
+        assert r.status_code == 200
+        assert r.content == data
+    assert client.get('/files/download.bin', headers={'Range': 'bytes=0-9', 'If-Range': etag}).status_code == 206
+
+    assert client.get('/files/download.bin', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/files/download.bin', headers={'If-Modified-Since': last_modified}).status_code == 304
+
+    # HEAD pela aplicação ASGI diretamente, já que o TestClient não lida com HEAD com Content-Length
+    import asyncio
+    from bench import asgi_request
+    messages = []
+    cookie = f'Authorization={client.cookies["Authorization"]}'
+    status = asyncio.new_event_loop().run_until_complete(
+        asgi_request(app, 'HEAD', '/files/download.bin', {'Cookie': cookie}, messages=messages))
+    assert status == 200
+    assert dict(messages[0]['headers'])[b'content-length'] == str(len(data)).encode()
+    assert b''.join(message.get('body', b'') for message in messages[1:]) == b''
+
+    assert client.get('/files/missing.bin').status_code == 404
+
+
+def test_object_storage(monkeypatch, tmp_path):
+    import storage
+
+    store = storage.LocalObjectStore(str(tmp_path))
+    monkeypatch.setattr(storage, 'backend', storage.ObjectStorage(store, 'uploads', 'blobs/'))
+
+    data = os.urandom(100000)
+    assert client.post('/upload', files={"file": ('object.bin', data, 'application/octet-stream')}).status_code == 200
+    assert not os.path.exists(stored_path(data))
+    assert storage.backend.exists(hashlib.sha256(data).hexdigest())
+
+    assert client.get('/files/object.bin').content == data
+    r = client.get('/files/object.bin', headers={'Range': 'bytes=50000-50099'})
+    assert r.status_code == 206
+    assert r.content == data[50000:50100]
+
+    assert client.delete('/files/object.bin').status_code == 200
+    assert not storage.backend.exists(hashlib.sha256(data).hexdigest())
+    assert os.listdir(os.path.join(str(tmp_path), 'uploads')) == []
+
+
+def test_migrate_storage():
+    from datetime import datetime
+    from database import Blob, FileUpload
+    import migrate_storage
+
+    # Um arquivo do formato original, com o próprio nome, e um blob de antes da divisão em subpastas
+    legacy = os.urandom(1000)
+    with open(os.path.join(UPLOAD_DIR, 'legacy.bin'), 'wb') as fd:
+        fd.write(legacy)
+    FileUpload.create(filename='legacy.bin', uploaded_by='pedrovhb', uploaded_at=datetime.now())
+
+    flat = os.urandom(1000)
+    digest = hashlib.sha256(flat).hexdigest()
+    with open(os.path.join(UPLOAD_DIR, '.blobs', digest), 'wb') as fd:
+        fd.write(flat)
+    Blob.create(digest=digest, size=len(flat), refcount=1, created_at=datetime.now())
+    FileUpload.create(filename='flat.bin', uploaded_by='pedrovhb', uploaded_at=datetime.now(), blob=digest)
+
+    # Antes da migração, os dois continuam acessíveis
+    assert client.get('/files/legacy.bin').content == legacy
+    assert client.get('/files/flat.bin').content == flat
+
+    assert migrate_storage.migrate(dry_run=True) == {'legacy_files': 1, 'flat_blobs': 1}
+    assert migrate_storage.migrate() == {'legacy_files': 1, 'flat_blobs': 1}
+    assert migrate_storage.migrate() == {'legacy_files': 0, 'flat_blobs': 0}
+
+    assert not os.path.exists(os.path.join(UPLOAD_DIR, 'legacy.bin'))
+    assert FileUpload.get(FileUpload.filename == 'legacy.bin').blob_id == hashlib.sha256(legacy).hexdigest()
+    for filename, data in (('legacy.bin', legacy), ('flat.bin', flat)):
+        with open(stored_path(data), 'rb') as fd:
+            assert fd.read() == data
+        assert client.get(f'/files/{filename}').content == data
+        assert client.delete(f'/files/{filename}').status_code == 200
+
+
+def test_upload_commit_claims(monkeypatch):
+    import blobs
+    from database import Blob
+
+    # Simula duas transações concorrentes que passaram juntas pela verificação do nome: a chave primária decide
+    data = os.urandom(5000)
+    assert client.post('/upload', files={"file": ('claimed.bin', data, 'text/plain')}).status_code == 200
+    monkeypatch.setattr(blobs, 'check_filename', lambda filename, user: None)
+    r = client.post('/upload', files={"file": ('claimed.bin', os.urandom(5000), 'text/plain')})
+    assert r.status_code == 409
+    monkeypatch.undo()
+    assert os.listdir(os.path.join(UPLOAD_DIR, '.tmp')) == []
+
+    # Só quem cria a entrada do blob armazena o conteúdo; os demais só acrescentam uma referência
+    digest = hashlib.sha256(data).hexdigest()
+    assert Blob.get_by_id(digest).refcount == 1
+    assert blobs._claim_blob(digest, len(data)) is False
+    assert Blob.get_by_id(digest).refcount == 2
+    Blob.update(refcount=1).where(Blob.digest == digest).execute()
+    assert client.delete('/files/claimed.bin').status_code == 200
+    assert Blob.get_or_none(Blob.digest == digest) is None
+
+
+def test_upload_stores_content_before_transaction(monkeypatch):
+    import blobs
+    import storage
+    from database import db
+
+    # O conteúdo vai pro backend antes da transação, que segura o lock de escrita do banco de dados
+    put = storage.backend.put
+
+    def put_outside_transaction(key, source_path):
+        assert not db.in_transaction()
+        put(key, source_path)
+
+    monkeypatch.setattr(storage.backend, 'put', put_outside_transaction)
+    data = [os.urandom(5000) for _ in range(3)]
+    assert client.post('/upload', files={"file": ('staged.bin', data[0])}).status_code == 200
+    r = client.post('/upload/batch', files=[('file', ('staged-1.bin', data[1])), ('file', ('staged-2.bin', data[0]))])
+    assert [result['status'] for result in r.json()['files']] == [200, 200]
+
+    # Se o arquivo não for criado, o conteúdo colocado é removido
+    monkeypatch.setattr(blobs, 'check_filename', lambda filename, user: None)
+    assert client.post('/upload', files={"file": ('staged.bin', data[2])}).status_code == 409
+    r = client.post('/upload/batch', files=[('file', ('staged-1.bin', data[2]))])
+    assert r.json()['files'][0]['status'] == 409
+    assert not os.path.exists(stored_path(data[2]))
+
+    # Se uma remoção concorrente do mesmo conteúdo o apagar antes da transação, ele é colocado de novo
+    stage = blobs._stage_content
+    removed = []
+
+    def stage_then_remove(digest, data_path):
+        staged = stage(digest, data_path)
+        if not removed:
+            removed.append(digest)
+            storage.backend.delete(digest)
+        return staged
+
+    monkeypatch.setattr(blobs, '_stage_content', stage_then_remove)
+    assert client.post('/upload', files={"file": ('staged-3.bin', data[2])}).status_code == 200
+    assert client.get('/files/staged-3.bin').content == data[2]
+    removed.clear()
+    r = client.post('/upload/batch', files=[('file', ('staged-4.bin', data[2] + b'4'))])
+    assert r.json()['files'][0]['status'] == 200
+    assert client.get('/files/staged-4.bin').content == data[2] + b'4'
+    assert not os.listdir(os.path.join(UPLOAD_DIR, '.tmp'))
+    monkeypatch.undo()
+    for filename in ('staged.bin', 'staged-1.bin', 'staged-2.bin', 'staged-3.bin', 'staged-4.bin'):
+        assert client.delete(f'/files/{filename}').status_code == 200
+
+
+def test_delete_removes_content_after_commit(monkeypatch):
+    import pytest
+    from database import db
+
+    # Se a transação que remove o arquivo for desfeita, o conteúdo continua no armazenamento
+    data = os.urandom(5000)
+    assert client.post('/upload', files={"file": ('deleted.bin', data)}).status_code == 200
+
+    def failing_commit():
+        raise OSError('Commit failure')
+
+    monkeypatch.setattr(db, 'commit', failing_commit)
+    with pytest.raises(OSError):
+        client.delete('/files/deleted.bin')
+    monkeypatch.undo()
+    assert client.get('/files/deleted.bin').content == data
+    assert client.delete('/files/deleted.bin').status_code == 200
+    assert not os.path.exists(stored_path(data))
+
+
+def test_sweep_orphaned_files():
+    import blobs
+    import sessions
+
+    session_id = client.post('/uploads', json={'filename': 'swept.bin'}).json()['id']
+    old = time.time() - 7200
+    paths = {name: os.path.join(directory, name) for directory, name in (
+        (blobs.TMP_DIR, 'old-temp'), (blobs.TMP_DIR, 'new-temp'), (sessions.PARTIAL_DIR, 'old-partial'))}
+    for name, path in paths.items():
+        open(path, 'wb').close()
+        if name.startswith('old'):
+            os.utime(path, (old, old))
+    os.utime(sessions.partial_path(session_id), (old, old))
+
+    assert blobs.sweep_temp_files(3600) == 1
+    assert sessions.sweep_partial_files(3600) == 1
+    assert not os.path.exists(paths['old-temp']) and not os.path.exists(paths['old-partial'])
+    assert os.path.exists(paths['new-temp'])
+    # O arquivo parcial de uma sessão existente fica, por mais antigo que seja
+    assert os.path.exists(sessions.partial_path(session_id))
+    os.remove(paths['new-temp'])
+    assert client.delete(f'/uploads/{session_id}').status_code == 200
+
+
+def test_upload_session_locks(monkeypatch):
+    from datetime import datetime, timedelta
+    from database import UploadLock
+
+    data = os.urandom(20000)
+    session_id = client.post('/uploads', json={'filename': 'locked.bin', 'size': len(data)}).json()['id']
+
+    # Um envio em andamento, possivelmente em outro processo do servidor, impede outro envio e a finalização
+    lock = UploadLock.create(session=session_id, number=-1, expires_at=datetime.now() + timedelta(minutes=1))
+    assert client.put(f'/uploads/{session_id}?offset=0', data=data).status_code == 409
+    assert client.post(f'/uploads/{session_id}/complete').status_code == 409
+
+    # O lock de um processo que morreu no meio do envio expira sozinho
+    lock.expires_at = datetime.now() - timedelta(seconds=1)
+    lock.save()
+    assert client.put(f'/uploads/{session_id}?offset=0', data=data).json()['offset'] == len(data)
+    assert UploadLock.select().where(UploadLock.session == session_id).count() == 0
+    assert client.post(f'/uploads/{session_id}/complete').status_code == 200
+
+    # No PostgreSQL, outra requisição pode pegar o lock entre a verificação e a inserção; a chave primária a barra
+    session_id = client.post('/uploads', json={'filename': 'raced.bin', 'size': len(data)}).json()['id']
+    create = UploadLock.create.__func__
+
+    def create_after_other_request(cls, **fields):
+        create(cls, **fields)
+        return create(cls, **fields)
+    monkeypatch.setattr(UploadLock, 'create', classmethod(create_after_other_request))
+    assert client.put(f'/uploads/{session_id}?offset=0', data=data).status_code == 409
+    monkeypatch.undo()
+    assert client.delete(f'/uploads/{session_id}').status_code == 200
+
+
+def test_upload_deduplicated_content():
+    data = os.urandom(10000)
+    digest = hashlib.sha256(data).hexdigest()
+    assert client.get(f'/blobs/{digest}').status_code == 404
+
+    r = client.post('/upload', files={"file": ('original.bin', data, 'application/octet-stream')})
+    assert r.status_code == 200
+    r = client.get(f'/blobs/{digest}')
+    assert r.json() == {'sha256': digest, 'size': len(data)}
+
+    # Mesmo conteúdo com outro nome, enviando os bytes ou só o hash, não ocupa espaço extra
+    r = client.post('/upload', files={"file": ('copy.bin', data, 'application/octet-stream')})
+    assert r.status_code == 200
+    r = client.post('/upload/by-hash', json={'filename': 'linked.bin', 'sha256': digest})
+    assert r.status_code == 200
+    r = client.post('/upload/by-hash', json={'filename': 'linked.bin', 'sha256': digest})
+    assert r.status_code == 409
+    r = client.post('/upload/by-hash', json={'filename': 'unknown.bin', 'sha256': '0' * 64})
+    assert r.status_code == 404
+    assert os.listdir(os.path.join(UPLOAD_DIR, '.tmp')) == []
+
+    # O conteúdo só é apagado quando o último arquivo que o referencia é removido
+    assert client.delete('/files/original.bin').status_code == 200
+    assert client.delete('/files/copy.bin').status_code == 200
+    assert os.path.exists(stored_path(data))
+    assert client.delete('/files/linked.bin').status_code == 200
+    assert not os.path.exists(stored_path(data))
+    assert client.get(f'/blobs/{digest}').status_code == 404
+    assert client.delete('/files/linked.bin').status_code == 404
+
+
+def test_upload_batch(monkeypatch):
+    from database import Blob
+
+    small = [os.urandom(1000) for _ in range(20)]
+    large = os.urandom(3 * 1024 * 1024)
+    files = [('file', (f'batch-{i}.bin', data, 'application/octet-stream')) for i, data in enumerate(small)]
+    files += [('file', ('batch-large.bin', large, 'application/octet-stream')),
+              ('file', ('batch-copy.bin', small[0], 'application/octet-stream')),
+              ('file', ('testfile.py', b'conflict', 'text/plain')),
+              ('file', ('batch-0.bin', b'duplicate', 'application/octet-stream')),
+              ('other', ('ignored.bin', b'ignored', 'application/octet-stream'))]
+    r = client.post('/upload/batch', files=files)
+    assert r.status_code == 200
+    results = r.json()['files']
+    assert [result['filename'] for result in results] == [name for field, (name, _, _) in files if field == 'file']
+    assert all(result['status'] == 200 for result in results[:22])
+    assert results[22] == {'filename': 'testfile.py', 'status': 409, 'detail': 'Filename already exists.'}
+    assert results[23]['status'] == 409
+
+    for i, data in enumerate(small):
+        assert client.get(f'/files/batch-{i}.bin').content == data
+    assert client.get('/files/batch-large.bin').content == large
+    assert client.get('/files/batch-copy.bin').content == small[0]
+    assert Blob.get(Blob.digest == hashlib.sha256(small[0]).hexdigest()).refcount == 2
+    assert client.get('/files/ignored.bin').status_code == 404
+    assert client.get('/files/testfile.py').content != b'conflict'
+    assert not os.listdir(os.path.join(UPLOAD_DIR, '.tmp'))
+
+    assert client.post('/upload/batch', files={'other': ('x.bin', b'x')}).status_code == 422
+
+    # Se o armazenamento falhar no meio, nenhum arquivo do lote é criado, e o que já foi armazenado é removido
+    import pytest
+    import storage
+    put = storage.backend.put
+
+    def failing_put(key, source_path):
+        if key == hashlib.sha256(contents[1]).hexdigest():
+            raise OSError('Disk failure')
+        put(key, source_path)
+
+    monkeypatch.setattr(storage.backend, 'put', failing_put)
+    contents = [os.urandom(1000), os.urandom(1000)]
+    with pytest.raises(OSError):
+        client.post('/upload/batch', files=[('file', (f'failed-{i}.bin', data)) for i, data in enumerate(contents)])
+    assert client.get('/files/failed-0.bin').status_code == 404
+    assert not os.path.exists(stored_path(contents[0]))
+    assert not os.listdir(os.path.join(UPLOAD_DIR, '.tmp'))
+
+
+def test_upload_digest_verification():
+    import base64
+
+    data = os.urandom(200000)
+    digest = hashlib.sha256(data).hexdigest()
+    wrong = hashlib.sha256(b'other').hexdigest()
+
+    # No cabeçalho ou numa parte depois do arquivo
+    r = client.post('/upload', files={"file": ('digest.bin', data)}, headers={'X-Upload-SHA256': wrong})
+    assert r.status_code == 400
+    assert r.json()['detail'] == 'Content digest mismatch.'
+    r = client.post('/upload', files=[('file', ('digest.bin', data)), ('sha256', (None, wrong))])
+    assert r.status_code == 400
+    assert client.get('/files/digest.bin').status_code == 404
+    assert client.post('/upload', files={"file": ('digest.bin', data)},
+                       headers={'X-Upload-SHA256': 'xyz'}).status_code == 400
+    r = client.post('/upload', files=[('file', ('digest.bin', data)), ('sha256', (None, digest.upper()))])
+    assert r.status_code == 200
+    assert not os.listdir(os.path.join(UPLOAD_DIR, '.tmp'))
+
+    # O hash fica registrado com o conteúdo, e é enviado nos downloads
+    r = client.get('/files/digest.bin')
+    assert r.headers['Repr-Digest'] == f'sha-256=:{base64.b64encode(bytes.fromhex(digest)).decode()}:'
+
+    # Nas sessões, informado na criação ou na finalização
+    data = os.urandom(100000)
+    session_id = client.post('/uploads', json={'filename': 'digest-session.bin', 'sha256': wrong}).json()['id']
+    client.put(f'/uploads/{session_id}?offset=0', data=data)
+    assert client.post(f'/uploads/{session_id}/complete').status_code == 400
+    assert client.get(f'/uploads/{session_id}').json()['sha256'] == wrong
+    client.delete(f'/uploads/{session_id}')
+    session_id = client.post('/uploads', json={'filename': 'digest-session.bin'}).json()['id']
+    client.put(f'/uploads/{session_id}?offset=0', data=data)
+    assert client.post(f'/uploads/{session_id}/complete', headers={'X-Upload-SHA256': wrong}).status_code == 400
+    r = client.post(f'/uploads/{session_id}/complete', headers={'X-Upload-SHA256': hashlib.sha256(data).hexdigest()})
+    assert r.status_code == 200
+
+    # No lote, cada arquivo pode ser seguido do seu hash
+    contents = [os.urandom(1000), os.urandom(1000)]
+    r = client.post('/upload/batch', files=[
+        ('file', ('digest-0.bin', contents[0])), ('sha256', (None, hashlib.sha256(contents[0]).hexdigest())),
+        ('file', ('digest-1.bin', contents[1])), ('sha256', (None, wrong))])
+    assert [result['status'] for result in r.json()['files']] == [200, 400]
+    assert client.get('/files/digest-0.bin').content == contents[0]
+    assert client.get('/files/digest-1.bin').status_code == 404
+    assert not os.listdir(os.path.join(UPLOAD_DIR, '.tmp'))
+
+
+def test_reserve_filename(monkeypatch):
+    import blobs
+    from database import Reservation
+
+    r = client.post('/upload/reserve', json={'filename': 'testfile.py', 'size': 10})
+    assert r.status_code == 409
+    r = client.post('/upload/reserve', json={'filename': 'reserved.bin', 'size': 1 << 60})
+    assert r.status_code == 507
+    r = client.post('/upload/reserve', json={'filename': 'reserved.bin', 'size': 10})
+    assert r.status_code == 200
+    assert r.json()['filename'] == 'reserved.bin'
+
+    # Enquanto a reserva vale, outros usuários não conseguem usar o nome
+    other_client = TestClient(app)
+    other_client.post('/register', json={'username': 'otheruser', 'password': 'abc123'})
+    assert other_client.post('/login', json={'username': 'otheruser', 'password': 'abc123'}).status_code == 200
+    r = other_client.post('/upload/reserve', json={'filename': 'reserved.bin'})
+    assert r.status_code == 409
+    r = other_client.post('/uploads', json={'filename': 'reserved.bin', 'size': 10})
+    assert r.status_code == 409
+    r = other_client.post('/upload', files={"file": ('reserved.bin', b'0123456789', 'application/octet-stream')})
+    assert r.status_code == 409
+
+    # No PostgreSQL, uma requisição concorrente pode passar pela verificação; mesmo assim, a reserva não muda de dono
+    with monkeypatch.context() as patched:
+        patched.setattr(blobs, 'check_filename', lambda filename, user: None)
+        assert other_client.post('/upload/reserve', json={'filename': 'reserved.bin'}).status_code == 409
+    assert Reservation.get(Reservation.filename == 'reserved.bin').owner_id == 'pedrovhb'
+
+    r = client.post('/upload', files={"file": ('reserved.bin', b'0123456789', 'application/octet-stream')})
+    assert r.status_code == 200
+    assert client.delete('/files/reserved.bin').status_code == 200
+    assert other_client.post('/upload/reserve', json={'filename': 'reserved.bin'}).status_code == 200
+
+
+def test_upload_rejected_before_body():
+    body_read = []
+
+    def body():
+        body_read.append(True)
+        yield b'never sent'
+
+    # Com o nome no cabeçalho, o conflito é detectado sem ler o corpo
+    r = client.post('/upload', data=body(), headers={'X-Upload-Filename': 'testfile.py',
+                                                     'Content-Type': 'multipart/form-data; boundary=x'})
+    assert r.status_code == 409
+    assert body_read == []
+
+    r = client.post('/upload', files={"file": ('other name.bin', b'abc', 'application/octet-stream')},
+                    headers={'X-Upload-Filename': 'declared%20name.bin'})
+    assert r.status_code == 400
+
+
+def test_get_files_pages():
+    for index in range(5):
+        r = client.post('/upload', files={"file": (f'page-{index}.txt', b'%d' % index, 'text/plain')})
+        assert r.status_code == 200
+    all_files = [file['filename'] for file in client.get('/files', params={'limit': 1000}).json()['files']]
+
+    # Percorrendo as páginas pelo cursor, cada arquivo aparece uma única vez, na mesma ordem
+    paged_files = []
+    cursor = None
+    while True:
+        params = {'limit': 2} if cursor is None else {'limit': 2, 'cursor': cursor}
+        r = client.get('/files', params=params)
+        assert r.status_code == 200
+        assert len(r.json()['files']) <= 2
+        paged_files += [file['filename'] for file in r.json()['files']]
+        cursor = r.json()['next_cursor']
+        if cursor is None:
+            break
+    assert paged_files == all_files
+    assert all_files[-5:] == [f'page-{index}.txt' for index in range(5)]
+
+    assert client.get('/files', params={'cursor': 'invalid'}).status_code == 400
+    assert client.get('/files', params={'limit': 0}).status_code == 422
+
+
+def test_search_files():
+    from datetime import datetime, timedelta, timezone
+    from starlette.testclient import TestClient
+
+    other_client = TestClient(app)
+    other_client.post('/register', json={'username': 'searcher', 'password': 'abc123'})
+    other_client.post('/login', json={'username': 'searcher', 'password': 'abc123'})
+    started = datetime.now()
+    for name in ('build-1.zip', 'build-2.zip', 'builder.txt'):
+        assert other_client.post('/upload', files={"file": (name, name.encode())}).status_code == 200
+    assert client.post('/upload', files={"file": ('build-3.zip', b'build-3')}).status_code == 200
+
+    def search(**params):
+        r = client.get('/files', params=params)
+        assert r.status_code == 200
+        return [file['filename'] for file in r.json()['files']]
+
+    assert search(uploaded_by='searcher') == ['build-1.zip', 'build-2.zip', 'builder.txt']
+    assert search(prefix='build-') == ['build-1.zip', 'build-2.zip', 'build-3.zip']
+    assert search(prefix='build-', uploaded_by='searcher', limit=1) == ['build-1.zip']
+    assert search(uploaded_after=started.isoformat()) == ['build-1.zip', 'build-2.zip', 'builder.txt', 'build-3.zip']
+    assert search(uploaded_before=started.isoformat(), prefix='build') == []
+    utc_start = started.astimezone(timezone.utc).isoformat()
+    assert search(uploaded_after=utc_start, prefix='builder') == ['builder.txt']
+    assert search(uploaded_after=(datetime.now() + timedelta(hours=1)).isoformat()) == []
+
+    # O cursor continua a busca de onde a página anterior parou
+    r = client.get('/files', params={'prefix': 'build', 'limit': 2}).json()
+    r = client.get('/files', params={'prefix': 'build', 'limit': 2, 'cursor': r['next_cursor']}).json()
+    assert [file['filename'] for file in r['files']] == ['builder.txt', 'build-3.zip']
+    assert r['next_cursor'] is None
+
+    assert client.get('/files', params={'uploaded_after': 'yesterday'}).status_code == 422
+
+
+def test_catalog_cache(monkeypatch):
+    import catalog
+    from fastapi.encoders import jsonable_encoder
+
+    # Um cache separado faz o papel do de outro processo do servidor: vê as mudanças pela versão do catálogo
+    other = catalog.CatalogCache(1000)
+    assert other.sync()
+    assert other.get('cached.txt') is None
+    assert client.post('/upload', files={"file": ('cached.txt', b'cached', 'text/plain')}).status_code == 200
+    assert other.sync()
+    record = other.get('cached.txt')
+    assert (record.uploaded_by, record.blob_id, record.size) == ('pedrovhb', hashlib.sha256(b'cached').hexdigest(), 6)
+
+    # Listagem, existência de nomes e downloads saem do cache, sem consultar os arquivos no banco de dados
+    def fail(*args):
+        raise AssertionError('catalog queried')
+    monkeypatch.setattr(catalog, 'query_files', fail)
+    monkeypatch.setattr(catalog, '_select_records', fail)
+    pages = []
+    cursor = None
+    while True:
+        page = client.get('/files', params={'limit': 2, **({'cursor': cursor} if cursor else {})}).json()
+        pages += page['files']
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    monkeypatch.undo()
+    assert pages == jsonable_encoder(catalog.query_files(1000)['files'])
+    assert 'cached.txt' in [file['filename'] for file in pages]
+
+    assert client.delete('/files/cached.txt').status_code == 200
+    assert other.sync()
+    assert other.get('cached.txt') is None
+    assert client.get('/files/cached.txt').status_code == 404
+
+    # Uma versão lida antes de um upload atualizar o cache é atendida pelo cache atual, sem recarregá-lo nem
+    # voltar a sua versão
+    from events import last_seq
+    stale = last_seq()
+    assert client.post('/upload', files={"file": ('stale.txt', b'stale', 'text/plain')}).status_code == 200
+    assert catalog.cache.version > stale
+    current = catalog.cache.version
+    monkeypatch.setattr(catalog.CatalogCache, '_load', fail)
+    page = catalog.list_files(1000, None, stale)
+    monkeypatch.undo()
+    assert 'stale.txt' in [file['filename'] for file in page['files']]
+    assert catalog.cache.version == current
+    assert client.delete('/files/stale.txt').status_code == 200
+
+    # Com mais arquivos que o limite, o cache não é usado
+    small = catalog.CatalogCache(1)
+    assert not small.sync()
+    assert small.get('pedrovhb') is None
+
+
+def test_change_feed():
+    import asyncio
+    import blobs
+    from events import iter_events, last_seq, notifier
+    from threadpool import run_db
+
+    start = last_seq()
+    data = b'feed content'
+    r = client.post('/upload', files={"file": ('feed.txt', data, 'text/plain')})
+    assert r.status_code == 200
+
+    async def connected():
+        return False
+
+    async def read_feed():
+        # Retomando a partir de `start`, o feed começa pelo evento seguinte
+        feed = iter_events(start, connected, heartbeat=5)
+        message = await feed.__anext__()
+        assert message.startswith(b'id: %d\nevent: added\n' % (start + 1))
+        assert b'"filename": "feed.txt"' in message
+
+        # Um arquivo novo chega ao feed assim que é criado, sem esperar o heartbeat
+        next_message = asyncio.ensure_future(feed.__anext__())
+        await asyncio.sleep(0.05)
+        assert not next_message.done()
+        await run_db(blobs.link_file, 'feed-copy.txt', 'pedrovhb', hashlib.sha256(data).hexdigest())
+        notifier.notify()
+        message = await asyncio.wait_for(next_message, 1)
+        assert message.startswith(b'id: %d\nevent: added\n' % (start + 2))
+        await feed.aclose()
+
+        # Sem `since`, o feed começa no evento atual; sem eventos novos, só envia keepalives
+        feed = iter_events(None, connected, heartbeat=0.01)
+        assert await feed.__anext__() == b'id: %d\nevent: ready\ndata: {}\n\n' % (start + 2)
+        assert await feed.__anext__() == b': keepalive\n\n'
+        await feed.aclose()
+
+        feed = iter_events(start + 1000, connected)
+        assert (await feed.__anext__()).startswith(b'id: %d\nevent: reset\n' % (start + 2))
+        await feed.aclose()
+
+    asyncio.new_event_loop().run_until_complete(read_feed())
+
+    assert client.delete('/files/feed-copy.txt').status_code == 200
+    assert last_seq() == start + 3
+
+
+def test_record_event_orders_postgresql_transactions(monkeypatch):
+    import peewee
+    import events
+
+    # No PostgreSQL, o advisory lock é pego antes de o evento receber seu número de sequência
+    class FakePostgresql(peewee.PostgresqlDatabase):
+        def execute_sql(self, sql, params=None, commit=None):
+            calls.append(('lock', sql, params))
+
+    calls = []
+    monkeypatch.setattr(events, 'db', FakePostgresql(None))
+    monkeypatch.setattr(events.CatalogEvent, 'create', lambda **fields: calls.append(('create', fields['kind'])))
+    events.record_event('added', events.FileUpload(filename='a.txt', uploaded_by='pedrovhb'))
+    assert calls == [('lock', 'SELECT pg_advisory_xact_lock(%s)', (events.EVENT_LOG_LOCK,)), ('create', 'added')]
+
+
+def test_get_files_not_modified(monkeypatch):
+    import catalog
+
+    r = client.get('/files')
+    etag = r.headers['ETag']
+
+    # Com o ETag atual, a resposta é 304 sem consultar o banco de dados
+    def fail(*args):
+        raise AssertionError('catalog queried')
+    monkeypatch.setattr(catalog, 'list_files', fail)
+    r = client.get('/files', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.content == b''
+    assert r.headers['ETag'] == etag
+    monkeypatch.undo()
+
+    # Depois de uma mudança, o ETag antigo não vale mais
+    r = client.post('/upload', files={"file": ('etag.txt', b'etag', 'text/plain')})
+    assert r.status_code == 200
+    r = client.get('/files', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+    assert client.get('/files', headers={'If-None-Match': f'"other", W/{r.headers["ETag"]}'}).status_code == 304
+
+
+def test_metrics(monkeypatch, tmp_path):
+    import json
+    import metrics
+
+    def value(lines, name):
+        return float(next((line.split()[-1] for line in lines if line.startswith(name + ' ')), 0))
+
+    before = client.get('/metrics').text.splitlines()
+    data = os.urandom(50000)
+    client.post('/upload', files={"file": ('metrics.bin', data)})
+    client.get('/files/metrics.bin')
+    client.get('/files/missing.bin')
+    lines = client.get('/metrics').text.splitlines()
+
+    # As rotas aparecem pelo padrão, e não pelo caminho de cada requisição
+    for status in (200, 404):
+        name = f'http_requests_total{{method="GET",route="/files/{{filename}}",status="{status}"}}'
+        assert value(lines, name) == value(before, name) + 1
+    assert not any('metrics.bin' in line for line in lines)
+    name = 'http_request_duration_seconds_count{method="POST",route="/upload"}'
+    assert value(lines, name) == value(before, name) + 1
+    assert value(lines, 'upload_received_bytes_total') > value(before, 'upload_received_bytes_total') + len(data)
+    name = 'uploaded_files_total{method="upload"}'
+    assert value(lines, name) == value(before, name) + 1
+    assert value(lines, 'uploads_in_progress') == 0
+    assert value(lines, 'db_query_duration_seconds_count{statement="SELECT"}') > 0
+    assert value(lines, 'password_hash_duration_seconds_count{operation="verify"}') > 0
+
+    # Com vários processos, os contadores dos outros são somados, e os gauges só dos que ainda existem
+    monkeypatch.setattr(metrics, 'directory', str(tmp_path))
+    dead_pid = 2 ** 22 + 1
+    with open(tmp_path / f'{dead_pid}.json', 'w') as fd:
+        json.dump({'pid': dead_pid, 'metrics': {'upload_received_bytes_total': [[[], 1000]],
+                                                'uploads_in_progress': [[[], 5]]}}, fd)
+    # Um processo que terminou e cujo pid foi reaproveitado por este continua somado, sem ser confundido com ele
+    with open(tmp_path / f'{os.getpid()}-1.json', 'w') as fd:
+        json.dump({'pid': os.getpid(), 'started': 1, 'metrics': {'upload_received_bytes_total': [[[], 500]],
+                                                                 'uploads_in_progress': [[[], 7]]}}, fd)
+    merged = client.get('/metrics').text.splitlines()
+    assert value(merged, 'upload_received_bytes_total') == value(lines, 'upload_received_bytes_total') + 1500
+    assert value(merged, 'uploads_in_progress') == 0
+    assert len(list(tmp_path.glob(f'{os.getpid()}-*.json'))) == 2
+
+
+def test_request_profiling(monkeypatch, tmp_path):
+    import pstats
+    import profiling
+
+    # Desligado, nenhuma requisição é profilada e os perfis não existem
+    r = client.post('/login', json={'username': 'pedrovhb', 'password': 'abc123'},
+                    headers={'X-Profile-Token': 'secret'})
     assert r.status_code == 200
+    assert 'X-Profile-Id' not in r.headers
+    assert client.get('/profiles').status_code == 404
+
+    monkeypatch.setattr(profiling, 'token', 'secret')
+    monkeypatch.setattr(profiling, 'directory', str(tmp_path))
+    assert 'X-Profile-Id' not in client.get('/files').headers
+    r = client.post('/login', json={'username': 'pedrovhb', 'password': 'abc123'},
+                    headers={'X-Profile-Token': 'secret'})
+    assert r.status_code == 200
+    name = r.headers['X-Profile-Id']
+
+    # O perfil inclui o Argon2, calculado em outro processo, e as consultas feitas no pool de I/O
+    functions = {function for _, _, function in pstats.Stats(str(tmp_path / name)).stats}
+    assert '_verify' in functions
+    assert 'execute_sql' in functions
+
+    assert client.get('/profiles').status_code == 403
+    r = client.get('/profiles', headers={'X-Profile-Token': 'secret'})
+    assert [profile['name'] for profile in r.json()['profiles']] == [name]
+    r = client.get(f'/profiles/{name}', headers={'X-Profile-Token': 'secret'})
+    assert r.content == (tmp_path / name).read_bytes()
+    assert client.get('/profiles/..%2Fuploads.db', headers={'X-Profile-Token': 'secret'}).status_code == 404
+
+
+def test_profiling_long_requests(monkeypatch, tmp_path):
+    import asyncio
+    import profiling
+
+    # A amostragem ignora o feed de mudanças e os downloads, mas não a remoção de arquivos
+    monkeypatch.setattr(profiling, 'sample_rate', 1.0)
+    monkeypatch.setattr(profiling, 'directory', str(tmp_path))
+    middleware = profiling.ProfilingMiddleware(None)
+    requests = [('GET', '/events'), ('GET', '/files/a.txt'), ('HEAD', '/files/a.txt'), ('DELETE', '/files/a.txt'),
+                ('GET', '/files'), ('POST', '/upload')]
+    selected = [request for request in requests
+                if middleware._selected({'method': request[0], 'path': request[1], 'headers': []})]
+    assert selected == [('DELETE', '/files/a.txt'), ('GET', '/files'), ('POST', '/upload')]
+
+    # Uma requisição mais longa que o limite tem o perfil encerrado e gravado durante ela, liberando o profiling
+    # pra outras requisições
+    monkeypatch.setattr(profiling, 'max_seconds', 0.05)
+    messages = []
+
+    async def slow_app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await asyncio.sleep(0.5)
+        messages.append((profiling._active, [entry.name for entry in tmp_path.iterdir()]))
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/slow', 'headers': []}
+    asyncio.new_event_loop().run_until_complete(profiling.ProfilingMiddleware(slow_app)(scope, None, send))
+    name = dict(messages[0]['headers'])[b'x-profile-id'].decode()
+    assert messages[1] == (False, [name])
+    assert not profiling._active
+
+
+def test_logging_pipeline():
+    import json
+    import logging
+    import queue
+    import logs
+
+    # Cada requisição tem um id, o recebido ou um novo, devolvido na resposta
+    assert client.get('/files', headers={'X-Request-ID': 'req-123'}).headers['X-Request-ID'] == 'req-123'
+    assert len(client.get('/files').headers['X-Request-ID']) == 16
+
+    # Com a fila cheia, os registros são descartados em vez de esperar, os abaixo de WARNING antes dos outros
+    handler = logs.DroppingQueueHandler(queue.Queue(4))
+    records = [logging.makeLogRecord({'levelno': level, 'msg': 'message %d', 'args': (i,)})
+               for i, level in enumerate([logging.INFO] * 4 + [logging.WARNING] * 2)]
+    for record in records:
+        handler.enqueue(record)
+    assert [handler.queue.get_nowait().args for _ in range(4)] == [(0,), (1,), (2,), (4,)]
+    assert handler.take_dropped() == 2
+    assert handler.take_dropped() == 0
+
+    record = logging.makeLogRecord({'name': 'upload_server', 'levelno': logging.INFO, 'levelname': 'INFO',
+                                    'msg': 'Uploaded %s', 'args': ('a.txt',), 'request_id': 'req-123', 'bytes': 10})
+    assert json.loads(logs.JsonFormatter().format(record)) == {
+        'time': json.loads(logs.JsonFormatter().format(record))['time'], 'level': 'INFO', 'logger': 'upload_server',
+        'message': 'Uploaded a.txt', 'request_id': 'req-123', 'bytes': 10}
+
+
+def test_login_rehashes_outdated_password_hash():
+    from argon2 import PasswordHasher
+    from database import User
+
+    old_hash = PasswordHasher(time_cost=1, memory_cost=1024, parallelism=1).hash('abc123')
+    User.create(username='olduser', password_hash=old_hash)
+    r = TestClient(app).post('/login', json={'username': 'olduser', 'password': 'abc123'})
+    assert r.status_code == 200
+
+    new_hash = User.get(User.username == 'olduser').password_hash
+    assert new_hash != old_hash
+    assert not PasswordHasher().check_needs_rehash(new_hash)
+    assert PasswordHasher().verify(new_hash, 'abc123')
+
+
+def test_password_queue_full(monkeypatch):
+    import passwords
+
+    monkeypatch.setattr(passwords, 'PASSWORD_QUEUE_LIMIT', 0)
+    r = client.post('/login', json={'username': 'pedrovhb', 'password': 'abc123'})
+    assert r.status_code == 503
+    assert r.headers['Retry-After'] == '1'
+
+
+def test_token_cache(monkeypatch):
+    import jwt
+    import auth
+
+    auth.token_cache.clear()
+    assert client.get('/files').status_code == 200
+
+    # Com o token já no cache, a assinatura não é verificada de novo
+    def fail(*args, **kwargs):
+        raise AssertionError('token decoded again')
+    monkeypatch.setattr(jwt, 'decode', fail)
+    assert client.get('/files').status_code == 200
+    monkeypatch.undo()
+
+    # As entradas respeitam o TTL do cache e o `exp` do token, e o tamanho máximo
+    cache = auth.TokenCache(max_size=2, ttl=60)
+    cache.put('a', {'exp': time.time() + 600, 'jti': 'a'})
+    cache.put('expired', {'exp': time.time() - 1, 'jti': 'expired'})
+    assert cache.get('a') is not None
+    assert cache.get('expired') is None
+    cache.put('b', {'exp': time.time() + 600, 'jti': 'b'})
+    cache.put('c', {'exp': time.time() + 600, 'jti': 'c'})
+    assert cache.get('a') is None and cache.get('c') is not None
+
+    # Um token revogado durante a sua verificação não volta pro cache
+    cache.revoke('c', {'exp': time.time() + 600, 'jti': 'c'})
+    assert cache.get('c') is None
+    cache.put('c', {'exp': time.time() + 600, 'jti': 'c'})
+    assert cache.get('c') is None
+
+
+def test_logout_during_token_verification(monkeypatch):
+    import auth
+
+    session = TestClient(app)
+    assert session.post('/login', json={'username': 'pedrovhb', 'password': 'abc123'}).status_code == 200
+    auth.token_cache.clear()
+
+    # O logout acontece entre a consulta das revogações e a inclusão do token no cache
+    put = auth.token_cache.put
+
+    def put_after_logout(token, claims):
+        auth.revoke_token(token)
+        put(token, claims)
+    monkeypatch.setattr(auth.token_cache, 'put', put_after_logout)
+    assert session.get('/files').status_code == 200
+    monkeypatch.undo()
+    assert session.get('/files').status_code == 403
+
+
+def test_invalid_tokens():
+    import jwt
+    from auth import JWT_SECRET
+
+    expired = jwt.encode({'username': 'pedrovhb', 'exp': int(time.time()) - 10, 'jti': 'x'},
+                         key=JWT_SECRET, algorithm='HS256').decode()
+    without_exp = jwt.encode({'username': 'pedrovhb'}, key=JWT_SECRET, algorithm='HS256').decode()
+    for token in (expired, without_exp, 'garbage'):
+        r = client.get('/files', cookies={'Authorization': f'Bearer {token}'})
+        assert r.status_code == 403
+
+
+def test_logout():
+    other_client = TestClient(app)
+    assert other_client.post('/login', json={'username': 'pedrovhb', 'password': 'abc123'}).status_code == 200
+    token = other_client.cookies['Authorization']
+    assert client.get('/files', cookies={'Authorization': token}).status_code == 200
+    assert other_client.post('/logout').status_code == 200
+
+    # O token revogado deixa de ser aceito, mesmo que alguém o tenha guardado
+    r = client.get('/files', cookies={'Authorization': token})
+    assert r.status_code == 403
+    assert client.get('/files').status_code == 200
+
+
+def test_concurrent_uploads_and_listing():
+    # Uploads (metade com o mesmo conteúdo, disputando o mesmo blob) e listagens ao mesmo tempo, no mesmo event
+    # loop, como no servidor: as operações de banco de dados rodam em paralelo nas threads do pool de I/O
+    import asyncio
+    from bench import asgi_request
+    from database import Blob, FileUpload
+
+    cookie = f'Authorization={client.cookies["Authorization"]}'
+    shared = os.urandom(50000)
+
+    def body(filename, data):
+        yield (b'--xyz\r\nContent-Disposition: form-data; name="file"; filename="' + filename.encode() + b'"\r\n'
+               b'Content-Type: application/octet-stream\r\n\r\n')
+        yield data
+        yield b'\r\n--xyz--\r\n'
+
+    async def hammer():
+        uploads = [asgi_request(app, 'POST', '/upload',
+                                {'Cookie': cookie, 'Content-Type': 'multipart/form-data; boundary=xyz'},
+                                body(f'concurrent-{index}.bin', shared if index % 2 else os.urandom(50000)))
+                   for index in range(40)]
+        listings = [asgi_request(app, 'GET', '/files', {'Cookie': cookie}) for _ in range(200)]
+        return await asyncio.gather(*uploads, *listings)
+
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(hammer()) == [200] * 240
+
+    filenames = {file.filename for file in FileUpload.select().where(FileUpload.filename.startswith('concurrent-'))}
+    assert filenames == {f'concurrent-{index}.bin' for index in range(40)}
+    assert Blob.get(Blob.digest == hashlib.sha256(shared).hexdigest()).refcount == 20
+
+    # Remoções concorrentes, que leem e depois escrevem na mesma transação
+    async def delete_all():
+        deletes = [asgi_request(app, 'DELETE', f'/files/concurrent-{index}.bin', {'Cookie': cookie})
+                   for index in range(40)]
+        listings = [asgi_request(app, 'GET', '/files', {'Cookie': cookie}) for _ in range(200)]
+        return await asyncio.gather(*deletes, *listings)
+
+    assert loop.run_until_complete(delete_all()) == [200] * 240
+    assert Blob.get_or_none(Blob.digest == hashlib.sha256(shared).hexdigest()) is None
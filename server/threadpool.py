@@ -0,0 +1,124 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+import profiling
+from config import IO_THREADS
+from database import db
+from utils import remove_if_exists
+
+# Pool dedicado às operações bloqueantes das rotas assíncronas (disco e banco de dados). É separado do
+# pool padrão do Starlette, usado pelas rotas síncronas, pra que um disco lento não esgote as threads
+# de que /files e /login dependem. Criado sob demanda, já dentro do processo que vai usá-lo.
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix='upload-io')
+    return _executor
+
+
+async def run_io(func: Callable, *args: Any, **kwargs: Any) -> Any:
+    """Executa `func` no pool de I/O sem bloquear o event loop, preservando o contexto atual."""
+    loop = asyncio.get_event_loop()
+    child = profiling.wrap(functools.partial(func, *args, **kwargs))
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), context.run, child)
+
+
+def _with_connection(func: Callable, *args: Any, **kwargs: Any) -> Any:
+    with db.connection_context():
+        return func(*args, **kwargs)
+
+
+async def run_db(func: Callable, *args: Any, **kwargs: Any) -> Any:
+    """Como `run_io`, mas pra funções que usam o banco de dados: `func` roda com uma conexão do pool, que é
+    devolvida ao final, mesmo se houver erro."""
+    return await run_io(_with_connection, func, *args, **kwargs)
+
+
+class AsyncFileWriter:
+    """Escreve um arquivo a partir do event loop, com as chamadas de disco feitas no pool de I/O.
+
+    No máximo uma escrita fica pendente: `write` só retorna depois que a escrita anterior terminou. Assim a
+    leitura do próximo bloco da rede se sobrepõe à escrita do bloco atual, mas, se o disco ficar pra trás,
+    paramos de ler do socket e o TCP aplica backpressure ao cliente, em vez de acumularmos dados em memória.
+
+    Se `offset` for passado, o arquivo existente é aberto pra continuar a escrita a partir dessa posição, e o
+    que houver depois dela é descartado, a não ser que `truncate` seja falso (ex.: escrita de uma parte no meio
+    de um arquivo pré-alocado). `bytes_written` conta apenas as escritas já concluídas.
+
+    Se `hasher` (ex.: `hashlib.sha256()`) for passado, ele é atualizado com cada bloco junto com a escrita, no
+    pool de I/O, então o hash sai sem uma leitura extra do arquivo e sem ocupar o event loop. Se uma escrita
+    falhar, `hasher` passa a ser None.
+    """
+
+    def __init__(self, path: str, offset: Optional[int] = None, truncate: bool = True, hasher=None):
+        self.path = path
+        self.offset = offset
+        self.truncate = truncate
+        self.hasher = hasher
+        self.bytes_written = 0
+        self._fd = None
+        self._pending: Optional[asyncio.Future] = None
+        self._pending_size = 0
+
+    async def open(self) -> 'AsyncFileWriter':
+        self._fd = await run_io(self._open)
+        return self
+
+    def _open(self):
+        if self.offset is None:
+            return open(self.path, 'wb')
+        fd = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+        if self.truncate:
+            fd.truncate(self.offset)
+        fd.seek(self.offset)
+        return fd
+
+    async def write(self, data: bytes) -> None:
+        await self.flush()
+        loop = asyncio.get_event_loop()
+        self._pending = loop.run_in_executor(get_executor(), profiling.wrap(self._fd.write), data)
+        if self.hasher is not None:
+            # O hash e a escrita liberam o GIL, então rodam de fato em paralelo, em threads diferentes
+            self._pending = asyncio.gather(self._pending, loop.run_in_executor(
+                get_executor(), profiling.wrap(self.hasher.update), data))
+        self._pending_size = len(data)
+
+    async def flush(self) -> None:
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            try:
+                await pending
+            except BaseException:
+                # O hash pode já incluir um bloco que não foi escrito; não serve mais pra nada
+                self.hasher = None
+                raise
+            self.bytes_written += self._pending_size
+
+    async def close(self, sync: bool = False) -> None:
+        """Fecha o arquivo; com `sync`, só retorna depois que os dados estiverem gravados no disco."""
+        try:
+            await self.flush()
+            if sync:
+                await run_io(self._sync)
+        finally:
+            await run_io(self._fd.close)
+
+    def _sync(self) -> None:
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+
+    async def abort(self) -> None:
+        """Fecha o arquivo e o remove, descartando escritas pendentes (ex.: upload interrompido)."""
+        try:
+            await self.close()
+        except OSError:
+            pass
+        await run_io(remove_if_exists, self.path)
@@ -1,11 +1,17 @@
 import logging
-import sys
+import os
 
+import logs
+from config import LOG_LEVEL
+
+# Os registros são escritos por uma thread própria, sem bloquear quem loga (ver logs.py)
 log = logging.getLogger('upload_server')
-log.setLevel(logging.INFO)
+log.setLevel(LOG_LEVEL)
+logs.configure(log)
+
 
-handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('[%(levelname)s] %(asctime)s - %(message)s')
-handler.setFormatter(formatter)
-log.addHandler(handler)
+def remove_if_exists(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass